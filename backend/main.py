@@ -1,8 +1,8 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, Response
 import subprocess
-import os
+import json
 
 app = FastAPI()
 
@@ -12,6 +12,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Movement-Sizes"],
 )
 
 @app.post("/api/run")
@@ -26,21 +27,32 @@ async def run_code(request: Request):
 async def compile_code():
     midi_file = "output.mid"
     try:
+        # the compiler writes the midi file to its stdout, it doesn't go through the disk,
+        # and its errors to stderr. With --sizes it also writes there a line per movement with
+        # the events it expands into and the beats it plays, they're sent apart from the errors
         result = subprocess.run(
-            ["python", "../python_stuff/compiler.py", "code.txt", midi_file],
-            capture_output=True, text=True, timeout=10
+            ["python", "../python_stuff/compiler.py", "code.txt", "-", "--sizes"],
+            capture_output=True, timeout=10
         )
+        lines = result.stderr.decode("utf-8", errors="replace").splitlines(keepends=True)
+        sizes = [line.rstrip() for line in lines if line.startswith("Size(")]
         if result.returncode != 0:
+            errors = "".join(line for line in lines if not line.startswith("Size("))
             return JSONResponse(
                 status_code=400,
-                content={"error": result.stdout, "output.txt": result.stdout}
+                content={"error": errors, "output.txt": errors, "sizes": sizes}
+            )
+        if result.stdout:
+            return Response(
+                result.stdout,
+                media_type="audio/midi",
+                headers={"Content-Disposition": f'attachment; filename="{midi_file}"',
+                         "X-Movement-Sizes": json.dumps(sizes)}
             )
-        if os.path.exists(midi_file):
-            return FileResponse(midi_file, media_type="audio/midi", filename=midi_file)
         else:
             return JSONResponse(
                 status_code=500,
-                content={"error": "MIDI file was not created.", "output.txt": result.stdout}
+                content={"error": "MIDI file was not created.", "output.txt": ""}
             )
     except Exception as e:
         return JSONResponse(
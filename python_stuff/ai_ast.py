@@ -1,8 +1,14 @@
 # AST Node classes
 from lexer import *
+from fractions import Fraction
+import copy
 
 
+# Nodes use __slots__ instead of a __dict__, a parsed score holds a lot of them.
+# Copies of a tree share its tokens (see Token.__deepcopy__), so only the nodes get copied
 class ASTNode:
+    __slots__ = ("source",)
+
     def __init__(self, source):
         self.source = source
         pass
@@ -10,11 +16,81 @@ class ASTNode:
     def __repr__(self):
         return self.__str__()
 
-    def source(self):
-        return self.source
+    def __deepcopy__(self, memo):
+        return copy_tree(self)
+
+
+# The names of the fields of a node class, cached per class
+SLOT_NAMES = {}
+
+def slot_names(cls):
+    names = SLOT_NAMES.get(cls)
+    if names is None:
+        names = SLOT_NAMES[cls] = tuple(name for c in cls.__mro__ for name in getattr(c, "__slots__", ()))
+    return names
+
+
+# The values of all the fields of a node, the slotted stand in for vars(node)
+def node_fields(node):
+    return [getattr(node, name) for name in slot_names(type(node))]
+
+
+# A hashable key for the structure of a subtree, equal subtrees get equal keys wherever they
+# are in the source: tokens count by their type and value, not their position
+def node_key(node):
+    key = []
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, Token):
+            key.append((item.type, item.value))
+        elif type(item) is list:
+            key.append(("list", len(item)))
+            stack.extend(reversed(item))
+        elif isinstance(item, ASTNode):
+            key.append(type(item))
+            stack.extend(reversed(node_fields(item)))
+        else:
+            key.append(item)
+    return tuple(key)
+
+
+# Copies the nodes and lists of a subtree and shares everything else (tokens, numbers, strings).
+# The copy is done with an explicit stack, so deep trees don't hit the recursion limit
+def copy_tree(node):
+    top = [node]
+    stack = [top] # copies whose fields still point at the originals
+    while stack:
+        item = stack.pop()
+        if type(item) is list:
+            for i, value in enumerate(item):
+                item[i] = shallow_copy(value, stack)
+        else:
+            for name in slot_names(type(item)):
+                setattr(item, name, shallow_copy(getattr(item, name), stack))
+    return top[0]
+
+
+def shallow_copy(value, stack):
+    if type(value) is list:
+        value = list(value)
+    elif isinstance(value, ASTNode):
+        original = value
+        value = object.__new__(type(original))
+        for name in slot_names(type(original)):
+            setattr(value, name, getattr(original, name))
+    elif isinstance(value, (dict, tuple, set)):
+        return copy.deepcopy(value)
+    else:
+        return value
+
+    stack.append(value)
+    return value
 
 
 class Program(ASTNode):
+    __slots__ = ("metadata", "macros", "tracks", "ident_dic", "err_list")
+
     def __init__(self, metadata, macros, tracks, source, idents, error_list):
         super().__init__(source)
         self.metadata = metadata
@@ -28,6 +104,8 @@ class Program(ASTNode):
 
 
 class Metadata(ASTNode):
+    __slots__ = ("title",)
+
     def __init__(self, title, source):
         super().__init__(source)
         self.title = title
@@ -39,6 +117,8 @@ class Metadata(ASTNode):
 ### Statements:
 
 class Macro(ASTNode):
+    __slots__ = ("name", "parameters", "body")
+
     def __init__(self, name, parameters, body):
         super().__init__(name)
         self.name = name
@@ -50,6 +130,8 @@ class Macro(ASTNode):
 
 
 class Track(ASTNode):
+    __slots__ = ("name", "movements")
+
     def __init__(self, name, movements, source):
         super().__init__(source)
         self.name = name
@@ -60,6 +142,8 @@ class Track(ASTNode):
 
 
 class Movement(ASTNode):
+    __slots__ = ("instrument", "tag", "expressions")
+
     def __init__(self, instrument, tag, expressions):
         super().__init__(instrument)
         self.instrument = instrument
@@ -74,6 +158,8 @@ class Movement(ASTNode):
 
 
 class Ident(ASTNode):
+    __slots__ = ("ident",)
+
     def __init__(self, source):
         super().__init__(source)
         self.ident = source
@@ -83,6 +169,8 @@ class Ident(ASTNode):
 
 
 class ReleaseNote(ASTNode):
+    __slots__ = ()
+
     def __init__(self, source):
         super().__init__(source)
 
@@ -91,6 +179,8 @@ class ReleaseNote(ASTNode):
 
 
 class HoldNote(ASTNode):
+    __slots__ = ("note",)
+
     def __init__(self, note, source):
         super().__init__(source)
         self.note = note
@@ -100,6 +190,8 @@ class HoldNote(ASTNode):
 
 
 class Note(ASTNode):
+    __slots__ = ("value", "semitone", "octave", "duration")
+
     def __init__(self, value, semitone, octave, duration):
         super().__init__(value)
         self.value = value
@@ -112,6 +204,8 @@ class Note(ASTNode):
 
 
 class Chord(ASTNode):
+    __slots__ = ("notes",)
+
     def __init__(self, notes, source):
         super().__init__(source)
         self.notes = notes
@@ -121,6 +215,8 @@ class Chord(ASTNode):
 
 
 class MacroCall(ASTNode):
+    __slots__ = ("name", "arguments")
+
     def __init__(self, name, arguments):
         super().__init__(name)
         self.name = name
@@ -131,6 +227,8 @@ class MacroCall(ASTNode):
 
 
 class Repetition(ASTNode):
+    __slots__ = ("times",)
+
     def __init__(self, times, source):
         super().__init__(source)
         self.times = times
@@ -140,7 +238,23 @@ class Repetition(ASTNode):
         return f"Repeat*{self.times})"
 
 
+# The expressions of body played times times. Made by apply_repetitions out of an expression
+# and the Repetitions after it, the body is shared by every repetition instead of being copied
+class Repeat(ASTNode):
+    __slots__ = ("body", "times")
+
+    def __init__(self, body, times, source):
+        super().__init__(source)
+        self.body = body
+        self.times = times
+
+    def __str__(self):
+        return f"Repeat*{self.times}{self.body}"
+
+
 class SetOctave(ASTNode):
+    __slots__ = ("dir", "n")
+
     def __init__(self, dir, n, source):
         super().__init__(source)
         self.dir = dir
@@ -151,6 +265,8 @@ class SetOctave(ASTNode):
 
 
 class SetDuration(ASTNode):
+    __slots__ = ("dur",)
+
     def __init__(self, dur, source):
         super().__init__(source)
         self.dur = dur
@@ -159,16 +275,9 @@ class SetDuration(ASTNode):
         return f"set(Duration={self.dur})"
 
 
-class Fraction:
-    def __init__(self, x, over):
-        self.x = x
-        self.over = over
-
-    def __str__(self):
-        return f"{self.x}/{self.over}"
-
-
 class SetTempo(ASTNode):
+    __slots__ = ("n",)
+
     def __init__(self, n, source):
         super().__init__(source)
         self.n = n
@@ -178,6 +287,8 @@ class SetTempo(ASTNode):
 
 
 class SetTone(ASTNode):
+    __slots__ = ("n", "note")
+
     def __init__(self, n, note, source):
         super().__init__(source)
         self.n = n
@@ -188,6 +299,8 @@ class SetTone(ASTNode):
 
 
 class Bar(ASTNode):
+    __slots__ = ()
+
     def __init__(self, source):
         super().__init__(source)
 
@@ -196,6 +309,8 @@ class Bar(ASTNode):
 
 
 class SetInterval(ASTNode):
+    __slots__ = ("time",)
+
     def __init__(self, time):
         super().__init__(time)
         self.time = time
@@ -205,6 +320,8 @@ class SetInterval(ASTNode):
 
 
 class SetMeasure(ASTNode):
+    __slots__ = ("x", "over")
+
     def __init__(self, x, over, source):
         super().__init__(source)
         self.x = x
@@ -215,6 +332,8 @@ class SetMeasure(ASTNode):
 
 
 class SetVolume(ASTNode):
+    __slots__ = ("vol",)
+
     def __init__(self, vol, source):
         super().__init__(source)
         self.vol = vol
@@ -224,6 +343,8 @@ class SetVolume(ASTNode):
 
 
 class temp(ASTNode):
+    __slots__ = ()
+
     def __init__(self, source):
         super().__init__(source)
 
@@ -233,6 +354,8 @@ class temp(ASTNode):
 
 ## Collections/groups
 class ExprGroup(ASTNode):
+    __slots__ = ("exprs",)
+
     def __init__(self, exprs, source):
         super().__init__(source)
         self.exprs = exprs
@@ -244,11 +367,39 @@ class ExprGroup(ASTNode):
 ### errors
 
 class errExpr(ASTNode):
+    __slots__ = ()
+
     def __init__(self, source):
         super().__init__(source)
 
 
+# Prints the tree under node. The walk uses an explicit stack instead of recursion,
+# so deeply nested groups don't hit the recursion limit
 def traverse_ast(node, indent):
+    out = []
+    stack = [(node, indent)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            out.append(item)
+            continue
+
+        parts = []
+        for i, line in enumerate(node_lines(*item)):
+            if i > 0:
+                parts.append("\n")
+            if isinstance(line, list):
+                parts.extend(line)
+            else:
+                parts.append(line)
+        stack.extend(reversed(parts))
+
+    return "".join(out)
+
+
+# The lines printing a node. A line is a string, a (child, indent) pair printed in its place,
+# or a list of those for a child printed in the middle of a line
+def node_lines(node, indent):
     prefix = "  " * indent
     result = []
 
@@ -256,17 +407,17 @@ def traverse_ast(node, indent):
         result.append(f"{prefix}Program:")
         if node.metadata:
             for meta in node.metadata:
-                result.append(traverse_ast(meta, indent + 1))
+                result.append((meta, indent + 1))
 
         if node.macros:
             result.append(f"{prefix}Macros:")
             for macro in node.macros:
-                result.append(traverse_ast(macro, indent + 1))
+                result.append((macro, indent + 1))
 
         if node.tracks:
             result.append(f"{prefix}Tracks:")
             for track in node.tracks:
-                result.append(traverse_ast(track, indent + 1))
+                result.append((track, indent + 1))
 
     elif isinstance(node, Metadata):
         result.append(f"{prefix}Metadata:")
@@ -278,27 +429,30 @@ def traverse_ast(node, indent):
         result.append(f"{prefix}  Parameters: {node.parameters}")
         result.append(f"{prefix}  Body:")
         for element in node.body:
-            result.append(traverse_ast(element, indent + 2))
+            result.append((element, indent + 2))
 
     elif isinstance(node, Track):
         result.append(f"{prefix}Track '{node.name}':")
         result.append(f"{prefix}  Movements:")
         for element in node.movements:
-            result.append(traverse_ast(element, indent + 2))
+            result.append((element, indent + 2))
 
     elif isinstance(node, Movement):
         result.append(f"{prefix}{node.instrument.value} {"" if node.tag == "" else node.tag.value} = ")
-        if isinstance(node.expressions, ExprGroup):
-            pass
 
         for element in node.expressions:
-            result.append(traverse_ast(element, indent + 2))
+            result.append((element, indent + 2))
 
     elif isinstance(node, Repetition):
         result.append(f"{prefix}Repeat*{node.times}")
 
+    elif isinstance(node, Repeat):
+        result.append(f"{prefix}Repeat*{node.times}:")
+        for expr in node.body:
+            result.append((expr, indent + 2))
+
     elif isinstance(node, HoldNote):
-        result.append(f"{prefix}Hold(\n{prefix}{traverse_ast(node.note, indent)}\n{prefix})")
+        result.append([f"{prefix}Hold(\n{prefix}", (node.note, indent), f"\n{prefix})"])
 
     elif (isinstance(node, SetOctave) or
           isinstance(node, SetDuration) or
@@ -313,29 +467,29 @@ def traverse_ast(node, indent):
           isinstance(node, SetVolume)
     ):
 
-        return f"{prefix}{node}"
+        result.append(f"{prefix}{node}")
 
     elif isinstance(node, MacroCall):
         result.append(f"{prefix}{node.name.value}(")
 
         for expr in node.arguments:
-            result.append(traverse_ast(expr, indent + 2))
+            result.append((expr, indent + 2))
         result.append(f"{prefix})")
 
     elif isinstance(node, ExprGroup):
         result.append(f"{prefix}[")
 
         for expr in node.exprs:
-            result.append(traverse_ast(expr, indent + 2))
+            result.append((expr, indent + 2))
 
         result.append(f"{prefix}]")
 
     elif isinstance(node, Chord):
         result.append(f"{prefix}Chord:")
         for note in node.notes:
-            result.append(f"{prefix}{traverse_ast(note, indent)}\\")
+            result.append([prefix, (note, indent), "\\"])
 
     else:
         raise ValueError(f"Unhandled case: {type(node)}")
-    return "\n".join(result) if isinstance(result, list) else result
+    return result
 
@@ -0,0 +1,410 @@
+from lexer import *
+from new_parser import Parser, LogLevel
+from incremental import IncrementalParser
+from simplify import movement_events, expansion_sizes
+from ai_ast import traverse_ast
+from midi_ir import EventBuffer, MidiIR, TICKS_PER_QUARTER, STRIDE, dump, load
+from smf import encode_smf
+from midigen import gen_ir
+import tracemalloc
+import io
+import copy
+import subprocess
+import types
+import time
+import sys
+import os
+
+# rough benchmarks for the compiler stages, run with:
+# python bench.py [stage ...]
+
+# the commit before the rewrites, with the per character lexer and the midiutil code generator.
+# The lexer and codegen benches compare against it
+BASELINE = "8edf815"
+
+def gen_score(n_notes):
+    # builds a score of roughly n_notes notes, using most of the syntax
+    lines = ['title: "bench"', '', 'riff = do re mi fa', '']
+    lines.append('piano "bench": [')
+    lines.append('    !4/4 :1/4 v=90')
+
+    notes = ["do", "re", "mi", "fa", "sol", "la", "si", "r"]
+    written = 0
+    while written < n_notes:
+        bar = []
+        for i in range(4):
+            note = notes[(written + i) % len(notes)]
+            if i == 1:
+                note += ".5"
+            bar.append(note)
+        lines.append("    " + " ".join(bar) + " |  # a comment")
+        written += 4
+
+        if written % 64 == 0:
+            lines.append("    [do/mi/sol | re mi fa sol |]*2 riff")
+            written += 9
+
+    lines.append("]")
+    return "\n".join(lines) + "\n"
+
+
+# the number of events the first movement of ast plays
+def count_events(ast):
+    return sum(1 for _ in movement_events(ast, ast.tracks[0].movements[0]))
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+# the modules of the compiler named in names at a given commit, imported in order, each one
+# importing the ones before it instead of the current ones. None when git, the commit or a module
+# the old code imports (midiutil) is not there
+def baseline_modules(names, rev=BASELINE):
+    here = os.path.dirname(os.path.abspath(__file__))
+    current = {name: sys.modules.get(name) for name in names}
+    modules = {}
+    try:
+        for name in names:
+            source = subprocess.run(["git", "show", f"{rev}:./{name}.py"], cwd=here,
+                                    capture_output=True, text=True, check=True).stdout
+            module = sys.modules[name] = types.ModuleType(name)
+            exec(compile(source, f"{rev}:{name}.py", "exec"), module.__dict__)
+            modules[name] = module
+    except (OSError, subprocess.CalledProcessError, ImportError):
+        return None
+    finally:
+        for name, module in current.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+    return modules
+
+
+# the Tokenizer class of lexer.py at a given commit, None when git or the commit is not there
+def baseline_tokenizer(rev=BASELINE):
+    modules = baseline_modules(["lexer"], rev)
+    return modules and modules["lexer"].Tokenizer
+
+def bench_lexer(n_notes):
+    source = gen_score(n_notes)
+    elapsed, tokens = timed(lambda: Tokenizer(source).tokenize())
+    print(f"lexer: {n_notes} notes, {len(source)} chars, {len(tokens)} tokens in {elapsed*1000:.1f}ms"
+          f" ({len(tokens)/elapsed/1e6:.2f}M tokens/s)")
+
+    Baseline = baseline_tokenizer()
+    if Baseline is None:
+        print(f"lexer: the lexer of {BASELINE} could not be read from git, skipped the comparison")
+        return
+    baseline_time, baseline_tokens = timed(lambda: Baseline(source).tokenize())
+    assert len(baseline_tokens) == len(tokens), "the two lexers give a different number of tokens"
+    print(f"lexer: {n_notes} notes, {len(baseline_tokens)} tokens in {baseline_time*1000:.1f}ms with the lexer of {BASELINE},"
+          f" {baseline_time/elapsed:.2f}x the time of the regex scanner")
+
+    # compiler.py lexes the file into a TokenBuffer as the parser reads it, no Token object is made
+    # for most tokens. The matching alone is the floor of any regex scanner, a Python loop has to
+    # look at every match
+    buffer_time, _ = timed(lambda: Tokenizer(io.StringIO(source)).buffer(lazy=True).fill_all())
+    match_time, _ = timed(lambda: sum(1 for _ in TOKEN_RE.finditer(source)))
+    print(f"lexer: {n_notes} notes, TokenBuffer from a file in {buffer_time*1000:.1f}ms ({baseline_time/buffer_time:.2f}x faster than {BASELINE}),"
+          f" the regex matches alone {match_time*1000:.1f}ms ({baseline_time/match_time:.2f}x)")
+
+    # tokenize() also makes a Token object for every token, the matching and the objects are its floor
+    objects_time, _ = timed(lambda: [Token("", 0, 0, 0) for _ in range(len(tokens))])
+    print(f"lexer: {n_notes} notes, the regex matches and {len(tokens)} Token objects alone {(match_time + objects_time)*1000:.1f}ms,"
+          f" tokenize() takes {elapsed/(match_time + objects_time):.2f}x that")
+
+    # lexing and parsing together, the way compiler.py does it and from the Token objects of stream
+    stream_time, _ = timed(lambda: Parser(Tokenizer(io.StringIO(source)).stream()).parse())
+    compiled_time, _ = timed(lambda: Parser(Tokenizer(io.StringIO(source)).buffer(lazy=True)).parse())
+    print(f"lexer: {n_notes} notes lexed and parsed in {compiled_time*1000:.1f}ms from a TokenBuffer,"
+          f" {stream_time*1000:.1f}ms from stream ({stream_time/compiled_time:.2f}x)")
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench_stream(n_notes):
+    source = gen_score(n_notes)
+    listed = peak_memory(lambda: Parser(Tokenizer(source).tokenize()).parse())
+    streamed = peak_memory(lambda: Parser(Tokenizer(source).stream()).parse())
+    # the way compiler.py reads a file
+    buffered = peak_memory(lambda: Parser(Tokenizer(io.StringIO(source)).buffer(lazy=True)).parse())
+    print(f"parser: {n_notes} notes, peak memory with a token list {listed/1e6:.1f}MB, streamed {streamed/1e6:.1f}MB,"
+          f" from a TokenBuffer filled from a file {buffered/1e6:.1f}MB")
+
+
+def bench_token_buffer(n_notes):
+    source = gen_score(n_notes)
+    listed = peak_memory(lambda: Tokenizer(source).tokenize())
+    buffered = peak_memory(lambda: Tokenizer(source).buffer())
+    n_tokens = len(Tokenizer(source).buffer())
+    print(f"tokens: {n_notes} notes, {n_tokens} tokens, {listed/n_tokens:.0f} bytes/token as Token objects,"
+          f" {buffered/n_tokens:.0f} bytes/token in a TokenBuffer")
+
+    tokens = Tokenizer(source).tokenize()
+    buffer = Tokenizer(source).buffer()
+    list_time, _ = timed(lambda: Parser(tokens).parse())
+    buffer_time, _ = timed(lambda: Parser(buffer).parse())
+    print(f"parser: {n_notes} notes in {list_time*1000:.1f}ms from a token list, {buffer_time*1000:.1f}ms from a TokenBuffer")
+
+
+def bench_trace(n_notes):
+    buffer = Tokenizer(gen_score(n_notes)).buffer()
+    times = []
+    for level in (LogLevel.OFF, LogLevel.INFO, LogLevel.DEBUG):
+        elapsed, _ = timed(lambda: Parser(buffer, level, log_size=100).parse())
+        times.append(f"{elapsed*1000:.1f}ms")
+    print(f"trace: {n_notes} notes parsed in {', '.join(times)} with tracing off, info, debug")
+
+
+def bench_expr(n_exprs):
+    # per expression cost of parse_expr, on plain notes and on notes with modifiers
+    for name, expr in (("plain notes", "do"), ("notes with modifiers", "do+.5:1/4"), ("mixed", "do re | :1/4 mi [fa] >")):
+        count = len(expr.split())
+        source = "piano: " + " ".join([expr] * (n_exprs // count)) + "\n"
+        buffer = Tokenizer(source).buffer()
+        elapsed, _ = timed(lambda: Parser(buffer).parse())
+        print(f"expr: {n_exprs} expressions, {name}, {elapsed/n_exprs*1e6:.2f}us per expression")
+
+
+def bench_nesting(depth):
+    # deeply nested groups, holds and macro calls, deeper than the recursion limit. The time per
+    # level should stay the same as depth grows, it would grow with depth for a quadratic parse
+    bodies = {
+        "groups": "[" * depth + "do]*2" + "]" * (depth - 1),
+        "holds": "[(do) " * depth + "do/mi" + "]" * depth,
+        "calls": "m(" * depth + "do" + ")" * depth,
+    }
+    for name, body in bodies.items():
+        source = "m(a) = a\npiano: " + body + "\n"
+        parse_time, ast = timed(lambda: Parser(Tokenizer(source).buffer()).parse(), repeat=1)
+        result = f"nesting: {depth} nested {name}, parse {parse_time*1000:.0f}ms ({parse_time/depth*1e6:.1f}us per level)"
+        if depth <= 10_000:
+            # the printed tree has an indent per level, so its size grows with the square of the depth
+            traverse_time, _ = timed(lambda: traverse_ast(ast, 0), repeat=1)
+            result += f", traverse_ast {traverse_time*1000:.0f}ms"
+
+        events_time, events = timed(lambda: count_events(ast), repeat=1)
+        print(result + f", {events} events walked in {events_time*1000:.0f}ms")
+
+
+def bench_groups(n_groups):
+    # flat and nested groups, the time per group should stay the same as n_groups grows
+    for name, body in (("flat", "[do re] " * n_groups), ("nested", "[do " * n_groups + "]" * n_groups)):
+        ast = Parser(Tokenizer("piano: " + body + "\n").buffer()).parse()
+        elapsed, _ = timed(lambda: count_events(ast))
+        print(f"groups: {n_groups} {name} groups walked in {elapsed*1000:.1f}ms, {elapsed/n_groups*1e6:.2f}us per group")
+
+
+def bench_ast(n_notes):
+    # memory held by the parsed AST, and the cost of copying it
+    buffer = Tokenizer(gen_score(n_notes)).buffer()
+
+    tracemalloc.start()
+    ast = Parser(buffer).parse()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    copy_time, _ = timed(lambda: copy.deepcopy(ast.tracks))
+    print(f"ast: {n_notes} notes, AST holds {held/1e6:.1f}MB, deepcopy of the tracks {copy_time*1000:.1f}ms")
+
+
+def bench_repeats(times):
+    # a nested repetition, played without the AST growing past the size of the source
+    source = f"piano: [[do re mi fa |]*100 [sol la]*{times}]*{times}\n"
+
+    tracemalloc.start()
+    ast = Parser(Tokenizer(source).buffer()).parse()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    elapsed, events = timed(lambda: count_events(ast), repeat=1)
+    print(f"repeats: *{times} nested, {events} events walked in {elapsed*1000:.1f}ms, AST holds {held/1e3:.0f}kB")
+
+
+def bench_macros(n_uses):
+    # macros used many times, with and without arguments
+    lines = ["riff = do re mi fa | sol la si r |", "verse = riff riff [sol sol fa fa |]*2", "call(a, b) = a riff b verse"]
+    uses = " ".join(["verse", "call(do,mi)", "riff"] * (n_uses // 3))
+    source = "\n".join(lines) + "\npiano: " + uses + "\n"
+
+    def walked():
+        ast = Parser(Tokenizer(source).buffer()).parse()
+        return count_events(ast)
+
+    elapsed, _ = timed(walked)
+    print(f"macros: {n_uses} uses, parsed and walked in {elapsed*1000:.1f}ms")
+
+    # a parameterised macro called with different arguments each time
+    notes = ["do", "re", "mi", "fa", "sol", "la", "si"]
+    body = " ".join(["a b do re mi fa | sol la si r | [a mi]*2 b"] * 4)
+    calls = " ".join(f"call({notes[i % 7]},{notes[i // 7 % 7]}.{i // 49 % 8})" for i in range(n_uses))
+    source = f"call(a,b) = {body}\npiano: {calls}\n"
+    elapsed, _ = timed(walked)
+    print(f"macros: {n_uses} calls with different arguments, parsed and walked in {elapsed*1000:.1f}ms")
+
+    # a chain of macros each using the one before it, deeper than the recursion limit
+    chain = ["m0 = do re"] + [f"m{i} = m{i-1} mi" for i in range(1, n_uses)]
+    source = "\n".join(chain) + f"\npiano: m{n_uses-1}\n"
+    elapsed, events = timed(walked, repeat=1)
+    print(f"macros: chain of {n_uses} macros, {events} events, parsed and walked in {elapsed*1000:.1f}ms")
+
+
+def bench_pipeline(times):
+    # events of a repeated score through movement_events, parse included
+    source = f"riff = do re mi fa | sol la si r |\nverse(a) = [riff a a ]*4\npiano: [verse(do) [sol la]*10 verse(mi)]*{times}\n"
+
+    def events():
+        ast = Parser(Tokenizer(source).buffer()).parse()
+        return movement_events(ast, ast.tracks[0].movements[0])
+
+    first_time, _ = timed(lambda: next(events()))
+    total_time, count = timed(lambda: sum(1 for _ in events()), repeat=1)
+    peak = peak_memory(lambda: sum(1 for _ in events()))
+    print(f"pipeline: {count} events through movement_events, first event {first_time*1000:.2f}ms,"
+          f" all events {total_time*1000:.1f}ms, peak memory {peak/1e3:.0f}kB")
+
+
+def bench_sizes(times):
+    # a macro of repeated macros, sized without expanding it
+    source = f"riff = do re mi fa | :1/8 sol la si r |\nverse = [riff riff ]*{times}\nsong = [verse sol]*{times}\npiano: [song ]*{times}\n"
+    ast = Parser(Tokenizer(source).buffer()).parse()
+    elapsed, sizes = timed(lambda: expansion_sizes(ast))
+    size = sizes[0][0]
+    print(f"sizes: {size.events} events, {float(size.duration)} beats, sized in {elapsed*1000:.2f}ms")
+
+
+def bench_smf(n_notes):
+    # writing the notes of a scale played over and over, with the built in writer and with midiutil
+    notes = [(60 + i % 12, i * 0.5, 0.5) for i in range(n_notes)]
+
+    def ir():
+        track = EventBuffer()
+        track.add_program_change(0, 0, 0)
+        for pitch, time, duration in notes:
+            track.add_note(0, pitch, int(time * TICKS_PER_QUARTER), int(duration * TICKS_PER_QUARTER), 100)
+        tempo = EventBuffer()
+        tempo.add_tempo(0, 120)
+        return MidiIR([tempo, track])
+
+    def native():
+        return encode_smf(ir())
+
+    elapsed, data = timed(native, repeat=1)
+    peak = peak_memory(native)
+    print(f"smf: {n_notes} notes, {len(data)} bytes written in {elapsed*1000:.0f}ms, peak {peak/1e6:.1f}MB")
+
+    midi = ir()
+    held = sum(track.events.itemsize * len(track.events) for track in midi.tracks)
+    dump_time, text = timed(lambda: dump(midi), repeat=1)
+    load_time, _ = timed(lambda: load(text), repeat=1)
+    print(f"smf: IR of {n_notes} notes held in {held/1e6:.1f}MB, dumped in {dump_time*1000:.0f}ms ({len(text)/1e6:.1f}MB of text),"
+          f" loaded in {load_time*1000:.0f}ms")
+
+    try:
+        from midiutil import MIDIFile
+    except ImportError:
+        print("smf: midiutil is not installed, skipped the comparison")
+        return
+
+    def with_midiutil():
+        midi = MIDIFile(1, True, True, False, 1)
+        midi.addTempo(0, 0, 120)
+        midi.addProgramChange(0, 0, 0, 0)
+        for pitch, time, duration in notes:
+            midi.addNote(0, 0, pitch, time, duration, 100)
+        out = io.BytesIO()
+        midi.writeFile(out)
+        return out.getvalue()
+
+    elapsed, data = timed(with_midiutil, repeat=1)
+    peak = peak_memory(with_midiutil)
+    print(f"smf: {n_notes} notes, {len(data)} bytes written by midiutil in {elapsed*1000:.0f}ms, peak {peak/1e6:.1f}MB")
+
+
+def bench_codegen(n_notes):
+    # the IR of a long movement, generated a note at a time and with the numpy arrays
+    source = gen_score(n_notes)
+    times = {}
+    for vectorised in (False, True):
+        ast = Parser(Tokenizer(source).buffer()).parse()
+        elapsed, ir = timed(lambda: gen_ir(ast, vectorised=vectorised), repeat=1)
+        name = "numpy" if vectorised else "scalar"
+        times[name] = elapsed
+        track = ir.tracks[1]
+        print(f"codegen: {n_notes} notes, {len(track)} events generated ({name}) in {elapsed*1000:.0f}ms,"
+              f" stored as {len(track.events) // STRIDE} events and {len(track.runs)} runs of {sum(map(len, track.runs)) // (8 * STRIDE)}")
+
+    # the code generator of the baseline goes through the expanded movement with an isinstance
+    # ladder and adds every note to a midiutil MIDIFile. Its expansion passes aren't timed, the
+    # walk of gen_ir is. The score has measure errors, so neither writes a file
+    old = baseline_modules(["lexer", "ai_ast", "new_parser", "simplify", "midigen"])
+    if old is None:
+        print(f"codegen: the code generator of {BASELINE} or midiutil could not be loaded, skipped the comparison")
+        return
+    ast = old["new_parser"].Parser(old["lexer"].Tokenizer(source).tokenize()).parse()
+    old["simplify"].resolve_repeats(ast)
+    old["simplify"].flatten_expr_group(ast)
+    old["simplify"].resolve_macros(ast)
+    elapsed, _ = timed(lambda: old["midigen"].gen_midi(ast, os.devnull), repeat=1)
+    print(f"codegen: {n_notes} notes, {len(ast.tracks[0].movements[0].expressions)} expanded events generated by {BASELINE} in {elapsed*1000:.0f}ms,"
+          f" {elapsed/times['scalar']:.2f}x the time of the scalar runner, {elapsed/times['numpy']:.2f}x numpy")
+
+def bench_incremental(n_movements):
+    # many small movements, edited in the middle
+    source = "".join(f'piano "m{i}": do re mi fa | sol la si r |\n' for i in range(n_movements))
+    middle = source.index(f'"m{n_movements // 2}"')
+
+    full_time, _ = timed(lambda: Parser(Tokenizer(source).buffer()).parse())
+    live = IncrementalParser(source)
+    live.program()
+
+    def edit(start, end, text):
+        edit_time, _ = timed(lambda: live.edit(start, end, text), repeat=1)
+        program_time, _ = timed(live.program, repeat=1)
+        return f"{edit_time*1000:.2f}ms + program {program_time*1000:.2f}ms ({live.reparsed} statements parsed again)"
+
+    note = source.index("do", middle)
+    note_edit = edit(note, note + 2, "re")
+    # an empty line before the movement, every statement after it moves down
+    line_edit = edit(middle - 6, middle - 6, "\n")
+    # a new tag, renamed in the registered program
+    tag_edit = edit(middle + 4, middle + 4, "x")
+    print(f"incremental: {n_movements} movements, full parse {full_time*1000:.1f}ms, note edit {note_edit},"
+          f" new line edit {line_edit}, tag edit {tag_edit}")
+
+BENCHES = {
+    "lexer": lambda: [bench_lexer(n) for n in (1_000, 10_000, 100_000)],
+    "stream": lambda: [bench_stream(n) for n in (1_000, 10_000)],
+    "tokens": lambda: [bench_token_buffer(n) for n in (1_000, 10_000)],
+    "expr": lambda: [bench_expr(n) for n in (10_000, 100_000)],
+    "nesting": lambda: [bench_nesting(n) for n in (2_000, 10_000, 50_000)],
+    "groups": lambda: [bench_groups(n) for n in (1_000, 10_000, 100_000)],
+    "ast": lambda: [bench_ast(n) for n in (10_000, 100_000)],
+    "repeats": lambda: [bench_repeats(n) for n in (10, 100, 1000)],
+    "macros": lambda: [bench_macros(n) for n in (500, 5_000)],
+    "pipeline": lambda: [bench_pipeline(n) for n in (10, 1000)],
+    "sizes": lambda: [bench_sizes(n) for n in (10, 1000)],
+    "smf": lambda: [bench_smf(n) for n in (10_000, 100_000)],
+    "codegen": lambda: [bench_codegen(n) for n in (10_000, 100_000)],
+    "trace": lambda: [bench_trace(n) for n in (1_000, 10_000)],
+    "incremental": lambda: [bench_incremental(n) for n in (100, 1_000, 10_000)],
+}
+
+if __name__ == "__main__":
+    stages = sys.argv[1:] or BENCHES.keys()
+    for stage in stages:
+        BENCHES[stage]()
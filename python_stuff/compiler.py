@@ -3,19 +3,50 @@ from lexer import Tokenizer
 from simplify import * 
 from ai_ast import traverse_ast
 from midigen import *
+import argparse
 import sys
 
-def main():
-    file_name = sys.argv[1]
+# a count above 0, for --max-events
+def positive_int(text):
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a whole number, got {text!r}")
+    if value <= 0:
+        raise argparse.ArgumentTypeError(f"expected a number above 0, got {value}")
+    return value
 
-    with open(file_name) as f:
-        source = f.read()
+# For --sizes: a line per movement with the events it expands into and the beats it plays,
+# the budget is checked against the events
+def print_sizes(ast, sizes, file):
+    for track, track_sizes in zip(ast.tracks, sizes):
+        for movement, size in zip(track.movements, track_sizes):
+            instrument = movement.instrument
+            print(f"Size({instrument.line},{instrument.column}): {instrument.value} expands into {size.events} events, {size.duration} beats", file=file)
 
-    tokenizer = Tokenizer(source)
-    tokens = tokenizer.tokenize()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compiles a score to a midi file.")
+    parser.add_argument("input_file", help="the score to compile")
+    parser.add_argument("output_file", nargs="?",
+                        help="the midi file to write, - to write it to stdout (default: the input file name with .mid)")
+    parser.add_argument("--max-events", type=positive_int, default=MAX_EVENTS, metavar="N",
+                        help=f"reject the score when a movement expands into more than N events (default: {MAX_EVENTS})")
+    parser.add_argument("--jobs", type=positive_int, default=1, metavar="N",
+                        help="generate the tracks in N worker processes, only worth it for long scores with several tracks (default: 1)")
+    parser.add_argument("--sizes", action="store_true",
+                        help="print the events every movement expands into and the beats it plays to stderr, before the midi file is generated")
+    return parser.parse_args(argv)
 
-    parser = Parser(tokens)
-    ast = parser.parse()
+def main(argv=None):
+    args = parse_args(argv)
+    file_name = args.input_file
+
+    # the file is lexed into a TokenBuffer while the parser reads it, no Token object
+    # is made for the tokens the parser only checks the type of
+    with open(file_name) as f:
+        tokenizer = Tokenizer(f)
+        parser = Parser(tokenizer.buffer(lazy=True))
+        ast = parser.parse()
 
 
 
@@ -34,30 +65,39 @@ def main():
 |
 | piano: do re mi fa sol la si do
 
-""")
-        return
+""", file=sys.stderr)
+        return 1
 
-    resolve_repeats(ast)
-    # print(traverse_ast(ast,0))
-    flatten_expr_group(ast)
-    # print(traverse_ast(ast,0))
-    resolve_macros(ast)
-    # print(traverse_ast(ast,0))
-    
-    output = ""
-    try:
-        output = sys.argv[2]
-    except:
+    # groups, repeats and macros are resolved while gen_midi walks the movements, see movement_events.
+    # Their size is known up front, so a score that would expand too much is rejected right away.
+    # Writing it with stream_midi wouldn't help, a track is only written once all its events are
+    # generated, and generating them is what takes the time
+    sizes, fits = check_budget(ast, args.max_events)
+    if args.sizes:
+        print_sizes(ast, sizes, sys.stderr)
+    if not fits:
+        print("Compilation errors:", file=sys.stderr)
+        for err in ast.err_list:
+            print(err, file=sys.stderr)
+        return 1
+
+    output = args.output_file
+    if output is None:
         output = file_name.split(".")[-2] + ".mid"
         # print(output)
         # files are in the form ./twinkle.midi , after splitting /twinkle, skip / with [1:]
-    gen_midi(ast,output)
+    # with - as the output the file is written to stdout, nothing is written there when there are errors
+    if output == "-":
+        output = sys.stdout.buffer
+    # tracks are independent, with --jobs they're generated by worker processes. Starting the
+    # workers costs more than generating a usual score, so it's one process by default
+    gen_midi(ast,output,min(len(ast.tracks), args.jobs))
 
-    # error checking
+    # error checking, the errors go to stderr so they never end up in a midi file written to stdout
     if len(ast.err_list) > 0:
-        print("Compilation errors:")
+        print("Compilation errors:", file=sys.stderr)
         for err in ast.err_list:
-            print(err)
+            print(err, file=sys.stderr)
         return 1
 
     return 0
@@ -0,0 +1,330 @@
+from new_parser import *
+from collections import Counter
+from itertools import chain
+from operator import attrgetter
+
+# the slot of Token holding the line, a LiveToken keeps the line counted from its statement there
+RELATIVE_LINE = Token.line
+
+
+class LiveToken(Token):
+    """A token of a statement kept by IncrementalParser. Its line is counted from the first line
+    of its statement (step), so a statement moved by an edit keeps its tokens as they are"""
+
+    __slots__ = ("step",)
+
+    def __init__(self, value, line, column, token_type, step):
+        self.value = value
+        RELATIVE_LINE.__set__(self, line)
+        self.column = column
+        self.type = token_type
+        self.step = step
+
+    @property
+    def line(self):
+        return self.step.first_line() + RELATIVE_LINE.__get__(self)
+
+    # other processes get a plain token, at the line it's on now
+    def __reduce__(self):
+        return Token, (self.value, self.line, self.column, self.type)
+
+
+class LiveTokens(TokenBuffer):
+    """A TokenBuffer making the tokens of step, the statement being parsed, LiveTokens"""
+
+    step = None
+
+    def __getitem__(self, index):
+        token = TokenBuffer.__getitem__(self, index)
+        return LiveToken(token.value, token.line - self.step.line, token.column, token.type, self.step)
+
+
+class Step:
+    """A top level statement and the place in the source where its parsing started.
+
+    Before the gap of IncrementalParser start and line are counted from the start of the source,
+    after it (tail is the parser) from its end, so an edit doesn't move the statements after it.
+    place is where register put the statement and reported the errors it added, see
+    IncrementalParser.register."""
+
+    __slots__ = ("start", "line", "column", "statement", "tail", "place", "reported")
+
+    def __init__(self, start, line, column, statement=None):
+        self.start = start
+        self.line = line
+        self.column = column
+        self.statement = statement
+        self.tail = None
+        self.place = None
+        self.reported = []
+
+    # the line the statement starts on, in the source as it is now
+    def first_line(self):
+        return self.line if self.tail is None else self.tail.lines - self.line
+
+    # the offset the statement starts at, in the source as it is now
+    def first_offset(self):
+        return self.start if self.tail is None else len(self.tail.source) - self.start
+
+
+class IncrementalParser:
+    """Keeps a source parsed statement by statement, so that after an edit only the
+    statements around the edit are lexed and parsed again and the others are reused.
+
+    live = IncrementalParser(source)
+    live.edit(start, end, "new text") # or live.update(new_source)
+    ast = live.program()
+
+    The statements are kept in a gap buffer: head holds the ones before the last edit, tail the
+    ones after it, last first. An edit moves the gap to where it is, only the statements between
+    the two edits change sides. The program is registered once and kept up to date, an edit that
+    leaves every statement defining the same things only replaces the nodes it parsed again.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.lines = source.count("\n")
+        self.reparsed = 0 # statements parsed by the last edit
+        self.tail = []
+        self.tail_errors = 0 # statements of tail with errors
+        self.head, _, _ = self.parse_from(source, 0, 1, 0, None)
+        self.registered = None # the Parser the statements were registered with, None when it has to be done again
+        self.names = Counter() # how many registered statements use each name
+        self.register_errors = 0 # registered statements that register reported errors for
+
+    # Builds the program out of the parsed statements. Nothing after the parser changes the nodes,
+    # so the programs built after each edit share the statements that weren't parsed again. The
+    # lines of their tokens are read through their step, they're the lines of the source as it is now
+    def program(self):
+        steps = self.head + self.tail[::-1]
+        if self.registered is None:
+            self.registered = Parser(())
+            self.names = Counter()
+            self.register_errors = 0
+            for step in steps:
+                self.register(step)
+
+        registered = self.registered
+        tracks = [Track(track.name, list(track.movements), track.source) for track in registered.tracks]
+        err_list = list(chain.from_iterable(map(attrgetter("reported"), steps)))
+        return Program(list(registered.metadata), list(registered.macros), tracks, None, dict(registered.idents), err_list)
+
+    # Registers the statement of step, remembering where it went (the index of the node in macros,
+    # metadata or tracks, or the track and index of a movement) and the errors it reported
+    def register(self, step):
+        registered = self.registered
+        statement = step.statement
+        errors = len(registered.err_list)
+        kind = statement.kind
+        new_track = kind == ParseState.MOVEMENT and not registered.tracks
+        registered.register(statement)
+        step.reported = registered.err_list[errors:]
+        self.names.update(names(statement))
+        self.register_errors += len(step.reported) != len(statement.errors)
+
+        if kind == ParseState.MACRO:
+            step.place = len(registered.macros) - 1
+        elif kind == ParseState.METADATA:
+            step.place = len(registered.metadata) - 1
+        elif kind == ParseState.TRACK:
+            step.place = len(registered.tracks) - 1
+        elif kind == ParseState.MOVEMENT:
+            step.place = (len(registered.tracks) - 1, len(registered.tracks[-1].movements) - 1, new_track)
+
+    # Puts the statements parsed again in place of the old ones in the registered program. That's
+    # only done when they define the same things, the statements after them are then registered the
+    # same. A macro or movement may be renamed if no other statement uses its old or new name. The
+    # errors of register show lines and tokens of other statements, so while there are any everything
+    # is registered again by the next program(), as it is for any other edit
+    def reregister(self, old, new):
+        registered = self.registered
+        if registered is None:
+            return
+        if self.register_errors or len(old) != len(new):
+            self.registered = None
+            return
+
+        delta = Counter()
+        for step, other in zip(old, new):
+            delta.subtract(names(step.statement))
+            delta.update(names(other.statement))
+        renamed = {}
+        for step, other in zip(old, new):
+            kind, name, ops = signature(step.statement)
+            new_kind, new_name, new_ops = signature(other.statement)
+            if kind != new_kind or ops != new_ops:
+                self.registered = None
+                return
+            if name != new_name:
+                old_name, new_name = name_of(step.statement), name_of(other.statement)
+                if self.names[old_name] != 1 or self.names[old_name] + delta[old_name] != 0 or self.names[new_name] + delta[new_name] != 1:
+                    self.registered = None
+                    return
+                renamed[old_name] = new_name
+        self.names.update(delta)
+
+        if renamed: # the names keep their place, as if they were registered again
+            registered.idents = {renamed.get(name, name): value for name, value in registered.idents.items()}
+        idents = registered.idents
+
+        for step, other in zip(old, new):
+            statement, node = other.statement, other.statement.node
+            kind = statement.kind
+            other.place = step.place
+            other.reported = statement.errors
+            if kind == ParseState.MACRO:
+                registered.macros[step.place] = node
+            elif kind == ParseState.METADATA:
+                registered.metadata[step.place] = node
+            elif kind == ParseState.TRACK:
+                track = registered.tracks[step.place]
+                registered.tracks[step.place] = Track(node.name, track.movements, node.source)
+            elif kind == ParseState.MOVEMENT:
+                t_id, m_id, new_track = step.place
+                track = registered.tracks[t_id]
+                track.movements[m_id] = node
+                if new_track:
+                    registered.tracks[t_id] = Track(track.name, track.movements, statement.ident)
+
+            for (token, _), (new_token, _) in zip(step.statement.ident_ops, statement.ident_ops):
+                if idents.get(token.value) is token:
+                    idents[token.value] = new_token
+
+    # Replaces the whole source, only the part that differs from the previous one is parsed again
+    def update(self, source):
+        old = self.source
+        start = common_prefix(old, source)
+        end = len(old) - common_suffix(old[start:], source[start:])
+        self.edit(start, end, source[start:len(source) - (len(old) - end)])
+
+    # Replaces source[start:end] with text
+    def edit(self, start, end, text):
+        old = self.source
+        source = old[:start] + text + old[end:]
+        delta_lines = text.count("\n") - old.count("\n", start, end)
+
+        # parsing restarts at the statement holding the character before the edit, in case the edit is
+        # glued to its last token. The statements before it looked ahead at its first tokens to know where
+        # they end, so parsing goes back two more statements
+        self.move_gap(start - 1)
+        head = self.head
+        first = max(len(head) - 3, 0)
+        restart = head[first] if head else Step(0, 1, 0)
+        removed = head[first:]
+        del head[first:]
+
+        # Statements after the edit can be reused when the parser gets back to where one of them starts,
+        # the rest of the old statements are then kept as they are. They have to start on a line after
+        # the edit so that only their lines moved, and errors are already formatted with their line
+        # numbers, so if lines moved none of the kept statements can have errors
+        self.source = source
+        self.lines += delta_lines
+        line_end = source.find("\n", start + len(text))
+        resync_from = len(source) + 1 if line_end == -1 else line_end + 1
+
+        steps, passed, reused = self.parse_from(source, restart.start, restart.line, restart.column, (resync_from, delta_lines != 0))
+        self.reparsed = len(steps)
+        if not reused:
+            passed += self.tail[::-1]
+            self.tail.clear()
+            self.tail_errors = 0
+        head += steps
+        self.reregister(removed + passed, steps)
+
+    # Moves the gap after the statements starting at or before offset
+    def move_gap(self, offset):
+        head, tail = self.head, self.tail
+        length, lines = len(self.source), self.lines
+        while head and head[-1].start > offset:
+            step = head.pop()
+            step.start, step.line, step.tail = length - step.start, lines - step.line, self
+            self.tail_errors += bool(step.statement.errors)
+            tail.append(step)
+        while tail and length - tail[-1].start <= offset:
+            step = tail.pop()
+            step.start, step.line, step.tail = length - step.start, lines - step.line, None
+            self.tail_errors -= bool(step.statement.errors)
+            head.append(step)
+
+    # Parses the statements of source starting at offset. With resync (where the old statements can be
+    # reused from, whether lines moved) parsing stops when a statement starts where one of tail did.
+    # Returns the new steps, the steps of tail parsed again and whether the rest of tail is reused
+    def parse_from(self, source, offset, line, column, resync):
+        tokenizer = Tokenizer(source[offset:], line, column)
+        tokens = LiveTokens(tokenizer.source, tokenizer.raw(), line, column)
+        parser = Parser(tokens)
+        if offset == 0:
+            parser.skip_whitespace() # like Parser.parse
+
+        tail = self.tail
+        steps = []
+        passed = []
+        start = offset
+        while parser.kind(0) != TokenType.EOF:
+            step = tokens.step = Step(start, line, column)
+            step.statement = parser.parse_statement()
+            steps.append(step)
+
+            if parser.kind(0) == TokenType.EOF:
+                break
+
+            pos = parser.pos
+            start = offset + tokens.starts[pos]
+            line = tokens.line(pos)
+            column = tokens.column(pos)
+
+            if resync is None:
+                continue
+            while tail and tail[-1].first_offset() < start:
+                step = tail.pop()
+                self.tail_errors -= bool(step.statement.errors)
+                passed.append(step)
+            resync_from, moved = resync
+            if start >= resync_from and tail and tail[-1].first_offset() == start and not (moved and self.tail_errors):
+                return steps, passed, True
+
+        return steps, passed, False
+
+
+# What a statement adds to the program apart from its node, the statements after it are registered
+# the same when it's replaced by one with the same signature
+def signature(statement):
+    return statement.kind, name_of(statement), [(token.value, replace) for token, replace in statement.ident_ops]
+
+
+# The identifier register gives to a macro or movement, None for other statements
+def name_of(statement):
+    kind, node = statement.kind, statement.node
+    if kind == ParseState.MACRO:
+        return statement.ident.value
+    if kind == ParseState.MOVEMENT:
+        return f"{node.instrument.value}{node.tag if node.tag == "" else node.tag.value}"
+    return None
+
+
+# The names a statement registers or looks up
+def names(statement):
+    name = name_of(statement)
+    found = [token.value for token, _ in statement.ident_ops]
+    if name is not None:
+        found.append(name)
+    return found
+
+
+# length of the common prefix of a and b, compared a block at a time
+def common_prefix(a, b, block=4096):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i:i + block] == b[i:i + block]:
+        i += block
+    if i >= n:
+        return n
+
+    end = min(i + block, n)
+    while i < end and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def common_suffix(a, b):
+    return common_prefix(a[::-1], b[::-1])
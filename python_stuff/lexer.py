@@ -1,296 +1,466 @@
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, compress, repeat
+from operator import add, itemgetter, ne
+
+# Token types are small integers so the parser can compare and look them up cheaply,
+# TOKEN_NAMES gives back the name used when printing a token
 class TokenType:
-    OPEN_BRACE = "OPEN_BRACE"
-    CLOSE_BRACE = "CLOSE_BRACE"
-    OPEN_PAREN = "OPEN_PAREN"
-    CLOSE_PAREN = "CLOSE_PAREN"
-    OPEN_BRACKET = "OPEN_BRACKET"
-    CLOSE_BRACKET = "CLOSE_BRACKET"
-    COLON = "COLON"
-    DOUBLE_QUOTE = "DOUBLE_QUOTE"
-    COMMA = "COMMA"
-    PIPE = "PIPE"
-    SLASH = "SLASH"
-    BANG = "BANG"
-    EQUAL = "EQUAL"
-    NL = "NL"
-    SINGLE_QUOTE = "SINGLE_QUOTE"
-    DOT = "DOT"
-    DASH = "DASH"
-    PLUS = "PLUS"
-    GREATER_THAN = "GREATER_THAN"
-    LESS_THAN = "LESS_THAN"
-    CARROT = "CARROT"
-    ASTERISK = "ASTERISK"
-    SEMICOLON = "SEMICOLON"
-    SPACE = "SPACE"
+    OPEN_BRACE = 0
+    CLOSE_BRACE = 1
+    OPEN_PAREN = 2
+    CLOSE_PAREN = 3
+    OPEN_BRACKET = 4
+    CLOSE_BRACKET = 5
+    COLON = 6
+    DOUBLE_QUOTE = 7
+    COMMA = 8
+    PIPE = 9
+    SLASH = 10
+    BANG = 11
+    EQUAL = 12
+    NL = 13
+    SINGLE_QUOTE = 14
+    DOT = 15
+    DASH = 16
+    PLUS = 17
+    GREATER_THAN = 18
+    LESS_THAN = 19
+    CARROT = 20
+    ASTERISK = 21
+    SEMICOLON = 22
+    SPACE = 23
 
     # Literals
-    ALPHANUM = "ALPHANUM"
-    NUM = "NUM"
-    STRING = "STRING"
+    ALPHANUM = 24
+    NUM = 25
+    STRING = 26
 
     # Keywords
-    KW_MACRO = 'KW_MACRO'
-    KW_TRACK = 'TRACK'
-    KW_TITLE = "KW_TITLE"
-    KW_CR = "KW_CR"
-    KW_R = "KW_R"
-    V = "V" # volume
+    KW_MACRO = 27
+    KW_TRACK = 28
+    KW_TITLE = 29
+    KW_CR = 30
+    KW_R = 31
+    V = 32 # volume
 
-    EOF = "EOF"
+    EOF = 33
 
     # notes
-    do = "do"
-    re = "re"
-    mi = "mi"
-    fa = "fa"
-    sol = "sol"
-    la = "la"
-    si = "si"
-
+    do = 34
+    re = 35
+    mi = 36
+    fa = 37
+    sol = 38
+    la = 39
+    si = 40
+
+
+TOKEN_NAMES = [
+    "OPEN_BRACE", "CLOSE_BRACE", "OPEN_PAREN", "CLOSE_PAREN", "OPEN_BRACKET", "CLOSE_BRACKET",
+    "COLON", "DOUBLE_QUOTE", "COMMA", "PIPE", "SLASH", "BANG", "EQUAL", "NL", "SINGLE_QUOTE",
+    "DOT", "DASH", "PLUS", "GREATER_THAN", "LESS_THAN", "CARROT", "ASTERISK", "SEMICOLON", "SPACE",
+    "ALPHANUM", "NUM", "STRING",
+    "KW_MACRO", "TRACK", "KW_TITLE", "KW_CR", "KW_R", "V",
+    "EOF",
+    "do", "re", "mi", "fa", "sol", "la", "si",
+]
 
 
 class Token:
+    __slots__ = ("value", "line", "column", "type")
+
     def __init__(self, value, line, column, token_type):
         self.value = value
         self.line = line
         self.column = column
         self.type = token_type
 
+    # tokens are shared by the copies of an AST instead of being copied with it
+    def __deepcopy__(self, memo):
+        return self
+
     def __repr__(self):
-        return f"<Token {self.type} '{self.value}' at {self.line}:{self.column}>"
+        return f"<Token {TOKEN_NAMES[self.type]} '{self.value}' at {self.line}:{self.column}>"
+
+
+class TokenBuffer:
+    """All the tokens of a source as parallel arrays instead of Token objects.
+
+    A token is its type and the [start,end) span of its text in the source, a SPACE token spans
+    its run of spaces and its value is the first one. A token keeps the index of its line, lines
+    are kept as the offsets they start at, which gives the columns.
+    Token objects are only created, and their value sliced, when the parser asks for one.
+    The raw tokens can also be read lazily, a batch at a time as the parser gets to them, and
+    then the text of a file is read along with them a block at a time, see add_text."""
+
+    # the tokens added at the end of the stream have no text in the source
+    SYNTHETIC = {TokenType.NL: "ln", TokenType.EOF: "eof"}
+
+    def __init__(self, source, raw=(), line=1, column=0):
+        # source is the whole text, or None when it's added a piece at a time with add_text.
+        # line and column are where the source starts, see Tokenizer
+        self.texts = [] if source is None else [source]
+        self.offsets = array('I') if source is None else array('I', [0]) # where each text starts in the source
+        self.types = array('B')
+        self.starts = array('I')
+        self.ends = array('I')
+        self.first_line = line
+        self.first_column = column
+        self.line_starts = array('I') # offsets of the lines after the first one
+        self.lines = array('I') # the lines of the tokens, counted from the first one
+        self.pending = iter(raw) # batches of raw tokens that weren't read yet, see Tokenizer.scan
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, index):
+        try:
+            token_type = self.types[index]
+        except IndexError:
+            if not self.fill(index):
+                index = -1 # reading past the end always gives the EOF token
+            token_type = self.types[index]
+        i = self.lines[index]
+        line_start = self.line_starts[i - 1] if i else -self.first_column
+        return Token(self.value(index), self.first_line + i, self.starts[index] - line_start, token_type)
+
+    def line(self, index):
+        return self.first_line + self.lines[index]
+
+    def column(self, index):
+        i = self.lines[index]
+        return self.starts[index] - (self.line_starts[i - 1] if i else -self.first_column)
+
+    # the parser asks for the type of most tokens several times, it's a plain array lookup
+    # until the index runs past the tokens read so far
+    def kind(self, index):
+        try:
+            return self.types[index]
+        except IndexError:
+            if self.fill(index):
+                return self.types[index]
+            return TokenType.EOF
+
+    # reads pending batches of raw tokens up to index, returns false if they ran out before
+    def fill(self, index):
+        for batch in self.pending:
+            self.extend(batch)
+            if index < len(self.types):
+                return True
+        return False
+
+    def fill_all(self):
+        for batch in self.pending:
+            self.extend(batch)
+
+    def value(self, index):
+        start, end = self.starts[index], self.ends[index]
+        if start == end:
+            return self.SYNTHETIC[self.types[index]]
+        if self.types[index] == TokenType.SPACE:
+            end = start + 1
+
+        texts = self.texts
+        if len(texts) == 1:
+            return texts[0][start:end]
+        i = bisect_right(self.offsets, start) - 1
+        offset = self.offsets[i]
+        return texts[i][start - offset:end - offset]
+
+    # the text starting at offset in the source, the raw tokens added after it may point into it
+    def add_text(self, text, offset):
+        self.texts.append(text)
+        self.offsets.append(offset)
+
+    # adds a (types, starts, ends, line starts) batch of raw tokens, see Tokenizer.scan
+    def extend(self, batch):
+        types, starts, ends, line_starts = batch
+        self.types.extend(types)
+        self.starts.extend(starts)
+        self.ends.extend(ends)
+        # the lines of the tokens are the lines starting up to them, looked up from the ones of the batch
+        first = len(self.line_starts)
+        self.line_starts.extend(line_starts)
+        self.lines.extend(map(add, map(bisect_right, repeat(line_starts), starts), repeat(first)))
+
+    def window(self, start, stop):
+        return [self[i] for i in range(max(start, 0), min(stop, len(self)))]
+
+
+KEYWORDS = {
+    "title": TokenType.KW_TITLE,
+    "copy_right": TokenType.KW_CR,
+    "r": TokenType.KW_R,
+    "track": TokenType.KW_TRACK,
+    "do":TokenType.do ,
+    "re":TokenType.re ,
+    "mi":TokenType.mi ,
+    "fa":TokenType.fa ,
+    "sol":TokenType.sol ,
+    "la":TokenType.la ,
+    "si":TokenType.si ,
+    "vol":TokenType.V,
+    "v":TokenType.V,
+    "volume":TokenType.V,
+}
+
+DELIMITERS = {
+    '{': TokenType.OPEN_BRACE,
+    '}': TokenType.CLOSE_BRACE,
+    '(': TokenType.OPEN_PAREN,
+    ')': TokenType.CLOSE_PAREN,
+    '[': TokenType.OPEN_BRACKET,
+    ']': TokenType.CLOSE_BRACKET,
+    ':': TokenType.COLON,
+    ',': TokenType.COMMA,
+    '|': TokenType.PIPE,
+    '/': TokenType.SLASH,
+    '!': TokenType.BANG,
+    '=': TokenType.EQUAL,
+    "'": TokenType.SINGLE_QUOTE,
+    '.': TokenType.DOT,
+    '-': TokenType.DASH,
+    '>': TokenType.GREATER_THAN,
+    '<': TokenType.LESS_THAN,
+    '^': TokenType.CARROT,
+    '*': TokenType.ASTERISK,
+    ';': TokenType.SEMICOLON,
+    '+': TokenType.PLUS,
+}
+
+# One pattern for the whole lexer, the name of the group that matched is the kind of token.
+# Order matters: the alternatives are tried left to right at every position.
+TOKEN_RE = re.compile(r"""
+    (?P<SPACE>[ \t]+)                               # a run of spaces is a single SPACE token
+  | (?P<IDENT>[^\W\d]\w*)                           # identifiers and keywords
+  | (?P<DELIM>[{}()\[\]:,/='.\-><*;+|!^])
+  | (?P<NL>\n)
+  | (?P<NUM>\d+(?:ms)?)
+  | (?P<STRING>"(?:[^"\\]|\\+[^\\])*(?:"|\\*\Z))   # a backslash escapes the next char, quotes included
+  | (?P<COMMENT>\#[^\r\n]*)                         # comments are not added to the token stream
+""", re.VERBOSE)
+
+# TOKEN_RE without its groups, findall then gives the text of every token
+TOKEN_TEXT_RE = re.compile(re.sub(r"\(\?P<\w+>", "(?:", TOKEN_RE.pattern), re.VERBOSE)
+NEWLINE_RE = re.compile("\n")
+
+# The type of a token of ascii text is told by its text: keywords, delimiters and new lines are
+# looked up, the other tokens by their first character, identifiers are the ones left
+COMMENT = 255 # not a token type, comments are left out
+TEXT_TYPES = {**KEYWORDS, **DELIMITERS, "\n": TokenType.NL}
+FIRST_CHAR_TYPES = {" ": TokenType.SPACE, "\t": TokenType.SPACE, '"': TokenType.STRING, "#": COMMENT}
+FIRST_CHAR_TYPES.update(dict.fromkeys("0123456789", TokenType.NUM))
+
+# the type of the tokens of each group of TOKEN_RE, by m.lastindex. Identifiers and delimiters are looked up
+GROUP_TYPES = [None, TokenType.SPACE, None, None, TokenType.NL, TokenType.NUM, TokenType.STRING, COMMENT]
+IDENT_GROUP = TOKEN_RE.groupindex["IDENT"]
+DELIM_GROUP = TOKEN_RE.groupindex["DELIM"]
 
 
 class Tokenizer:
-    def __init__(self, source):
+    BLOCK = 1 << 16 # characters read at once from a file, rounded up to a whole line
+    WINDOW = 1 << 10 # characters scanned at once, rounded up to a whole line, see scan
+    BATCH = 1024 # tokens in a batch of scan_matches
+
+    def __init__(self, source, line=1, column=0):
+        # source is either the whole text or a file object, which is read a block of lines at a time.
+        # line and column are where the source starts, when lexing only a part of a file
         self.source = source
         self.pos = 0
-        self.line = 1
-        self.column = 0
+        self.line = line
+        self.column = column
         self.tokens = []
 
     def tokenize(self):
+        self.tokens.extend(self.stream())
+        return self.tokens
 
-        while self.pos < len(self.source) -1:
-            self.tokenize_next()
+    # Generates Token objects lazily, only one block of lines of the source is held at a time
+    def stream(self):
+        line, line_start = self.line, -self.column
+        for text, batches in self.chunks(True):
+            offset = self.pos # the offsets are into the whole source
+            for types, starts, ends, line_starts in batches:
+                # i is the number of lines of the batch starting up to a token, firsts[i] is where its line starts
+                firsts = [line_start]
+                firsts += line_starts
+                for token_type, start, end, i in zip(types, starts, ends, map(bisect_right, repeat(line_starts), starts)):
+                    value = text[start - offset] if token_type == TokenType.SPACE else text[start - offset:end - offset]
+                    yield Token(value, line + i, start - firsts[i], token_type)
+                line += len(line_starts)
+                line_start = firsts[-1]
 
         # Add extra newline token for parsing reasons
-        self.tokens.append(Token("ln",self.line,self.column,TokenType.NL))
+        yield Token("ln",self.line,self.column,TokenType.NL)
         # Add EOF token
-        self.tokens.append(Token("eof", self.line, self.column, TokenType.EOF))
-        return self.tokens
+        yield Token("eof", self.line, self.column, TokenType.EOF)
 
-    # It peeks char
-    def peek(self, offset=0):
-        pos = self.pos + offset
-        if pos >= len(self.source):
-            return None
-        return self.source[pos]
-
-    #Increases position after taking the token
-    def advance(self):
-        char = self.source[self.pos]
-        self.pos += 1
-        self.column += 1
-
-        if char == '\n':
-            self.line += 1
-            self.column = 0
-
-        return char
-
-    def tokenize_next(self):
-        char = self.peek()
-
-        # Skip whitespace except newlines
-        if char in ' \t':
-            self.tokens.append(Token(char, self.line, self.column, TokenType.SPACE))
-            while char in ' \t':
-                self.advance()
-                char = self.peek()
-            return
-
-        # Handle newlines
-        if char == '\n':
-            self.tokens.append(Token(char, self.line, self.column, TokenType.NL))
-            self.advance()
-            return
-
-        # Handle comments
-        if char == '#':
-            self.tokenize_comment()
-            return
-
-        # Handle identifiers and keywords
-        if char.isalpha() or char == '_':
-            self.tokenize_identifier()
-            return
-
-        # Handle numbers
-        if char.isdigit():
-            self.tokenize_number()
-            return
-
-        # Handle strings
-        if char == '"':
-
-            self.tokenize_string()
+    # Lexes the whole source into a compact TokenBuffer, right away or as the parser reads it.
+    # A file is then read a block at a time like with stream, the buffer keeps the blocks it was given
+    def buffer(self, lazy=False):
+        if isinstance(self.source, str):
+            tokens = TokenBuffer(self.source, self.raw(), self.line, self.column)
+        else:
+            tokens = TokenBuffer(None, (), self.line, self.column)
+            tokens.pending = self.raw(tokens.add_text)
+
+        if not lazy:
+            tokens.fill_all()
+        return tokens
+
+    # Generates the batches of raw tokens of the source, see scan. With add_text the offsets are into
+    # the whole source, and every text is passed to add_text before its tokens
+    def raw(self, add_text=None):
+        for text, batches in self.chunks(add_text is not None):
+            if add_text is not None:
+                add_text(text, self.pos)
+            yield from batches
+
+        end = self.pos
+        yield [TokenType.NL, TokenType.EOF], [end, end], [end, end], []
+
+    # Yields (text, raw tokens of text) pairs, the raw tokens must be consumed before the next pair.
+    # The offsets of the tokens are into text, or into the whole source when absolute is set
+    def chunks(self, absolute=False):
+        source = self.source
+        if isinstance(source, str):
+            lines = iter((source,))
+        else:
+            # a file is read in blocks of whole lines, so no token but a string is split between two
+            lines = iter(lambda: "".join(source.readlines(self.BLOCK)), "")
+
+        text = next(lines, "")
+        for line in lines:
+            consumed = self.pos
+            yield text, self.scan(text, len(text), True, consumed if absolute else 0)
+
+            # whatever wasn't consumed (an unfinished string) is kept in front of the next line
+            text = text[self.pos - consumed:] + line
+
+        # the last character of the source is never tokenized, it's usually the final newline
+        yield text, self.scan(text, len(text) - 1, False, self.pos if absolute else 0)
+
+    # Generates the tokens starting in text[:end], where text continues from self.pos, in batches of
+    # parallel lists (types, starts, ends, line starts): the type and [start,end) span of every token,
+    # then the offsets of the lines starting in them. If more text is coming, a string running into
+    # the end of text is left for later. base is added to the offsets.
+    #
+    # The text is scanned WINDOW characters of whole lines at a time. findall gives the text of every
+    # token of the window, and their types and offsets are worked out a list at a time with map and
+    # accumulate, as looking at every match from Python costs several times the matching. \d and \w
+    # match the digits and letters of other scripts too, so the types are only told by the text of the
+    # tokens of ascii text, other texts and unrecognized characters are left for scan_matches
+    def scan(self, text, end, more, base=0):
+        if not text.isascii():
+            yield from self.scan_matches(text, 0, end, more, base)
             return
 
-        # Handle delimiters
-        if self.is_delimiter(char):
-            self.tokenize_delimiter()
+        n = len(text)
+        pos = 0
+        done = False
+        while not done and pos < end:
+            stop = text.find("\n", pos + self.WINDOW) + 1 or n
+            while True:
+                texts = TOKEN_TEXT_RE.findall(text, pos, stop)
+                starts = list(accumulate(map(len, texts), initial=pos + base))
+                if stop == n or starts[-1] != stop + base or texts[-1][0] != '"' or texts[-1][-1] != "\n":
+                    break
+                # a string running past the window, which is extended to the line the string ends on
+                stop = text.find("\n", TOKEN_RE.match(text, starts[-2] - base).end()) + 1 or n
+            if starts.pop() != stop + base:
+                break # an unrecognized character
+
+            ends = starts[1:]
+            ends.append(stop + base)
+            types = list(map(TEXT_TYPES.get, texts, map(FIRST_CHAR_TYPES.get, map(itemgetter(0), texts), repeat(TokenType.ALPHANUM))))
+            scanned = stop
+            if more and stop == n and types[-1] == TokenType.STRING:
+                # an unfinished string, it's scanned again with the text after it
+                types.pop()
+                scanned = starts.pop() - base
+                ends.pop()
+                done = True
+            elif stop > end:
+                # the tokens starting from end on are left out
+                kept = bisect_left(starts, end + base)
+                del types[kept:], starts[kept:], ends[kept:]
+                scanned = ends[-1] - base if ends else pos
+                done = True
+
+            if COMMENT in types:
+                keep = list(map(ne, types, repeat(COMMENT)))
+                types, starts, ends = list(compress(types, keep)), list(compress(starts, keep)), list(compress(ends, keep))
+            yield types, starts, ends, self.line_starts(text, pos, scanned, base)
+            pos = scanned
+        else:
+            self.advance(text, pos)
             return
 
-        # If we get here, we have an unrecognized character
-        raise SyntaxError(f"Unrecognized character '{char}' at line {self.line}, column {self.column}")
-
-    # Comments are not added to token stream
-    def tokenize_comment(self):
-        self.advance()
-
-        while True:
-            if self.peek() in '\r\n':
-                return
-            self.advance()
-
-
+        yield from self.scan_matches(text, pos, end, more, base)
 
-    def tokenize_identifier(self):
-
-        start_pos = self.pos
-        start_line = self.line
-        start_column = self.column
-
-        # Read all alphanumeric characters
-        while self.peek() is not None and (self.peek().isalnum() or self.peek() == '_'):
-            self.advance()
-
-        # Extract the identifier
-        identifier = self.source[start_pos:self.pos]
+    # scan for the rest of text from pos, looking at the regex matches one at a time
+    def scan_matches(self, text, pos, end, more, base):
+        types, starts, ends = [], [], []
+        batch_start = pos
+        for m in TOKEN_RE.finditer(text, pos):
+            if pos >= end:
+                break
 
-        # Check if it's a keyword
-        token_type = self.get_keyword_type(identifier)
-        if token_type:
-            self.tokens.append(Token(identifier, start_line, start_column, token_type))
+            start = m.start()
+            if start != pos:
+                raise self.unrecognized(text, pos)
+
+            kind = m.lastindex
+            pos = m.end()
+            if kind == IDENT_GROUP:
+                token_type = KEYWORDS.get(m.group(), TokenType.ALPHANUM)
+            elif kind == DELIM_GROUP:
+                token_type = DELIMITERS[text[start]]
+            else:
+                token_type = GROUP_TYPES[kind]
+                if token_type == COMMENT:
+                    continue
+                if token_type == TokenType.STRING and more and pos == len(text):
+                    pos = start
+                    break
+
+            types.append(token_type)
+            starts.append(start + base)
+            ends.append(pos + base)
+            if len(types) == self.BATCH:
+                yield types, starts, ends, self.line_starts(text, batch_start, pos, base)
+                types, starts, ends = [], [], []
+                batch_start = pos
         else:
-            self.tokens.append(Token(identifier, start_line, start_column, TokenType.ALPHANUM))
-
-    def tokenize_number(self):
-        start_pos = self.pos
-        start_line = self.line
-        start_column = self.column
-
-        # Read all digits
-        while self.peek() is not None and self.peek().isdigit():
-            self.advance()
-
-        # Check for 'ms' suffix
-        if self.peek() == 'm' and self.peek(1) == 's':
-            self.advance()  # Skip 'm'
-            self.advance()  # Skip 's'
-
-        # Extract the number
-        number = self.source[start_pos:self.pos]
-        self.tokens.append(Token(number, start_line, start_column, TokenType.NUM))
-
-    def tokenize_string(self):
-
-        start_pos = self.pos
-        start_line = self.line
-        start_column = self.column
-
-        self.advance()  # Skip opening quote
-
-        # i don't understand this
-        escaped = False
-        while self.peek() is not None:
-            if self.peek() == '\\':
-                escaped = True
-                self.advance()
-                continue
-
-            if self.peek() == '"' and not escaped:
-                self.advance()  # Skip closing quote
-                break
+            if pos < end:
+                raise self.unrecognized(text, pos)
+
+        yield types, starts, ends, self.line_starts(text, batch_start, pos, base)
+        self.advance(text, pos)
+
+    # the offsets of the lines starting in text[start:stop], only tokens hold new lines
+    def line_starts(self, text, start, stop, base):
+        return [m.end() + base for m in NEWLINE_RE.finditer(text, start, stop)]
+
+    # moves past text[:pos], the next text continues from there
+    def advance(self, text, pos):
+        newlines = text.count("\n", 0, pos)
+        if newlines:
+            self.line += newlines
+            self.column = pos - text.rindex("\n", 0, pos) - 1
+        else:
+            self.column += pos
+        self.pos += pos
 
-            escaped = False
-            self.advance()
-
-        # Extract the string including quotes
-        string = self.source[start_pos:self.pos]
-        self.tokens.append(Token(string, start_line, start_column, TokenType.STRING))
-
-    def tokenize_delimiter(self):
-        char = self.peek()
-        token_type = None
-
-        if char == '{':
-            token_type = TokenType.OPEN_BRACE
-        elif char == '}':
-            token_type = TokenType.CLOSE_BRACE
-        elif char == '(':
-            token_type = TokenType.OPEN_PAREN
-        elif char == ')':
-            token_type = TokenType.CLOSE_PAREN
-        elif char == '[':
-            token_type = TokenType.OPEN_BRACKET
-        elif char == ']':
-            token_type = TokenType.CLOSE_BRACKET
-        elif char == ':':
-            token_type = TokenType.COLON
-        elif char == '"':
-            token_type = TokenType.DOUBLE_QUOTE
-        elif char == ',':
-            token_type = TokenType.COMMA
-        elif char == '|':
-            token_type = TokenType.PIPE
-        elif char == '/':
-            token_type = TokenType.SLASH
-        elif char == '!':
-            token_type = TokenType.BANG
-        elif char == '=':
-            token_type = TokenType.EQUAL
-        elif char == "'":
-            token_type = TokenType.SINGLE_QUOTE
-        elif char == '.':
-            token_type = TokenType.DOT
-        elif char == '-':
-            token_type = TokenType.DASH
-        elif char == '>':
-            token_type = TokenType.GREATER_THAN
-        elif char == '<':
-            token_type = TokenType.LESS_THAN
-        elif char == '^':
-            token_type = TokenType.CARROT
-        elif char == '*':
-            token_type = TokenType.ASTERISK
-        elif char == ';':
-            token_type = TokenType.SEMICOLON
-        elif char == '+':
-            token_type = TokenType.PLUS
-
-        self.tokens.append(Token(char, self.line, self.column, token_type))
-        self.advance()
+    def unrecognized(self, text, pos):
+        line = self.line + text.count("\n", 0, pos)
+        line_start = text.rfind("\n", 0, pos) + 1 or -self.column
+        return SyntaxError(f"Unrecognized character '{text[pos]}' at line {line}, column {pos - line_start}")
 
     def is_delimiter(self, char):
-        return char in "{}()[]:\",/='.-><*;+|!^"
+        return char in DELIMITERS
 
     def get_keyword_type(self, word):
-        keywords = {
-            "title": TokenType.KW_TITLE,
-            "copy_right": TokenType.KW_CR,
-            "r": TokenType.KW_R,
-            "track": TokenType.KW_TRACK,
-            "do":TokenType.do ,
-            "re":TokenType.re ,
-            "mi":TokenType.mi ,
-            "fa":TokenType.fa ,
-            "sol":TokenType.sol ,
-            "la":TokenType.la ,
-            "si":TokenType.si ,
-            "vol":TokenType.V,
-            "v":TokenType.V,
-            "volume":TokenType.V,
-        }
-        return keywords.get(word)
\ No newline at end of file
+        return KEYWORDS.get(word)
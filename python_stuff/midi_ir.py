@@ -0,0 +1,479 @@
+from array import array
+from itertools import chain
+import re
+
+# The midi intermediate representation of grammar/midi_ir.md: the events of every track chunk in
+# a compact, array backed buffer, between the generation from the AST and the byte encoding.
+# Passes (order_events, merge_tracks) work on the buffers, back ends (smf.encode_smf, dump) write
+# them out, load reads the textual syntax back.
+
+# default timing division, in ticks per quarter note
+TICKS_PER_QUARTER = 960
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+POLY_PRESSURE = 0xA0
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+CHANNEL_PRESSURE = 0xD0
+PITCH_BEND = 0xE0
+META = 0xFF
+
+META_TEXT = 0x01
+META_COPYRIGHT = 0x02
+META_TRACK_NAME = 0x03
+META_END_OF_TRACK = 0x2F
+META_TEMPO = 0x51
+META_SMPTE = 0x54
+META_TIME_SIGNATURE = 0x58
+META_KEY_SIGNATURE = 0x59
+
+# events at the same tick are written in this order, then in the order they were added
+ORDER_TRACK_NAME = 0
+ORDER_OTHER = 1
+ORDER_NOTE_OFF = 2
+ORDER_NOTE_ON = 3
+ORDER_TEMPO = 3
+
+# the number of fields of an event in EventBuffer.events
+STRIDE = 6
+
+# the status of an event standing for a run of events of EventBuffer.runs, it's never written
+RUN = 0x100
+
+
+class EventBuffer:
+    """The events of one track chunk, in a flat array of integers.
+
+    Every event takes STRIDE slots: tick, order, index, status, data1, data2. The tick is absolute,
+    the order of its kind at the same tick and the index it was added at sort it (see
+    order_events). A meta event has status META, its type as data1 and, as data2, the index of
+    its bytes in data. A note is added as a note on and a note off with the same index.
+    ordered is set once the events are in the order they're written in.
+
+    Material played again is stored once: runs holds runs of events laid out like events, with
+    ticks and indices counted from 0, and an event with status RUN, the number of the run as
+    data1 and the number of indices it takes as data2 stands for the run played from its tick
+    and index. The runs are replayed when the events are read (order_events, dump...).
+    """
+
+    __slots__ = ("events", "data", "count", "ordered", "runs", "run_numbers", "replayed")
+
+    def __init__(self):
+        self.events = array("q")
+        self.data = []
+        self.count = 0
+        self.ordered = False
+        self.runs = []
+        self.run_numbers = {} # by the bytes of the run
+        self.replayed = 0 # the events of the runs played, less the events standing for them
+
+    # the number of events, with the runs replayed
+    def __len__(self):
+        return len(self.events) // STRIDE + self.replayed
+
+    # The events as (tick, order, index, status, data1, data2) tuples, with the runs replayed
+    def __iter__(self):
+        fields = iter(self.events)
+        events = zip(*[fields] * STRIDE)
+        return self.replay(events) if self.runs else events
+
+    def replay(self, events):
+        runs = [None] * len(self.runs)
+        for event in events:
+            if event[3] != RUN:
+                yield event
+                continue
+            tick, _, index, _, number, _ = event
+            run = runs[number]
+            if run is None:
+                fields = iter(array("q", self.runs[number]))
+                run = runs[number] = list(zip(*[fields] * STRIDE))
+            for run_tick, order, run_index, status, data1, data2 in run:
+                yield (tick + run_tick, order, index + run_index, status, data1, data2)
+
+    # Adds events laid out like events with ticks and indices counted from 0 (a buffer of int64
+    # fields), played from tick and given the next count indices. The same events added again are
+    # stored once, see runs
+    def add_run(self, tick, events, count):
+        events = bytes(events)
+        number = self.run_numbers.get(events)
+        if number is None:
+            number = self.run_numbers[events] = len(self.runs)
+            self.runs.append(events)
+        self.events.extend((tick, 0, self.count, RUN, number, count))
+        self.count += count
+        self.replayed += len(events) // (STRIDE * self.events.itemsize) - 1
+
+    def add_message(self, tick, order, status, data1, data2=0):
+        self.events.extend((tick, order, self.count, status, data1, data2))
+        self.count += 1
+
+    def add_meta(self, tick, order, meta_type, data):
+        self.events.extend((tick, order, self.count, META, meta_type, len(self.data)))
+        self.data.append(bytes(data))
+        self.count += 1
+
+    def add_note(self, channel, pitch, tick, duration, velocity):
+        self.events.extend((tick, ORDER_NOTE_ON, self.count, NOTE_ON | channel, pitch, velocity,
+                            tick + duration, ORDER_NOTE_OFF, self.count, NOTE_OFF | channel, pitch, velocity))
+        self.count += 1
+
+    def add_program_change(self, channel, tick, program):
+        self.add_message(tick, ORDER_OTHER, PROGRAM_CHANGE | channel, program)
+
+    def add_track_name(self, tick, name):
+        self.add_meta(tick, ORDER_TRACK_NAME, META_TRACK_NAME, encode_text(name))
+
+    def add_text(self, tick, text):
+        self.add_meta(tick, ORDER_OTHER, META_TEXT, encode_text(text))
+
+    # tempo in beats per minute, stored as microseconds per quarter note
+    def add_tempo(self, tick, bpm):
+        tempo = int(60000000 / bpm) & 0xFFFFFF
+        self.add_meta(tick, ORDER_TEMPO, META_TEMPO, tempo.to_bytes(3, "big"))
+
+
+class MidiIR:
+    """A midi file: its format, timing division and track chunks (EventBuffers).
+
+    bars is what the generator knows of the bars of the score, one midigen.BarIndex per movement
+    in the order of the score, None when it's not known. It isn't written to the file or dumped.
+    """
+
+    __slots__ = ("format", "ticks_per_quarter", "tracks", "bars")
+
+    def __init__(self, tracks, format=1, ticks_per_quarter=TICKS_PER_QUARTER, bars=None):
+        self.format = format
+        self.ticks_per_quarter = ticks_per_quarter
+        self.tracks = tracks
+        self.bars = bars
+
+
+def encode_text(text):
+    return text.encode("latin-1", errors="replace")
+
+
+# The number of data bytes of a channel message
+def message_length(status):
+    return 1 if status & 0xF0 in (PROGRAM_CHANGE, CHANNEL_PRESSURE) else 2
+
+
+### passes
+
+# Returns the buffer with its events in the order they're written: sorted, duplicates removed,
+# and the note offs of overlapping notes of the same pitch moved so every note on is followed
+# by its own off. This is what midiutil did with its events, so the files come out the same.
+#
+# Two events are duplicates when they have the same tick, status and data1, and for meta events
+# other than text the same bytes too: the first one added is kept. Duplicates have the same
+# order, so once sorted they're among the events of the same tick, that's all that's looked at
+def order_events(buffer):
+    if buffer.ordered:
+        return buffer
+
+    data = buffer.data
+    events = sorted(buffer)
+    kept = []
+    same_tick = set()
+    last_tick = None
+    # a note off that ends one of several notes still sounding on a pitch is moved to the start
+    # of the last of them, that's where the note played after it would have ended the sound
+    sounding = {} # (channel, pitch) -> ticks of the note ons still waiting for their off
+    moved = False
+    for event in events:
+        tick, _, _, status, data1, data2 = event
+        if tick != last_tick:
+            same_tick.clear()
+            last_tick = tick
+        key = (status, data1) if status != META or data1 == META_TEXT else (status, data1, data[data2])
+        if key in same_tick:
+            continue
+        same_tick.add(key)
+
+        kind = status & 0xF0
+        if kind == NOTE_ON or kind == NOTE_OFF:
+            starts = sounding.get((status, data1) if kind == NOTE_ON else (status | 0x10, data1))
+            if kind == NOTE_ON:
+                if starts is None:
+                    sounding[(status, data1)] = [tick]
+                else:
+                    starts.append(tick)
+            elif starts is not None and len(starts) > 1:
+                event = (starts.pop(),) + event[1:]
+                moved = True
+            elif starts:
+                starts.pop()
+        kept.append(event)
+    if moved:
+        kept.sort()
+
+    ordered = EventBuffer()
+    ordered.events = array("q", chain.from_iterable(kept))
+    ordered.data = data
+    ordered.count = buffer.count
+    ordered.ordered = True
+    return ordered
+
+
+# Merges the tracks of a format 1 file into the single track of a format 0 one. Events at the
+# same tick keep the order of their tracks
+def merge_tracks(ir):
+    events = []
+    data = []
+    for t_id, track in enumerate(ir.tracks):
+        track = order_events(track)
+        for position, (tick, order, index, status, data1, data2) in enumerate(track):
+            if status == META:
+                if data1 == META_END_OF_TRACK:
+                    continue
+                data2 += len(data)
+            events.append((tick, t_id, position, status, data1, data2))
+        data.extend(track.data)
+    events.sort()
+
+    merged = EventBuffer()
+    merged.data = data
+    for index, (tick, _, _, status, data1, data2) in enumerate(events):
+        merged.events.extend((tick, 0, index, status, data1, data2))
+    merged.count = len(events)
+    merged.ordered = True
+    return MidiIR([merged], 0, ir.ticks_per_quarter)
+
+
+### textual syntax
+
+CHANNEL_MESSAGES = {
+    NOTE_ON: "NoteOn",
+    NOTE_OFF: "NoteOff",
+    POLY_PRESSURE: "PolyPressure",
+    CONTROL_CHANGE: "ControlChange",
+    PROGRAM_CHANGE: "ProgramChange",
+    CHANNEL_PRESSURE: "ChannelPressure",
+    PITCH_BEND: "PitchBend",
+}
+
+# the meta events holding a string
+TEXT_METAS = {
+    0x01: "Text",
+    0x02: "Copyright",
+    0x03: "TrackName",
+    0x04: "Instrument",
+    0x05: "Lyric",
+    0x06: "Marker",
+    0x07: "CuePoint",
+    0x08: "ProgramName",
+    0x09: "DeviceName",
+}
+
+# the meta events holding one number of that many bytes
+NUMBER_METAS = {
+    0x00: ("SequenceNumber", 2),
+    0x20: ("ChannelPrefix", 1),
+    0x21: ("Port", 1),
+    META_TEMPO: ("Tempo", 3),
+}
+
+CHANNEL_COMMANDS = {name: kind for kind, name in CHANNEL_MESSAGES.items()}
+TEXT_COMMANDS = {name: meta_type for meta_type, name in TEXT_METAS.items()}
+NUMBER_COMMANDS = {name: (meta_type, size) for meta_type, (name, size) in NUMBER_METAS.items()}
+
+NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+NOTE_STEPS = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+
+# C4 is 60
+def pitch_name(pitch):
+    return f"{NOTE_NAMES[pitch % 12]}{pitch // 12 - 1}"
+
+
+def parse_pitch(text):
+    if text.lstrip("-").isdigit():
+        return int(text)
+    step = NOTE_STEPS[text[0].upper()]
+    rest = text[1:]
+    while rest[:1] in ("#", "b"):
+        step += 1 if rest[0] == "#" else -1
+        rest = rest[1:]
+    return step + 12 * (int(rest) + 1)
+
+
+# A string of the textual syntax stays on one line: the characters str.splitlines breaks lines
+# on are escaped, as \n, \r or \x and two hex digits, and so are '\' and '"'
+ESCAPED = re.compile(r'[\\"\n\r\x0b\x0c\x1c-\x1e\x85]')
+ESCAPES = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r"}
+UNESCAPES = {"n": "\n", "r": "\r"}
+
+
+def quote(data):
+    text = ESCAPED.sub(lambda m: ESCAPES.get(m.group(), f"\\x{ord(m.group()):02x}"), data.decode("latin-1"))
+    return f'"{text}"'
+
+
+def unescape(m):
+    escape = m.group(1)
+    if len(escape) == 3:
+        return chr(int(escape[1:], 16))
+    return UNESCAPES.get(escape, escape)
+
+
+def unquote(text):
+    return re.sub(r"\\(x[0-9a-fA-F]{2}|.)", unescape, text)
+
+
+# the words of a line: quoted strings, which may hold spaces or ';', and runs of other characters.
+# ';' starts a comment
+WORD = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|(;.*)|([^\s";]+)|(\S))')
+
+
+def split_words(line):
+    words = []
+    for m in WORD.finditer(line):
+        string, comment, word, stray = m.groups()
+        if comment is not None:
+            break
+        if stray is not None:
+            raise ValueError("No closing quotation")
+        words.append(word if string is None else unquote(string))
+    return words
+
+
+# The message of an event in the textual syntax, without its delta time
+def event_text(buffer, status, data1, data2):
+    if status != META:
+        kind, channel = status & 0xF0, status & 0x0F
+        name = CHANNEL_MESSAGES[kind]
+        if kind in (NOTE_ON, NOTE_OFF, POLY_PRESSURE):
+            return f"{name} {channel} {pitch_name(data1)} {data2}"
+        if kind == PITCH_BEND:
+            return f"{name} {channel} {data1 | data2 << 7}"
+        if message_length(status) == 1:
+            return f"{name} {channel} {data1}"
+        return f"{name} {channel} {data1} {data2}"
+
+    data = buffer.data[data2]
+    if data1 in TEXT_METAS:
+        return f"Meta {TEXT_METAS[data1]} {quote(data)}"
+    if data1 in NUMBER_METAS:
+        return f"Meta {NUMBER_METAS[data1][0]} {int.from_bytes(data, 'big')}"
+    if data1 == META_TIME_SIGNATURE:
+        return f"Meta TimeSignature {data[0]}/{2 ** data[1]}/{data[2]}/{data[3]}"
+    if data1 == META_SMPTE:
+        return f"Meta SMPTE {' '.join(str(byte) for byte in data)}"
+    if data1 == META_KEY_SIGNATURE:
+        return f"Meta KeySignature {int.from_bytes(data[:1], 'big', signed=True)} {data[1]}"
+    if data1 == META_END_OF_TRACK:
+        return "Meta EndOfTrack"
+    return f"Meta SequencerSpecific {data.hex()}" if data1 == 0x7F else f"; meta {data1:#04x} {data.hex()} left out"
+
+
+# Writes the file in the textual syntax of grammar/midi_ir.md, events with their delta times in
+# the order they're written
+def dump(ir):
+    lines = [".MIDIHeader", f"Format {ir.format}", f"Tracks {len(ir.tracks)}", f"TicksPerQuarter {ir.ticks_per_quarter}"]
+    for track in ir.tracks:
+        track = order_events(track)
+        lines.append(".TrackBegin")
+        previous = 0
+        for tick, _, _, status, data1, data2 in track:
+            if status == META and data1 == META_END_OF_TRACK:
+                continue
+            lines.append(f"+{tick - previous}: {event_text(track, status, data1, data2)}")
+            previous = tick
+        lines.append("+0: Meta EndOfTrack")
+        lines.append(".EndTrack")
+    return "\n".join(lines) + "\n"
+
+
+def parse_error(number, line, message):
+    return ValueError(f"IR error({number}): {message}: {line.strip()}")
+
+
+# Reads a file written in the textual syntax. The events keep the order they're written in,
+# ';' starts a comment. A channel, note or value that doesn't fit its bytes is an error
+def load(text):
+    header = {}
+    tracks = []
+    track = None
+    tick = 0
+    for number, line in enumerate(text.splitlines(), 1):
+        if '"' in line:
+            try:
+                words = split_words(line)
+            except ValueError as e:
+                raise parse_error(number, line, e)
+        else:
+            words = line.split(";", 1)[0].split()
+        if not words:
+            continue
+
+        if words[0] == ".MIDIHeader":
+            continue
+        if words[0] in ("Format", "Tracks", "TicksPerQuarter") and track is None:
+            header[words[0]] = int(words[1])
+            continue
+        if words[0] == ".TrackBegin":
+            track = EventBuffer()
+            tick = 0
+            continue
+        if words[0] == ".EndTrack":
+            if track is None:
+                raise parse_error(number, line, ".EndTrack without .TrackBegin")
+            track.ordered = True
+            tracks.append(track)
+            track = None
+            continue
+        if track is None or not words[0].startswith("+") or not words[0].endswith(":"):
+            raise parse_error(number, line, "expected an event like +<delta>: <command>")
+
+        tick += int(words[0][1:-1])
+        try:
+            add_event(track, tick, words[1:])
+        except (KeyError, IndexError, ValueError, OverflowError) as e:
+            raise parse_error(number, line, f"invalid event ({e})")
+
+    if track is not None:
+        raise parse_error(len(text.splitlines()), "", "missing .EndTrack")
+    if header.get("Tracks", len(tracks)) != len(tracks):
+        raise ValueError(f"IR error: the header says {header['Tracks']} tracks, found {len(tracks)}")
+    return MidiIR(tracks, header.get("Format", 1), header.get("TicksPerQuarter", TICKS_PER_QUARTER))
+
+
+def add_event(track, tick, words):
+    command = words[0]
+    if command != "Meta":
+        kind = CHANNEL_COMMANDS[command]
+        channel = int(words[1])
+        if kind in (NOTE_ON, NOTE_OFF, POLY_PRESSURE):
+            data1, data2 = parse_pitch(words[2]), int(words[3]) if len(words) > 3 else 0
+        elif kind == PITCH_BEND:
+            value = int(words[2])
+            data1, data2 = value & 0x7F, value >> 7
+        elif message_length(kind) == 1:
+            data1, data2 = int(words[2]), 0
+        else:
+            data1, data2 = int(words[2]), int(words[3])
+        if not 0 <= channel < 16:
+            raise ValueError(f"the channel is 0 to 15, got {channel}")
+        if not (0 <= data1 < 0x80 and 0 <= data2 < 0x80):
+            raise ValueError(f"the data bytes are 0 to 127, got {data1} {data2}" if kind != PITCH_BEND else f"a pitch bend is 0 to 16383, got {words[2]}")
+        track.add_message(tick, 0, kind | channel, data1, data2)
+        return
+
+    name = words[1]
+    if name in TEXT_COMMANDS:
+        track.add_meta(tick, 0, TEXT_COMMANDS[name], encode_text(words[2]))
+    elif name in NUMBER_COMMANDS:
+        meta_type, size = NUMBER_COMMANDS[name]
+        track.add_meta(tick, 0, meta_type, int(words[2]).to_bytes(size, "big"))
+    elif name == "TimeSignature":
+        n, d, c, b = (int(part) for part in words[2].split("/"))
+        track.add_meta(tick, 0, META_TIME_SIGNATURE, bytes((n, d.bit_length() - 1, c, b)))
+    elif name == "SMPTE":
+        track.add_meta(tick, 0, META_SMPTE, bytes(int(word) for word in words[2:7]))
+    elif name == "KeySignature":
+        track.add_meta(tick, 0, META_KEY_SIGNATURE, int(words[2]).to_bytes(1, "big", signed=True) + bytes((int(words[3]),)))
+    elif name == "SequencerSpecific":
+        track.add_meta(tick, 0, 0x7F, bytes.fromhex(words[2]))
+    elif name != "EndOfTrack": # the encoder ends every track
+        raise KeyError(name)
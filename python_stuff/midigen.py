@@ -1,194 +1,686 @@
 from new_parser import *
 from ai_ast import *
-from midiutil import MIDIFile
+from simplify import movement_events
+from midi_ir import EventBuffer, MidiIR, TICKS_PER_QUARTER, STRIDE, NOTE_ON, NOTE_OFF, ORDER_NOTE_ON, ORDER_NOTE_OFF
+from smf import encode_smf, iter_smf, write_smf
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from itertools import chain
+from math import lcm
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np
+except ImportError: # numpy is optional, without it movements are generated one event at a time
+    np = None
 
 class gen_state:
     def __init__(self):
         self.oct = 4
-        self.tempo = 60
         self.meas = (4,4)
-        self.counter = 0 
         self.dur = 1
-        self.channel = 0
         self.volume = 100
 
-        self.semitone_dict = {
-            'r': 0,
-            'c': 0, 'do': 0,
-            'd': 0, 're': 0,
-            'e': 0, 'mi': 0,
-            'f': 0, 'fa': 0,
-            'g': 0, 'sol':0,
-            'a': 0, 'la': 0,
-            'b': 0, 'si': 0
-        }
-
-        self.time = 0
+        # the key signature, semitones over c of every note key with its accidentals (see NOTE_KEY)
+        self.tones = list(NOTE_TONES)
 
         pass
 
 
-def gen_midi(ast,output):
-    if len(ast.tracks) == 1:
-        gen_mono_track(ast,output)
-    else:
-        ast.err_list.append("Error : Multiple tracks within the same file are currently not supported.")
-        return
-        # gen_multi_track(ast.tracks,ast.metadata)
-    pass
+# Writes the program as a midi file to output: a path, a binary stream or a writable buffer like
+# a memoryview (see smf.write_chunks), see gen_ir. Nothing is written when there are errors.
+# Returns the number of bytes written. With running_status the file is smaller, without it
+# it's the same bytes midiutil wrote
+def gen_midi(ast,output,workers=1,running_status=True,vectorised=True,ticks_per_quarter=TICKS_PER_QUARTER):
+    ir = gen_ir(ast,workers,vectorised,ticks_per_quarter)
 
+    if len(ast.err_list) > 0:
+        return 0
 
-def gen_mono_track(ast,output):
-    track = ast.tracks[0]
-    meta = ast.metadata
+    return write_smf(ir,output,running_status)
 
-    midi = MIDIFile(1,True,True,False,1) # default values for 1 track
-    midi.addTempo(0,0,120) #default values
 
-    midi.addTrackName(0,0,track.name) # add the name of the track
+# The midi file of the program as bytes, None when there are errors
+def gen_midi_bytes(ast,workers=1,running_status=True,vectorised=True,ticks_per_quarter=TICKS_PER_QUARTER):
+    ir = gen_ir(ast,workers,vectorised,ticks_per_quarter)
 
-    for m_id,movement in enumerate(track.movements):
+    if len(ast.err_list) > 0:
+        return None
 
-        if movement.instrument.value in midi_instruments.keys():
-            program = midi_instruments[movement.instrument.value]
-        else:
-            ast.err_list.append(f"""Compilation error({movement.instrument.line},{movement.instrument.column}): instrument \"{movement.instrument.value}\" is not supported
-| Tip: You can choose instruments like piano,guitar etc.
-| Tip: All the midi instruments are supported
+    return bytes(encode_smf(ir,running_status))
 
-""")
 
-        midi.addProgramChange(0,m_id,0,program)
+# The midi file of the program in chunks: the header and the tempo track, then every track as
+# soon as it's generated. The errors of a track are only known once it's generated, so the
+# chunks stop before the first track with errors (the tracks after it are still generated for
+# their errors). The file is complete only if ast.err_list is empty after the last chunk
+def stream_midi(ast,workers=1,running_status=True,vectorised=True,ticks_per_quarter=TICKS_PER_QUARTER):
+    def tracks():
+        yield tempo_track()
+        for events in gen_tracks(ast,workers,vectorised,ticks_per_quarter):
+            if len(ast.err_list) == 0:
+                yield events.track
 
-        state = gen_state()
+    return iter_smf(tracks(),len(ast.tracks) + 1,ticks_per_quarter=ticks_per_quarter,running_status=running_status)
 
-        for e_id,event in enumerate(movement.expressions):
-            if isinstance(event, Note):
-                try:
-                    next_state = movement.expressions[e_id+1]
-                except:
-                    next_state = event
 
+# Generates the midi IR of the program, a format 1 file with one track per track of the program.
+# The tempo and the title are shared, every track has its own state and channels. Times are
+# exact ticks, ticks_per_quarter of them in a quarter note. ir.bars holds the bars of every
+# movement, in the order of the score, so a player can start from any bar (see BarIndex)
+def gen_ir(ast,workers=1,vectorised=True,ticks_per_quarter=TICKS_PER_QUARTER):
+    tracks = list(gen_tracks(ast,workers,vectorised,ticks_per_quarter))
+    bars = [movement for events in tracks for movement in events.bars]
+    return MidiIR([tempo_track()] + [events.track for events in tracks],ticks_per_quarter=ticks_per_quarter,bars=bars)
 
-                add_note(state,next_state,event,m_id,midi)
 
-                pass
+def tempo_track():
+    tempo = EventBuffer()
+    tempo.add_tempo(0,120) #default values
+    return tempo
 
 
-            elif isinstance(event,SetInterval):
-                #this is already handled
-                pass
+# Generates the events of the tracks in order (TrackEvents), the errors of every track are added
+# to ast.err_list when it's yielded. Tracks don't depend on each other, so with workers > 1 they're
+# generated in parallel by that many processes
+def gen_tracks(ast,workers=1,vectorised=True,ticks_per_quarter=TICKS_PER_QUARTER):
+    channels = assign_channels(ast)
+
+    if workers > 1 and len(ast.tracks) > 1:
+        with ProcessPoolExecutor(workers, initializer=set_worker_program, initargs=(ast,vectorised,ticks_per_quarter)) as pool:
+            for events in pool.map(gen_worker_track, range(len(ast.tracks)), channels):
+                ast.err_list.extend(events.errors)
+                yield events
+    else:
+        for t_id in range(len(ast.tracks)):
+            events = gen_track(ast,t_id,channels[t_id],vectorised,ticks_per_quarter)
+            ast.err_list.extend(events.errors)
+            yield events
 
-            elif isinstance(event,SetMeasure):
-                state.meas = (int(event.x),int(event.over))
-                pass
 
-            elif isinstance(event,SetTone):
-                state.semitone_dict[event.note.value.lower()] += int(event.n)
-            elif isinstance(event,SetVolume):
-                state.volume = event.vol
-            elif isinstance(event,SetTempo):
-                state.tempo = event.n
-            elif isinstance(event,SetOctave):
-                state.oct += event.n * event.dir
-            elif isinstance(event,SetDuration):
-                duration = event.dur 
-                if isinstance(duration,Fraction):
-                    duration = duration.x / duration.over
+class TrackEvents:
+    """The midi events of one track, with the errors found generating them and the bars of its
+    movements (BarIndex).
 
-                state.dur = duration
+    The events are added to track in ticks, ticks_per_quarter of them in a quarter note. A track
+    is generated apart from the others, possibly in another process, gen_tracks puts them in
+    order after.
+    """
 
-            elif isinstance(event,Bar):
+    def __init__(self,ticks_per_quarter=TICKS_PER_QUARTER):
+        self.track = EventBuffer()
+        self.errors = []
+        self.bars = []
+        self.ticks_per_quarter = ticks_per_quarter
 
-                if state.counter != state.meas[0]:
-                    ast.err_list.append(f"Measure error({event.source.line},{event.source.column}): The measure is {state.meas[0]}/{state.meas[1]}, for this bar got {state.counter} notes instead")
 
-                # print("Current measure:",state.counter)
-                state.counter = 0
+class BarIndex:
+    """Where the bars of the movement playing on channel start: the tick and the line and column
+    of the source the bar starts at, bar n in ticks[n], lines[n] and columns[n].
 
-                pass
+    Bar 0 starts with the movement, at its instrument, and every bar line starts a new bar. The
+    bars of a macro or a repeat played again start at the same bar line. Seeking to a bar is an
+    index into the arrays, the program doesn't have to be generated again.
+    """
 
-            elif isinstance(event,Chord):
-                try:
-                    next_state = movement.expressions[e_id+1]
-                except:
-                    next_state = event
+    __slots__ = ("channel", "ticks", "lines", "columns")
 
+    def __init__(self,channel,source):
+        self.channel = channel
+        self.ticks = array("q",(0,))
+        self.lines = array("q",(source.line,))
+        self.columns = array("q",(source.column,))
 
-                for note_e in event.notes[:-1]:
-                    # treat the next state as being interval 0
-                    # this way note/note/... is completly equivalent to note 0 note 0 ...
-                    interv_0 = SetInterval(Token("0",0,0,TokenType.NUM))
-                    add_note(state,interv_0,note_e,m_id,midi)
-                    continue
+    def __len__(self):
+        return len(self.ticks)
 
-                add_note(state,next_state,event.notes[-1],m_id,midi)
-                pass
+    # adds bars starting at ticks (an array of int64 or any iterable of ints), at sources
+    def extend(self,ticks,sources):
+        if np is not None and isinstance(ticks,np.ndarray):
+            self.ticks.frombytes(ticks.astype(np.int64).tobytes())
+        else:
+            self.ticks.extend(ticks)
+        self.lines.extend([source.line for source in sources])
+        self.columns.extend([source.column for source in sources])
+
+    # the tick bar n starts at
+    def start(self,n):
+        return self.ticks[n]
+
+    # the bar playing at tick
+    def bar_at(self,tick):
+        return bisect_right(self.ticks,tick) - 1
+
+
+# the program the tracks of a worker process are generated from, set once when it starts
+worker_program = None
+
+worker_vectorised = True
+
+worker_ticks_per_quarter = TICKS_PER_QUARTER
+
+# the channel general midi plays drums on, only the movements of drum kits get it
+DRUM_CHANNEL = 9
+
+# the channels of the other movements, in the order they're given out
+MELODIC_CHANNELS = [channel for channel in range(16) if channel != DRUM_CHANNEL]
+
+# The channel of every movement, per track. Drum kits all play on DRUM_CHANNEL, the other
+# movements get a channel of their own in the order of the score. The channel plays one kit
+# at a time, so the movements asking for another kit than the first one are reported in
+# ast.err_list, and so are the movements past the last channel. They get None, they're left out
+def assign_channels(ast):
+    channels = []
+    melodic = 0
+    kit = None # the instrument of the first drums movement
+    for track in ast.tracks:
+        track_channels = []
+        for movement in track.movements:
+            instrument = movement.instrument
+            if instrument.value in drum_kits:
+                if kit is None or drum_kits[kit.value] == drum_kits[instrument.value]:
+                    kit = kit or instrument
+                    track_channels.append(DRUM_CHANNEL)
+                else:
+                    track_channels.append(None)
+                    ast.err_list.append(f"""Compilation error({instrument.line},{instrument.column}): channel 10 already plays the kit \"{kit.value}\" ({kit.line},{kit.column}), \"{instrument.value}\" was left out
+| Tip: All the drums movements play on channel 10, and it plays one kit at a time
+| Tip: Use the same kit for every drums movement
 
-            elif isinstance(event, errExpr):
-                pass
+""")
+            elif melodic < len(MELODIC_CHANNELS):
+                track_channels.append(MELODIC_CHANNELS[melodic])
+                melodic += 1
             else:
-                raise ValueError(f"	Unhandled event type in movement:{event}")
+                track_channels.append(None)
+                ast.err_list.append(f"""Compilation error({movement.instrument.line},{movement.instrument.column}): no midi channel left for \"{movement.instrument.value}\", it was left out
+| Tip: A midi file has 16 channels, every movement plays on its own one and channel 10 is kept for drums
+| Tip: At most {len(MELODIC_CHANNELS)} movements can play instruments, the drums movements all share channel 10
 
+""")
+        channels.append(track_channels)
+    return channels
+
+
+def set_worker_program(ast,vectorised,ticks_per_quarter):
+    global worker_program, worker_vectorised, worker_ticks_per_quarter
+    worker_program = ast
+    worker_vectorised = vectorised
+    worker_ticks_per_quarter = ticks_per_quarter
+
+def gen_worker_track(t_id,channels):
+    return gen_track(worker_program,t_id,channels,worker_vectorised,worker_ticks_per_quarter)
+
+
+# Generates the events of a track, its movements play on channels (see assign_channels).
+# The errors are taken out of ast.err_list, gen_tracks adds them back in track order.
+# With vectorised (and numpy installed) movements are generated with array operations,
+# see run_program_vectorised
+def gen_track(ast,t_id,channels,vectorised=True,ticks_per_quarter=TICKS_PER_QUARTER):
+    track = ast.tracks[t_id]
+    errors_start = len(ast.err_list)
+
+    midi = TrackEvents(ticks_per_quarter)
+    if t_id == 0:
+        # the title goes on the first track
+        for meta in ast.metadata:
+            midi.track.add_text(0,meta.title.strip("\""))
+    midi.track.add_track_name(0,track.name) # add the name of the track
+
+    for m_id,movement in zip(channels,track.movements):
+        if m_id is None:
+            continue
+
+        if movement.instrument.value in drum_kits:
+            program = drum_kits[movement.instrument.value]
+        elif movement.instrument.value in midi_instruments.keys():
+            program = midi_instruments[movement.instrument.value]
+        else:
+            ast.err_list.append(f"""Compilation error({movement.instrument.line},{movement.instrument.column}): instrument \"{movement.instrument.value}\" is not supported
+| Tip: You can choose instruments like piano,guitar etc.
+| Tip: All the midi instruments are supported, and drums
+
+""")
 
-    if len(ast.err_list) == 0:
-        with open(output, "wb") as output_file:
-            midi.writeFile(output_file)    
+        midi.track.add_program_change(m_id,0,program)
 
-    pass
+        gen_movement(ast,movement,m_id,midi,vectorised)
 
-def add_note(state,next_state,event,m_id,midi):
+    midi.errors = ast.err_list[errors_start:]
+    del ast.err_list[errors_start:]
+    return midi
 
-    note = event.value.value.lower()
 
-    if isinstance(next_state,ReleaseNote):
-        release_note(state,note,midi,m_id)
-        return
+# Generates the notes of a movement, playing on channel m_id. The movement is compiled to a
+# program (see compile_movement) and the program is run one instruction at a time, or with
+# array operations when vectorised, numpy is installed and the movement is long enough for them
+# to pay for setting up the arrays
+def gen_movement(ast,movement,m_id,midi,vectorised=False):
+    errors_start = len(ast.err_list)
+    program, units = compile_movement(ast,movement,midi.ticks_per_quarter)
+    bars = BarIndex(m_id,movement.instrument)
+
+    if vectorised and np is not None and len(program) >= MIN_VECTORISED_INSTRUCTIONS and units <= MAX_VECTORISED_UNITS:
+        bar_errors = run_program_vectorised(program,units,m_id,midi,bars)
+    else:
+        bar_errors = run_program(program,units,m_id,midi,bars)
+
+    midi.bars.append(bars)
+    report_bar_errors(ast,errors_start,bar_errors)
+
 
-    volume = state.volume
+# opcodes of a compiled movement, every instruction is ROW int64 fields: the opcode then its own
+# fields, padded with 0. The pitch of a note is offset + tones[tone slot] + octaves[octave slot],
+# the slots pick the key signature and octave of the movement or a 0 when the note has its own
+# (then they're in the offset). The duration is -1 when the movement's one is used. Durations,
+# intervals and bar lengths are counted in units of a tick (see compile_movement)
+OP_NOTE = 0     # (op, tone slot, octave slot, pitch offset, duration, interval, is rest)
+OP_BAR = 1      # (op, bar number in program.bars, walker errors before it)
+OP_OCTAVE = 2   # (op, octaves added)
+OP_DURATION = 3 # (op, duration)
+OP_VOLUME = 4   # (op, volume)
+OP_TONE = 5     # (op, note key, semitones added)
+OP_MEASURE = 6  # (op, x, over, length of a bar)
+ROW = 7
 
-    if event.value.value.lower() == 'r':
-        #handle rests
-        volume = 0
+# events that don't change what's generated, the intervals are read by the note before them
+SKIPPED_EVENTS = (SetInterval, SetTempo, errExpr)
 
-    note_n = note_to_midi[note]
+# the end of the events of a movement, the last note has no event after it
+END = object()
 
-    semitone = state.semitone_dict[note] if event.semitone == 0 else event.semitone
+# the octave slots of a note, octaves holds 12 times the octave of the movement then 0
+MOVEMENT_OCTAVE = 0
+OWN_OCTAVE = 1
 
-    octave = state.oct if event.octave == -1 else event.octave
 
-    pitch = note_n + semitone + 12*octave
-    # print("pitch:",pitch)
+class MovementProgram:
+    """A compiled movement: its instructions, ROW int64 fields each, one after the other in code,
+    and the Bar events its OP_BAR instructions are numbers of in bars. Times are counted in units,
+    units of them in a tick.
+    """
 
-    duration = state.dur if event.duration == -1 else event.duration
-    if isinstance(duration,Fraction):
-        duration = duration.x / duration.over
-    elif not (isinstance(duration,int) or isinstance(duration,float)):
+    __slots__ = ("code", "bars", "units")
+
+    def __init__(self):
+        self.code = array("q")
+        self.bars = []
+        self.units = 1
+
+    # the number of instructions
+    def __len__(self):
+        return len(self.code) // ROW
+
+    # adds an instruction, the opcode then its fields
+    def emit(self,*fields):
+        self.code.extend(fields)
+        self.code.extend((0,) * (ROW - len(fields)))
+
+    # counts the times in units factor times smaller, the times already compiled are scaled
+    def rescale(self,factor):
+        code = self.code
+        try:
+            for row in range(0,len(code),ROW):
+                op = code[row]
+                if op == OP_NOTE:
+                    for field in (row + 4,row + 5):
+                        if code[field] != -1:
+                            code[field] *= factor
+                elif op == OP_DURATION:
+                    code[row + 1] *= factor
+                elif op == OP_MEASURE:
+                    code[row + 3] *= factor
+        except OverflowError:
+            raise ValueError(f"durations too fine to be counted in {self.units * factor} units of a tick") from None
+        self.units *= factor
+
+
+# Compiles the events of a movement to a MovementProgram. The event after a note is looked at while
+# compiling it, so the note knows the interval after it, and the notes of a chord are compiled as
+# notes with interval 0 after them.
+# Notes and chords are compiled once for every interval they're played with, the walk yields
+# the same nodes for every repetition, and their instructions are kept as bytes copied into the
+# program. Errors reported while walking the movement are counted at every bar, so measure errors
+# can be reported in between them.
+# Times are exact: durations are given in whole notes and turned into ticks. When some duration
+# isn't a whole number of ticks (a third of a note...) all the times are counted in units,
+# fractions of a tick small enough for every duration of the movement, and the instructions
+# compiled before it are scaled. Returns the program and the number of units in a tick, 1 for
+# most movements
+def compile_movement(ast,movement,ticks_per_quarter=TICKS_PER_QUARTER):
+    err_list = ast.err_list
+    errors_start = len(err_list)
+    program = MovementProgram()
+    emit, emit_notes = program.emit, program.code.frombytes
+    compiled = {} # by node, interval and units
+    same_notes = {} # by the fields of the note, interval and units, for notes that aren't shared
+    whole = 4 * ticks_per_quarter
+
+    pending = None # the note or chord waiting for the event after it
+    for event in chain(movement_events(ast,movement),(END,)):
+        kind = type(event)
+        if pending is not None:
+            interval = int(event.time.value) * ticks_per_quarter if kind is SetInterval else -1
+            key = (id(pending),interval,program.units)
+            instructions = compiled.get(key)
+            if instructions is None:
+                instructions = compile_notes(pending,interval,same_notes,whole,program)
+                if program.units != key[2]:
+                    # a note of the chord rescaled the program, the notes before it count in other units
+                    instructions = compile_notes(pending,interval,same_notes,whole,program)
+                compiled[(id(pending),interval,program.units)] = instructions
+            emit_notes(instructions)
+            pending = None
+
+        if kind is Note or kind is Chord:
+            pending = event
+        elif kind in SKIPPED_EVENTS:
+            pass
+        elif kind is Bar:
+            emit(OP_BAR,len(program.bars),len(err_list) - errors_start)
+            program.bars.append(event)
+        elif kind is SetOctave:
+            emit(OP_OCTAVE,event.n * event.dir)
+        elif kind is SetDuration:
+            emit(OP_DURATION,duration_units(event.dur,whole,program))
+        elif kind is SetVolume:
+            emit(OP_VOLUME,event.vol)
+        elif kind is SetTone:
+            emit(OP_TONE,NOTE_KEY[event.note.type],int(event.n))
+        elif kind is SetMeasure:
+            emit(OP_MEASURE,int(event.x),int(event.over),int(event.x) * ticks_per_quarter * program.units)
+        elif event is not END:
+            raise ValueError(f"	Unhandled event type in movement:{event}")
+
+    return program, program.units
+
+
+# The instructions of a note or chord with interval (in ticks) after it, as bytes. Notes are
+# looked up in same_notes first, parsed notes are all different nodes even when they're written
+# the same
+def compile_notes(event,interval,same_notes,whole,program):
+    if type(event) is Note:
+        key = (event.value.type,event.semitone,event.octave,event.duration,interval,program.units)
+        instructions = same_notes.get(key)
+        if instructions is None:
+            instructions = same_notes[key] = array("q",compile_note(event,interval,whole,program)).tobytes()
+        return instructions
+
+    for note in event.notes:
+        if type(note) is not Note:
+            raise ValueError(f"	Unhandled event type in movement:{note}")
+    # the notes of a chord play with no interval between them, note/note is note 0 note
+    rows = array("q")
+    for note in event.notes[:-1]:
+        rows.extend(compile_note(note,0,whole,program))
+    rows.extend(compile_note(event.notes[-1],interval,whole,program))
+    return rows.tobytes()
+
+
+# The pitch of a note is worked out here as far as it doesn't depend on the movement, an
+# accidental of 0 means the key signature is used like in run_program
+def compile_note(event,interval,whole,program):
+    key = NOTE_KEY[event.value.type]
+    tone_slot, octave_slot, offset = key, MOVEMENT_OCTAVE, 0
+    if event.semitone != 0:
+        tone_slot = OWN_TONE
+        offset += NOTE_TONES[key] + event.semitone
+    if event.octave != -1:
+        octave_slot = OWN_OCTAVE
+        offset += 12 * event.octave
+
+    duration = event.duration
+    if duration != -1:
+        duration = duration_units(duration,whole,program)
+    if interval != -1:
+        interval *= program.units
+
+    return (OP_NOTE,tone_slot,octave_slot,offset,duration,interval,key == REST)
+
+
+# The units of program a duration in whole notes lasts. When it's not a whole number of them
+# the program is rescaled so it is
+def duration_units(duration,whole,program):
+    if type(duration) is int:
+        return duration * whole * program.units
+    if not isinstance(duration,(Fraction,float)):
         raise ValueError(f"duration should be numeric, {duration} is {type(duration)} instead")
 
-    duration *= 4
+    units = Fraction(duration) * whole * program.units
+    if units.denominator != 1:
+        program.rescale(units.denominator)
+        units *= units.denominator
+    return units.numerator
 
-    midi.addNote(0,m_id,pitch,state.time,duration, volume)
-    
-    delta =  duration \
-        if not isinstance(next_state,SetInterval) \
-        else int(next_state.time.value)
 
-    state.counter += delta
-    state.time += delta
+# counter is in units, quarter of them in a quarter note
+def measure_error(bar,meas,counter,quarter):
+    notes = counter // quarter if counter % quarter == 0 else counter / quarter
+    return f"Measure error({bar.source.line},{bar.source.column}): The measure is {meas[0]}/{meas[1]}, for this bar got {notes} notes instead"
 
-    pass
 
-note_to_midi = {
-    'r':0, #rest is just a silent note
-    'c': 0, 'do': 0,
-    'd': 2, 're': 2,
-    'e': 4, 'mi': 4,
-    'f': 5, 'fa': 5,
-    'g': 7, 'sol': 7,
-    'a': 9, 'la': 9,
-    'b': 11, 'si': 11
+# Adds the measure errors of a movement, (errors reported by the walk before the bar, message),
+# to ast.err_list in between the errors reported by the walk from errors_start on
+def report_bar_errors(ast,errors_start,bar_errors):
+    if not bar_errors:
+        return
+    walked = ast.err_list[errors_start:]
+    del ast.err_list[errors_start:]
+    reported = 0
+    for errors_before,message in bar_errors:
+        ast.err_list.extend(walked[reported:errors_before])
+        reported = errors_before
+        ast.err_list.append(message)
+    ast.err_list.extend(walked[reported:])
+
+
+# Adds the bars of a compiled movement to bars and returns its measure errors, see
+# report_bar_errors. bar_at and measure_at are the numbers of the OP_BAR and OP_MEASURE
+# instructions of program, in order, and bar_time the time in units of every bar line. The notes
+# counted in a bar are the time from its start to the next bar line, and the measure of a bar is
+# the last one set before it. The runners only record where the bars are, they're all checked
+# here at once, with array operations when numpy is installed
+def index_bars(program,bar_at,bar_time,measure_at,units,quarter,bars):
+    if len(bar_at) == 0:
+        return []
+
+    code = program.code
+    meas = gen_state().meas # the measure before the first one set
+    bar_lengths = [meas[0] * quarter] + [code[i * ROW + 3] for i in measure_at]
+    sources = [bar.source for bar in program.bars]
+    if np is not None and units <= MAX_VECTORISED_UNITS:
+        bar_time = np.asarray(bar_time,np.int64)
+        bars.extend(bar_time // units,sources)
+        counts = np.diff(bar_time,prepend=0)
+        measure = np.searchsorted(np.asarray(measure_at,np.int64),bar_at)
+        wrong = np.flatnonzero(counts != np.array(bar_lengths,np.int64)[measure]).tolist()
+    else:
+        bars.extend([time // units for time in bar_time],sources)
+        counts = [time - start for start,time in zip(chain((0,),bar_time),bar_time)]
+        measure = [bisect_left(measure_at,i) for i in bar_at]
+        wrong = [b for b,count in enumerate(counts) if count != bar_lengths[measure[b]]]
+
+    measures = [meas] + [(code[i * ROW + 1],code[i * ROW + 2]) for i in measure_at]
+    bar_errors = []
+    for b in wrong:
+        errors_before = code[bar_at[b] * ROW + 2]
+        bar_errors.append((errors_before,measure_error(program.bars[b],measures[measure[b]],int(counts[b]),quarter)))
+    return bar_errors
+
+
+# Runs a compiled movement one instruction at a time, with the state kept in locals. The notes
+# are laid out like in an EventBuffer and the notes of every bar are added to the track as a run
+# played from its bar line, a bar played again is stored once (see EventBuffer.add_run). Times
+# are counted in units (see compile_movement) and the ticks of a note are the whole ticks before
+# its start and end, so they don't drift. Where the bars and measures are is recorded while
+# running, the bars are added to bars and checked after, see index_bars. Returns the measure errors
+def run_program(program,units,m_id,midi,bars):
+    state = gen_state()
+    quarter = midi.ticks_per_quarter * units
+    tones = state.tones
+    octaves = [12 * state.oct,0]
+    duration, volume = state.dur * 4 * quarter, state.volume
+    time = 0
+    pending = [] # the notes of the bar, their ticks and indices counted from its first one
+    add, add_run = pending.extend, midi.track.add_run
+    index = bar_index = midi.track.count
+    bar_tick = 0
+    note_on, note_off = NOTE_ON | m_id, NOTE_OFF | m_id
+    bar_at, bar_time, measure_at = [], [], []
+
+    for at,instruction in enumerate(zip(*[iter(program.code)] * ROW)):
+        op = instruction[0]
+        if op == OP_NOTE:
+            _, tone_slot, octave_slot, pitch, note_duration, interval, rest = instruction
+            pitch += tones[tone_slot] + octaves[octave_slot]
+            if note_duration == -1:
+                note_duration = duration
+
+            velocity = 0 if rest else volume
+            add((time // units - bar_tick, ORDER_NOTE_ON, index - bar_index, note_on, pitch, velocity,
+                 (time + note_duration) // units - bar_tick, ORDER_NOTE_OFF, index - bar_index, note_off, pitch, velocity))
+            index += 1
+
+            time += note_duration if interval == -1 else interval
+
+        elif op == OP_BAR:
+            bar_at.append(at)
+            bar_time.append(time)
+            if pending:
+                add_run(bar_tick,array("q",pending).tobytes(),index - bar_index)
+                pending.clear()
+            bar_tick, bar_index = time // units, index
+        elif op == OP_OCTAVE:
+            octaves[MOVEMENT_OCTAVE] += 12 * instruction[1]
+        elif op == OP_DURATION:
+            duration = instruction[1]
+        elif op == OP_VOLUME:
+            volume = instruction[1]
+        elif op == OP_TONE:
+            tones[instruction[1]] += instruction[2]
+        elif op == OP_MEASURE:
+            measure_at.append(at)
+
+    if pending:
+        add_run(bar_tick,array("q",pending).tobytes(),index - bar_index)
+    return index_bars(program,bar_at,bar_time,measure_at,units,quarter,bars)
+
+
+### vectorised code generation
+
+# times are int64 counts of units, a movement with more units in a tick than this is run by
+# run_program so they can't overflow
+MAX_VECTORISED_UNITS = 1 << 16
+
+# movements with fewer instructions than this are run by run_program, setting up the arrays
+# takes longer than running them one instruction at a time (see bench.py codegen)
+MIN_VECTORISED_INSTRUCTIONS = 128
+
+# The value in effect at every one of n notes, from changes to changed[i] before notes before[i]
+def values_in_effect(n,before,changed,default):
+    values = np.full(n,default,np.int64)
+    if len(before):
+        last = np.searchsorted(before,np.arange(n),side="right") - 1
+        values[last >= 0] = changed[last[last >= 0]]
+    return values
+
+
+# Runs a compiled movement with array operations instead of one instruction at a time, with
+# the same result as run_program. The program is read as an array of its instructions, the
+# state in effect at every note comes from the state changes before it, start times are a
+# cumulative sum of the time every note takes and pitches, velocities and the notes counted in
+# every bar are computed for all the notes at once
+def run_program_vectorised(program,units,m_id,midi,bars):
+    code = np.frombuffer(program.code,np.int64).reshape(-1,ROW)
+    ops = code[:,0]
+    is_note = ops == OP_NOTE
+    notes_before = np.cumsum(is_note) - is_note # of every instruction
+
+    # the changes of every kind of state, the notes before them and their instructions
+    def changes(op):
+        at = np.flatnonzero(ops == op)
+        return notes_before[at], code[at]
+
+    played = code[is_note]
+    n = len(played)
+    notes = np.arange(n)
+    tone_slot, octave_slot, offset = played[:,1], played[:,2], played[:,3]
+    explicit_duration, interval = played[:,4], played[:,5]
+
+    # octaves and accidentals add up, duration and volume are replaced
+    before, changed = changes(OP_OCTAVE)
+    octave = 4 + values_in_effect(n,before,np.cumsum(changed[:,1]),0)
+    octave[octave_slot == OWN_OCTAVE] = 0
+
+    tone = np.array(NOTE_TONES,np.int64)[tone_slot]
+    before, changed = changes(OP_TONE)
+    for key in np.unique(changed[:,1]).tolist():
+        of_key = changed[:,1] == key
+        totals = np.cumsum(changed[of_key,2])
+        played_key = notes[tone_slot == key]
+        last = np.searchsorted(before[of_key],played_key,side="right") - 1
+        tone[played_key[last >= 0]] += totals[last[last >= 0]]
+
+    pitch = offset + tone + 12 * octave
+
+    before, changed = changes(OP_VOLUME)
+    velocity = values_in_effect(n,before,changed[:,1],100)
+    velocity[played[:,6] != 0] = 0
+
+    quarter = midi.ticks_per_quarter * units
+    before, changed = changes(OP_DURATION)
+    duration = values_in_effect(n,before,changed[:,1],4 * quarter)
+    duration = np.where(explicit_duration == -1,duration,explicit_duration)
+    delta = np.where(interval >= 0,interval,duration)
+
+    time = np.zeros(n,np.int64)
+    np.cumsum(delta[:-1],out=time[1:])
+
+    # the notes of every bar are a run, like in run_program: their ticks and indices are counted
+    # from the bar line and the first note after it
+    bar_at = np.flatnonzero(ops == OP_BAR)
+    starts = np.unique(np.concatenate(([0],notes_before[bar_at])))
+    starts = starts[starts < n]
+    run = np.searchsorted(starts,notes,side="right") - 1
+    start_tick = time[starts] // units
+
+    events = np.empty((n,2,STRIDE),np.int64)
+    index = notes - starts[run]
+    events[:,0,0] = time // units - start_tick[run]
+    events[:,0,1] = ORDER_NOTE_ON
+    events[:,0,3] = NOTE_ON | m_id
+    events[:,1,0] = (time + duration) // units - start_tick[run]
+    events[:,1,1] = ORDER_NOTE_OFF
+    events[:,1,3] = NOTE_OFF | m_id
+    for i in (0,1):
+        events[:,i,2] = index
+        events[:,i,4] = pitch
+        events[:,i,5] = velocity
+    for start,end,tick in zip(starts.tolist(),starts[1:].tolist() + [n],start_tick.tolist()):
+        midi.track.add_run(tick,events[start:end].tobytes(),end - start)
+
+    # the bars start where the bar lines before them are
+    elapsed = np.concatenate(([0],np.cumsum(delta)))
+    bar_time = elapsed[notes_before[bar_at]]
+    return index_bars(program,bar_at.tolist(),bar_time,np.flatnonzero(ops == OP_MEASURE).tolist(),units,quarter,bars)
+
+
+# notes are told apart by their token type, so their names are never compared
+NOTE_KEY = {
+    TokenType.KW_R: 0, #rest is just a silent note
+    TokenType.do: 1,
+    TokenType.re: 2,
+    TokenType.mi: 3,
+    TokenType.fa: 4,
+    TokenType.sol: 5,
+    TokenType.la: 6,
+    TokenType.si: 7,
 }
+REST = NOTE_KEY[TokenType.KW_R]
+
+# semitones over c of every note key, then the tone slot of notes with their own accidentals
+NOTE_TONES = (0, 0, 2, 4, 5, 7, 9, 11, 0)
+OWN_TONE = 8
 
 midi_instruments = {
     # Piano (0-7)
@@ -354,4 +846,18 @@ midi_instruments = {
     'helicopter': 125,
     'applause': 126,
     'gunshot': 127
+}
+
+# drum kits, they play on DRUM_CHANNEL where the program picks the kit (as in general midi 2)
+drum_kits = {
+    'drums': 0, # the standard kit
+    'standard_kit': 0,
+    'room_kit': 8,
+    'power_kit': 16,
+    'electronic_kit': 24,
+    'analog_kit': 25,
+    'jazz_kit': 32,
+    'brush_kit': 40,
+    'orchestra_kit': 48,
+    'sfx_kit': 56,
 }
\ No newline at end of file
@@ -1,7 +1,12 @@
 from ai_ast import *
+from collections import deque
+from types import GeneratorType
+import sys
 
-NOTES = [TokenType.do,TokenType.re,TokenType.mi,TokenType.fa,TokenType.sol,TokenType.la,TokenType.si, TokenType.KW_R]
-END_STATEMENT = [TokenType.NL, TokenType.SEMICOLON, TokenType.EOF]
+NOTES = frozenset([TokenType.do,TokenType.re,TokenType.mi,TokenType.fa,TokenType.sol,TokenType.la,TokenType.si, TokenType.KW_R])
+END_STATEMENT = frozenset([TokenType.NL, TokenType.SEMICOLON, TokenType.EOF])
+END_CHORD = frozenset([TokenType.NL, TokenType.SPACE])
+NOTE_MODIFIERS = frozenset([TokenType.PLUS, TokenType.DASH, TokenType.DOT, TokenType.SLASH, TokenType.COLON])
 
 class ParseState:
 
@@ -10,68 +15,146 @@ class ParseState:
     
     EXPR = "EXPR"
 
+    # only used as statement kinds
+    TRACK = "TRACK"
+    METADATA = "METADATA"
+
+
+class LogLevel:
+    """How much the parser traces, each level includes the ones before it"""
+    OFF = 0
+    ERROR = 1 # errors and error recovery
+    INFO = 2 # one message per statement
+    DEBUG = 3 # everything
+
+
+class Statement:
+    """A parsed top level statement, with the errors and identifiers found while parsing it"""
+
+    def __init__(self, kind, ident=None, node=None):
+        self.kind = kind # one of the ParseState values, None for empty or invalid statements
+        self.ident = ident
+        self.node = node
+        self.errors = []
+        self.ident_ops = [] # (token, replace) pairs, see Parser.declare
+
+
+class TokenStream:
+    """Lookahead buffer over any iterable of tokens, the tokens are read only when the parser
+    gets to them and the ones far behind the parser are dropped, so memory doesn't grow with the score"""
+
+    WINDOW = 64 # how far back the parser is still allowed to look
 
-class Parser:
     def __init__(self, tokens):
-        self.tokens = tokens
+        self.source = iter(tokens)
+        self.buffer = []
+        self.base = 0 # index of buffer[0] in the whole token stream
+        self.last = None # last token read, the EOF token once the stream is exhausted
+
+    def __getitem__(self, index):
+        i = index - self.base
+        buffer = self.buffer
+
+        while i >= len(buffer):
+            token = next(self.source, None)
+            if token is None:
+                return self.last # reading past the end always gives the EOF token
+
+            buffer.append(token)
+            self.last = token
+
+            if len(buffer) > 2 * self.WINDOW:
+                del buffer[:self.WINDOW]
+                self.base += self.WINDOW
+                i -= self.WINDOW
+
+        if i < 0:
+            raise IndexError(f"Token {index} was already dropped from the stream")
+        return buffer[i]
+
+    def kind(self, index):
+        return self[index].type
+
+    def window(self, start, stop):
+        # the tokens in [start,stop) that are still buffered, used when dumping the parser state
+        return self.buffer[max(start - self.base, 0) : max(stop - self.base, 0)]
+
+
+class Parser:
+    def __init__(self, tokens, log_level=LogLevel.OFF, log_size=None):
+        # tokens can be a TokenBuffer, a list or a generator like Tokenizer.stream()
+        # log_level is how much is traced to log_list, log_size keeps only that many of the last messages
+        self.tokens = tokens if isinstance(tokens, (TokenBuffer, TokenStream)) else TokenStream(tokens)
         self.pos = 0
         self.stack = []
         self.tracks = []
         self.macros = []
         self.metadata = []
         self.idents = {}
+        self.ident_ops = []
         self.err_list = []
-        self.log_list = []
+        self.log_level = log_level
+        self.log_list = deque(maxlen=log_size)
 
     def advance(self):
         self.pos += 1
-        if self.pos < len(self.tokens):
-            return self.tokens[self.pos - 1]
-        return self.tokens[-1]  # Return EOF token
+        return self.tokens[self.pos - 1] # past the end the stream returns the EOF token
 
     def peek(self, offset):
-        pos = self.pos + offset
-        if pos < len(self.tokens):
-            return self.tokens[pos]
-        return self.tokens[-1]  # Return EOF token
+        return self.tokens[self.pos + offset]
+
+    # type of the token at offset, doesn't create a Token when parsing from a TokenBuffer
+    def kind(self, offset):
+        return self.tokens.kind(self.pos + offset)
 
     def match(self, token_type):
-        curr = self.peek(0).type
-        if curr == token_type:
-            return True
-        else :
-            return False
+        return self.tokens.kind(self.pos) == token_type
 
     def expect(self, token_type):
-        if self.peek(0).type == token_type:
+        if self.kind(0) == token_type:
             return self.advance()
         else:
             return None
 
-    def log(self,msg):
-        self.log_list.append(msg)
+    # msg is only formatted if tracing is on for the level, with args and the current token as {tk}
+    def log(self, msg, *args, level=LogLevel.DEBUG):
+        if level <= self.log_level:
+            self.log_list.append(str(msg).format(*args, tk=self.peek(0)))
 
 
     def parse(self):
         # Create program node (root of AST)
         #update metadata if you want to add for example
 
-        if TokenType.KW_TRACK not in self.tokens:
-            self.log("Added global track")
-            self.tracks.append(Track("global",[],self.peek(0)))
-            pass
-
         # Skip initial newlines
         self.skip_whitespace()
-        
+
         # Continue parsing until we reach EOF
-        while self.peek(0).type != TokenType.EOF:
-            self.log(f"new iteration of statement loop at {self.peek(0)}")
+        while self.kind(0) != TokenType.EOF:
+            self.register(self.parse_statement())
+
+        self.log("finished parsing program", level=LogLevel.INFO)
+        return self.program(self.peek(0))
+
+    def program(self, source):
+        return Program(self.metadata,self.macros,self.tracks, source,self.idents,self.err_list)
+
+    # Parses one top level statement. Nothing is added to the program here, that's done by register,
+    # so a statement that didn't change can be registered again without parsing it again
+    def parse_statement(self):
+        self.log("new iteration of statement loop at {tk}", level=LogLevel.INFO)
+
+        # errors and identifiers found while parsing are kept in the statement
+        errors = self.err_list
+        self.err_list = []
+        self.ident_ops = []
+
+        statement = Statement(None)
 
-            # Handle expected error cases:
-            if self.peek(0).type in NOTES:
-                self.log(f"Error: note literal as statement")
-                self.err_list.append(f"""{SyntaxErr(self.peek(0))}Statements cannot start with a note literal.
+        # Handle expected error cases:
+        if self.kind(0) in NOTES:
+            self.log("Error: note literal as statement", level=LogLevel.ERROR)
+            self.err_list.append(f"""{SyntaxErr(self.peek(0))}Statements cannot start with a note literal.
 |
 | Tip: To write notes or expressions over multiple lines use an exression group by enclosing them in []
 |
@@ -84,144 +167,111 @@ class Parser:
 |   ]
 |
 """)
-                self.restore_stmt()
-                continue
+            self.restore_stmt()
 
 
-            # Handle metadata
-            if self.peek(0).type == TokenType.KW_TITLE:
-                self.log("found title")
-                self.advance() # consume title token
+        # Handle metadata
+        elif self.kind(0) == TokenType.KW_TITLE:
+            self.log("found title")
+            self.advance() # consume title token
+            self.skip_space()
+
+            if self.expect(TokenType.COLON) is None:
+                self.log("expected colon but found {tk}", level=LogLevel.ERROR)
+                self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected colon after keyword title, got token \"{self.peek(0).value}\" intead\n" )
+                self.restore_stmt()
+            else:
+                self.log("found colon in metadata")
                 self.skip_space()
+                name = self.expect(TokenType.STRING)
 
-                if self.expect(TokenType.COLON) is None:
-                    self.log(f"expected colon but found {self.peek(0)}")
-                    self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected colon after keyword title, got token \"{self.peek(0).value}\" intead\n" )
-                    self.restore_stmt()
+                if name is not None:
+                    self.log("found name for title {}", name)
+                    statement = Statement(ParseState.METADATA, node=Metadata(name.value,name))
                 else:
-                    self.log("found colon in metadata")
-                    self.skip_space()
-                    name = self.expect(TokenType.STRING)
+                    self.log("title error", level=LogLevel.ERROR)
+                    self.err_list.append(f"{SyntaxErr(name)}Expected string after title definiton, got token \"{name.value}\" instead\n")
+                    self.restore_stmt()
 
-                    if name is not None:
-                        self.log(f"found name for title {name}")
-                        self.metadata.append(Metadata(name.value,name))
-                    else:
-                        self.log(f"title error")
-                        self.err_list.append(f"{SyntaxErr(name)}Expected string after title definiton, got token \"{name.value}\" instead\n")
-                        self.restore_stmt()
 
+        # Handle macro definition or movement
+        elif self.kind(0) == TokenType.ALPHANUM:
+            self.log("found alphanum:{tk}")
+            ident = self.advance()
+            self.skip_space()
+            # parse macros
+            if self.kind(0) in [TokenType.EQUAL,TokenType.OPEN_PAREN]:
+                self.log("parsing macros")
 
-            # Handle macro definition or movement
-            elif self.peek(0).type == TokenType.ALPHANUM:
-                self.log(f"found alphanum:{self.peek(0)}")
-                ident = self.advance()
-                self.skip_space()
-                # parse macros
-                if self.peek(0).type in [TokenType.EQUAL,TokenType.OPEN_PAREN]:
-                    self.log("parsing macros")
-                    
-                    # if it's a macro, it needs to be added to ident list
-                    if ident.value in self.idents.keys():
-                        self.log(f"adding macro {ident} to ident list")
-
-                        if not isinstance(self.idents[ident.value],Token) :
-                            self.log(f"idents already defined error")
-                            self.err_list.append(f"{Ident_err(ident)}Identifier {ident.value} is already used here:{self.idents[ident.value]}, redefinitions are not allowed")
-                    self.log(f"register ident for macro {ident}")
-                    self.idents[ident.value] = ident
-
-                    self.log(f"push macro state")
-                    self.stack.append(ParseState.MACRO)
-                    self.log(f"call parse macro")
-                    macro = self.parse_macro(ident)
-                    self.log(f"append macro {macro}")
-                    self.macros.append(macro)
-                    
-                    self.log(f"assign index of macro to the map")
-                    self.idents[ident.value] = len(self.macros)
-
-                    self.log(f"pop macro from stack")
-                    top = self.stack.pop()
-                    if top != ParseState.MACRO:
-                        self.log(f"top of stack wasnt macro")
-                        self.dump_state()
-                        raise ValueError(f"Internal error: Expected Macro state on top of the stack, got {top} intead")
-
-                # parse movements
-                elif self.peek(0).type in [TokenType.STRING , TokenType.COLON]:
-                    self.log(f"push MOVEMENT to stack")
-                    self.stack.append(ParseState.MOVEMENT)
-                    self.log(f"call parse movemet")
-                    movement = self.parse_movement(ident)
-                    self.log("append to the last defined track")
-                    self.tracks[-1].movements.append(movement)
-                    self.skip_whitespace()
-                    self.skip_space()
+                self.log("push macro state")
+                self.stack.append(ParseState.MACRO)
+                self.log("call parse macro")
+                macro = self.parse_macro(ident)
+                statement = Statement(ParseState.MACRO, ident, macro)
 
+                self.log("pop macro from stack")
+                top = self.stack.pop()
+                if top != ParseState.MACRO:
+                    self.log("top of stack wasnt macro")
+                    self.dump_state()
+                    raise ValueError(f"Internal error: Expected Macro state on top of the stack, got {top} intead")
+
+            # parse movements
+            elif self.kind(0) in [TokenType.STRING , TokenType.COLON]:
+                self.log("push MOVEMENT to stack")
+                self.stack.append(ParseState.MOVEMENT)
+                self.log("call parse movemet")
+                movement = self.parse_movement(ident)
+                statement = Statement(ParseState.MOVEMENT, ident, movement)
+                self.skip_whitespace()
+                self.skip_space()
 
-                    self.log("add the identifier for the movement to the list")
-                    m_ident = f"{movement.instrument.value}{movement.tag if movement.tag == "" else movement.tag.value}"
-                    if (m_ident not in self.idents.keys()  # if the movement isn't defined already
-                        or self.idents[m_ident][0] != len(self.tracks) # or if defined, doesn't belong to the same track
-                    ):
-                        self.log("added new ident for movement")
-                        self.idents[m_ident] = (len(self.tracks), len(self.tracks[-1].movements))
-                    else:
-                        tag_already_exists = f'''Tag {m_ident} already exits {self.idents[m_ident]}'''
-                        instrument_already_used = f'''Instrument {movement.instrument} was already used in this track:{self.idents[m_ident]} 
-| Tip: to have the same instrument playing twice in a movement, use a tag to differentiate it:
-| x piano : do re mi
-|   piano : fa sol la
-|
-| v piano : do re mi
-|   piano "another" : fa sol la
-'''
-                        self.err_list.append(f"{instrument_already_used if movement.tag == "" else tag_already_exists }")
-                        pass
+                self.log("pop from stack movement")
+                top = self.stack.pop()
+                if top != ParseState.MOVEMENT:
+                    self.log("expected to pop movemnt, got {} instead", top, level=LogLevel.ERROR)
+                    self.dump_state()
+                    raise ValueError(f"Compiler error: Expected Movement state on top of the stack, got {top} intead")
+                pass
 
-                    self.log("pop from stack movement")
-                    top = self.stack.pop()
-                    if top != ParseState.MOVEMENT:
-                        self.log(f"expected to pop movemnt, got {top} instead")
-                        self.dump_state()
-                        raise ValueError(f"Compiler error: Expected Movement state on top of the stack, got {top} intead")
-                    pass
+            else:
+                self.log("192: token error", level=LogLevel.ERROR) # there is no standard way to create log messeges, i kinda wing them
+                self.err_list.append(f"{SyntaxErr(self.peek(0))}Unexpected token after alphanum: {self.peek(0)}")
+                self.restore_stmt()
 
-                else:
-                    self.log("192: token error") # there is no standard way to create log messeges, i kinda wing them
-                    self.err_list.append(f"{SyntaxErr(self.peek(0))}Unexpected token after alphanum: {self.peek(0)}")
-                    self.restore_stmt()
+        elif self.kind(0) == TokenType.KW_TRACK:
+            self.log("found track kw")
+            source = self.advance()
+            name = "main"
+            self.skip_space()
 
-            elif self.peek(0).type == TokenType.KW_TRACK:
-                self.log("found track kw")
-                source = self.advance()
-                name = "main"
+            if self.match(TokenType.STRING):
+                name = self.advance()
                 self.skip_space()
-                
-                if self.match(TokenType.STRING):
-                    name = self.advance()
-                    self.skip_space()
-                    self.log(f"found name for track {name}")
+                self.log("found name for track {}", name)
 
-                if self.match(TokenType.COLON):
-                    self.log("found colon after track kw")
-                    self.advance()
-                    self.skip_whitespace()
+            if self.match(TokenType.COLON):
+                self.log("found colon after track kw")
+                self.advance()
+                self.skip_whitespace()
 
-                else :
-                    self.log(f"213: token error")
-                    self.err_list.append(f"{SyntaxErr(self.peek(1))} Expected colon or string after \"track\" , got token \"{self.peek(1).value}\" instead")
-                    self.restore_to(TokenType.NL)
+                if not isinstance(name, str):
+                    name = name.value.strip('"')
+                statement = Statement(ParseState.TRACK, node=Track(name,[],source))
 
+            else :
+                self.log("213: token error", level=LogLevel.ERROR)
+                self.err_list.append(f"{SyntaxErr(self.peek(1))} Expected colon or string after \"track\" , got token \"{self.peek(1).value}\" instead")
+                self.restore_to(TokenType.NL)
 
-            elif self.peek(0).type == TokenType.NL:
-                self.log("Skip newlines between statements")
-                self.advance()
-            else:
-                self.log("Handle unexpected tokens for start of statements")
-                self.err_list.append(
-                    f"{SyntaxErr(self.peek(0))}Unexpected token \"{self.peek(0)}\" for begining of new statement \n") + '''
+
+        elif self.kind(0) == TokenType.NL:
+            self.log("Skip newlines between statements")
+            self.advance()
+        else:
+            self.log("Handle unexpected tokens for start of statements")
+            self.err_list.append(
+                f"{SyntaxErr(self.peek(0))}Unexpected token \"{self.peek(0)}\" for begining of new statement \n") + '''
 | Tip: The supported types of statements are:
 | 1. Metadata statements
 |   example: title = "my title"
@@ -239,10 +289,90 @@ class Parser:
 |            my_macro_with_arguments (arg1,arg2) = arg1 do re mi arg2
 |
 '''
-                self.restore_stmt()
+            self.restore_stmt()
 
-        self.log(f"finished parsing program")
-        return Program(self.metadata,self.macros,self.tracks, self.tokens[self.pos],self.idents,self.err_list)
+        statement.errors = self.err_list
+        statement.ident_ops = self.ident_ops
+        self.err_list = errors
+        return statement
+
+    # Adds a parsed statement to the program
+    def register(self, statement):
+        kind = statement.kind
+
+        if kind == ParseState.MACRO:
+            ident = statement.ident
+
+            # if it's a macro, it needs to be added to ident list
+            if ident.value in self.idents.keys():
+                self.log("adding macro {} to ident list", ident)
+
+                if not isinstance(self.idents[ident.value],Token) :
+                    self.log("idents already defined error", level=LogLevel.ERROR)
+                    self.err_list.append(f"{Ident_err(ident)}Identifier {ident.value} is already used here:{self.idents[ident.value]}, redefinitions are not allowed")
+            self.log("register ident for macro {}", ident)
+            self.idents[ident.value] = ident
+
+            self.err_list.extend(statement.errors)
+            self.declare(statement.ident_ops)
+
+            self.log("append macro {}", statement.node)
+            self.macros.append(statement.node)
+
+            self.log("assign index of macro to the map")
+            self.idents[ident.value] = len(self.macros)
+
+        elif kind == ParseState.MOVEMENT:
+            movement = statement.node
+            self.err_list.extend(statement.errors)
+            self.declare(statement.ident_ops)
+
+            if not self.tracks:
+                # no track statement before this movement, the file is treated as a single track
+                self.log("Added global track")
+                self.tracks.append(Track("global",[],statement.ident))
+
+            self.log("append to the last defined track")
+            self.tracks[-1].movements.append(movement)
+
+            self.log("add the identifier for the movement to the list")
+            m_ident = f"{movement.instrument.value}{movement.tag if movement.tag == "" else movement.tag.value}"
+            if (m_ident not in self.idents.keys()  # if the movement isn't defined already
+                or self.idents[m_ident][0] != len(self.tracks) # or if defined, doesn't belong to the same track
+            ):
+                self.log("added new ident for movement")
+                self.idents[m_ident] = (len(self.tracks), len(self.tracks[-1].movements))
+            else:
+                tag_already_exists = f'''Tag {m_ident} already exits {self.idents[m_ident]}'''
+                instrument_already_used = f'''Instrument {movement.instrument} was already used in this track:{self.idents[m_ident]} 
+| Tip: to have the same instrument playing twice in a movement, use a tag to differentiate it:
+| x piano : do re mi
+|   piano : fa sol la
+|
+| v piano : do re mi
+|   piano "another" : fa sol la
+'''
+                self.err_list.append(f"{instrument_already_used if movement.tag == "" else tag_already_exists }")
+                pass
+
+        elif kind == ParseState.TRACK:
+            self.err_list.extend(statement.errors)
+            track = statement.node
+            self.tracks.append(Track(track.name,[],track.source))
+
+        elif kind == ParseState.METADATA:
+            self.err_list.extend(statement.errors)
+            self.metadata.append(statement.node)
+
+        else:
+            self.err_list.extend(statement.errors)
+
+    # Adds the identifiers found while parsing a statement. Parameters replace existing
+    # identifiers, other names are only added if they aren't known yet
+    def declare(self, ident_ops):
+        for token, replace in ident_ops:
+            if replace or token.value not in self.idents:
+                self.idents[token.value] = token
 
     def parse_movement(self,instr):
         
@@ -251,19 +381,19 @@ class Parser:
 
         if self.match(TokenType.STRING):
             tag = self.advance()
-            self.log(f"found tag {tag} for movement {instr}")
+            self.log("found tag {} for movement {}", tag, instr)
             self.skip_space()
 
         if self.expect(TokenType.COLON) is None:
-            self.log(f"258: token error")
+            self.log("258: token error", level=LogLevel.ERROR)
             self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected colon after movement {instr} {self.log_tk()}")
 
-        while self.peek(0).type not in END_STATEMENT:
+        while self.kind(0) not in END_STATEMENT:
             self.log("iterating movement body")
             self.skip_space()
             self.log("calling parse expr")
             new_expr = self.parse_expr()
-            self.log(f"appending new_expr to body")
+            self.log("appending new_expr to body")
             body.append(new_expr)
             self.skip_space()
         self.log("iteration of movemnt stoped")
@@ -274,7 +404,7 @@ class Parser:
         parameters = []
         body = []
         
-        if self.peek(0).type == TokenType.OPEN_PAREN:
+        if self.kind(0) == TokenType.OPEN_PAREN:
             self.log("Parse parameters in macro")
             self.advance() # consume open paren token
             self.skip_space()
@@ -290,8 +420,8 @@ class Parser:
                 elif self.match(TokenType.ALPHANUM):
                     param = self.advance()
                     parameters.append(param) 
-                    self.idents[param.value] = param
-                    self.log(f"got some parameters that are alphanum:{param}")
+                    self.ident_ops.append((param, True))
+                    self.log("got some parameters that are alphanum:{}", param)
 
                     self.skip_space()
 
@@ -301,17 +431,17 @@ class Parser:
                         self.advance()  # Skip comma
                         self.skip_space()
 
-                        if self.peek(0).type == TokenType.ALPHANUM:
-                            self.log(f"next parameter is alphanum, continuing")
+                        if self.kind(0) == TokenType.ALPHANUM:
+                            self.log("next parameter is alphanum, continuing")
                             continue
 
-                        elif self.peek(0).type == TokenType.CLOSE_PAREN:
-                            self.log(f"309: token err")
+                        elif self.kind(0) == TokenType.CLOSE_PAREN:
+                            self.log("309: token err", level=LogLevel.ERROR)
                             self.err_list.append(f"{SyntaxErr(self.peek(0))}Trailing comma in macro definition arguments: \"{self.peek(0).value}\"")
                             self.log("restoer by skipping close paren token")
                             self.advance()
                         else:
-                            self.log("314: token err")
+                            self.log("314: token err", level=LogLevel.ERROR)
                             self.err_list.append(
                                 f"{SyntaxErr(self.peek(0))}Expected parameter type, got \"{self.peek(0)}\" instead of an identifier")
                             self.log("restore by skipping that token")
@@ -324,12 +454,12 @@ class Parser:
                         self.advance()
                         break
                     else:
-                        self.log("327: token err")
+                        self.log("327: token err", level=LogLevel.ERROR)
                         self.err_list.append(f"{SyntaxErr(self.peek(0))}Macro parameter must be fallowed by comma or closed parenthesi, got token \"{self.peek(0).value}\" instead")
                         self.restore_to(TokenType.NL,TokenType.CLOSE_PAREN)
                     pass
                 else:
-                    self.log("332: token err")
+                    self.log("332: token err", level=LogLevel.ERROR)
                     self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected identifier in arguments body, got token \"{self.peek(0).value}\" instead")
                 pass
 
@@ -338,7 +468,7 @@ class Parser:
         self.skip_space()
             
         if not self.match(TokenType.EQUAL):
-            self.log("341: token err")
+            self.log("341: token err", level=LogLevel.ERROR)
             self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected equals sign after macro name or arguments",self.log_tk())
             self.restore_stmt()
 
@@ -347,7 +477,7 @@ class Parser:
 
         self.log("Parse macro body")
 
-        while self.peek(0).type not in END_STATEMENT:
+        while self.kind(0) not in END_STATEMENT:
             self.skip_space()
             self.log("Parse expr in macro body")
             body.append(self.parse_expr())
@@ -360,423 +490,428 @@ class Parser:
         return Macro(name, parameters, body) 
 
 
+    # Parses one expression, the handler is picked from its first token, see EXPR_PARSERS.
+    # Compound expressions (groups, holds, chords and macro calls) are parsed by generators that
+    # yield when they need a sub expression and are sent it back, so nesting doesn't recurse
     def parse_expr(self):
-        self.log("push expr to stack")
-        self.stack.append(ParseState.EXPR)
-        expression = None
+        expression = self.start_expr()
+        if type(expression) is not GeneratorType and expression is not None:
+            return expression
+
+        waiting = [] # compound expressions waiting for a sub expression, innermost last
+        while True:
+            if type(expression) is GeneratorType:
+                waiting.append(expression)
+                sub = None # starts the generator
+            else:
+                if expression is None:
+                    self.dump_state()
+                    raise ValueError(f"Expression must not be none",self.log_tk())
 
-        if False:
-            todo("remove this branch later")
+                if not waiting:
+                    return expression
+                sub = expression
 
+            try:
+                waiting[-1].send(sub)
+                expression = self.start_expr() # it yielded, so it needs a sub expression
+            except StopIteration as stop:
+                waiting.pop()
+                expression = stop.value
 
-# simple expressions
+    # Parses a simple expression, or returns the generator parsing a compound one
+    def start_expr(self):
+        kind = self.kind(0)
 
-        
-        elif self.match(TokenType.V):
-            self.log("Parse SetVolume")
-            source = self.advance()
+        # fast path for the most common expression, a note without modifiers
+        if kind in NOTES and self.kind(1) not in NOTE_MODIFIERS:
+            return Note(self.advance(),0,-1,-1)
 
-            self.skip_space()
+        return self.EXPR_PARSERS.get(kind, Parser.parse_unexpected)(self)
 
-            if self.expect(TokenType.EQUAL) is None:
-                err_source = self.peek(0)
-                self.log("380: token err")
-                self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected colon after keyword {source.value}{self.log_tk()}")
-                self.restore_to(TokenType.SPACE)
-                expression = errExpr(err_source) 
+# simple expressions
 
-                self.log("pop expr from stack")
-                top = self.stack.pop()
-                if top != ParseState.EXPR:
-                    self.log(f"not expr on top, {top}")
-                    self.dump_state()
-                    raise ValueError(f"Expected expr on top of the stack, got {top} instead")
+    def parse_volume(self):
+        self.log("Parse SetVolume")
+        source = self.advance()
 
-                return expression
-            
-            if self.match(TokenType.NUM):
-                expression = SetVolume(int(self.advance().value),source)
-            else:
-                err_source = self.peek(0)
-                self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected note literal after plus{self.log_tk()}")
-                self.restore_to(TokenType.SPACE)
-                expression = errExpr(err_source)
-        # Parse SetTone
-        elif self.match(TokenType.PLUS):
-            source = self.advance()
-            if self.peek(0).type in NOTES:
-                note = self.advance()
-                expression = SetTone(1,note,source)
-            else:
-                self.err_list.append(f"""{SyntaxErr(self.peek(0))}Expected note literal after plus \"{self.source.value}\" {self.log_tk}
-| Tip: '+' increase the pitch of a note by a semitone for the entire movement""")                
-                expression = errExpr(self.peek(0))
-        
-        elif self.match(TokenType.DASH):
-            source = self.advance()
-            if self.peek(0).type in NOTES:
-                note = self.advance()
-                expression = SetTone(-1,note,source)
-            else:
-                self.err_list.append(f"""{SyntaxErr(self.peek(0))}Expected note literal after dash \"{self.source.value}\" {self.log_tk}
+        self.skip_space()
+
+        if self.expect(TokenType.EQUAL) is None:
+            err_source = self.peek(0)
+            self.log("380: token err", level=LogLevel.ERROR)
+            self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected colon after keyword {source.value}{self.log_tk()}")
+            self.restore_to(TokenType.SPACE)
+            return errExpr(err_source)
+
+        if self.match(TokenType.NUM):
+            return SetVolume(int(self.advance().value),source)
+
+        err_source = self.peek(0)
+        self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected note literal after plus{self.log_tk()}")
+        self.restore_to(TokenType.SPACE)
+        return errExpr(err_source)
+
+    # Parse SetTone
+    def parse_sharp(self):
+        source = self.advance()
+        if self.kind(0) in NOTES:
+            note = self.advance()
+            return SetTone(1,note,source)
+
+        self.err_list.append(f"""{SyntaxErr(self.peek(0))}Expected note literal after plus \"{self.source.value}\" {self.log_tk}
+| Tip: '+' increase the pitch of a note by a semitone for the entire movement""")
+        return errExpr(self.peek(0))
+
+    def parse_flat(self):
+        source = self.advance()
+        if self.kind(0) in NOTES:
+            note = self.advance()
+            return SetTone(-1,note,source)
+
+        self.err_list.append(f"""{SyntaxErr(self.peek(0))}Expected note literal after dash \"{self.source.value}\" {self.log_tk}
 | Tip: '-' lowers the pitch of a note by a semitone for the entire movement""")
-                expression =  errExpr(self.peek(0))
+        return errExpr(self.peek(0))
 
-        # Parse SetOctave
-        elif self.match(TokenType.GREATER_THAN):
-            source = self.advance()
-            oct = 0
-            if self.match(TokenType.NUM):
-                oct = int(self.advance().value)
+    # Parse SetOctave
+    def parse_octave_up(self):
+        source = self.advance()
+        oct = 0
+        if self.match(TokenType.NUM):
+            oct = int(self.advance().value)
 
-            expression =SetOctave(1,oct,source)
+        return SetOctave(1,oct,source)
 
-        # Parse SetOctave        
-        elif self.match(TokenType.LESS_THAN):
-            source = self.advance()
-            oct = 0
-            if self.match(TokenType.NUM):
-                oct = int(self.advance().value)
+    def parse_octave_down(self):
+        source = self.advance()
+        oct = 0
+        if self.match(TokenType.NUM):
+            oct = int(self.advance().value)
 
-            expression = SetOctave(-1,oct,source)
+        return SetOctave(-1,oct,source)
 
-        # Parse SetDuration
-        elif self.match(TokenType.COLON):
-            source = self.advance()
-            
-            if self.match(TokenType.NUM):
-                x = self.advance()
-                over = None
-                if self.expect(TokenType.SLASH):
-                    over = self.expect(TokenType.NUM)
-                
-                duration = int(x.value) if over is None else Fraction(int(x.value),int(over.value))
+    # Parse SetDuration
+    def parse_duration(self):
+        source = self.advance()
 
-                expression = SetDuration(duration,source)
-            else:
-                self.err_list.append(f"""{SyntaxErr(self.peek(0))}After colon expression expected number{self.log_tk()}
-| Tip: ':' fallowed directly by a number is used to set the duration of a single note for the given track""")
-                expression = errExpr(self.peek(0))
+        if self.match(TokenType.NUM):
+            x = self.advance()
+            over = None
+            if self.expect(TokenType.SLASH):
+                over = self.expect(TokenType.NUM)
 
-        # Parse SetMeasure
-        elif self.match(TokenType.BANG):
-            source = self.advance()
+            duration = int(x.value) if over is None else Fraction(int(x.value),int(over.value))
 
-            if self.match(TokenType.NUM):
-                x = int(self.advance().value)
+            return SetDuration(duration,source)
 
-                if self.expect(TokenType.SLASH) is None:
-                    err_source = self.peek(-1)
-                    self.err_list.append(f"{SyntaxErr(self.peek(-1))}Measures are defined as number/number, after number got {self.peek(-1)} instead of \"/\"  ")
-                    self.restore_to(TokenType.SPACE)
-                    expression = errExpr(err_source)
+        self.err_list.append(f"""{SyntaxErr(self.peek(0))}After colon expression expected number{self.log_tk()}
+| Tip: ':' fallowed directly by a number is used to set the duration of a single note for the given track""")
+        return errExpr(self.peek(0))
 
-                if self.match(TokenType.NUM):
-                    over = int(self.advance().value)
-                else:
-                    self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected number after defining measure{self.log_tk()}")
-                    self.restore_to(TokenType.SPACE)
+    # Parse SetMeasure
+    def parse_measure(self):
+        source = self.advance()
+
+        if self.match(TokenType.NUM):
+            x = int(self.advance().value)
+
+            if self.expect(TokenType.SLASH) is None:
+                self.err_list.append(f"{SyntaxErr(self.peek(-1))}Measures are defined as number/number, after number got {self.peek(-1)} instead of \"/\"  ")
+                self.restore_to(TokenType.SPACE)
 
-                expression = SetMeasure(x,over,source)
+            if self.match(TokenType.NUM):
+                over = int(self.advance().value)
             else:
-                self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected a number after \"!\"{self.log_tk()} ")
+                self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected number after defining measure{self.log_tk()}")
                 self.restore_to(TokenType.SPACE)
 
+            return SetMeasure(x,over,source)
 
-        # Parse SetTempo
-        elif self.match(TokenType.CARROT):
-            source = self.advance()
+        self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected a number after \"!\"{self.log_tk()} ")
+        self.restore_to(TokenType.SPACE)
 
-            if self.match(TokenType.NUM):
-                x = int(self.advance().value)
+    # Parse SetTempo
+    def parse_tempo(self):
+        source = self.advance()
 
-                tempo = x
-                expression =SetTempo(tempo,source)
-            else:
-                self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected number after '^'",self.log_tk())
-                self.restore_to(TokenType.SPACE)
+        if self.match(TokenType.NUM):
+            tempo = int(self.advance().value)
+            return SetTempo(tempo,source)
 
-        # Parse Bar
-        elif self.match(TokenType.PIPE):
-            expression =Bar(self.advance())
+        self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected number after '^'",self.log_tk())
+        self.restore_to(TokenType.SPACE)
 
-        # Parse SetInterval
-        elif self.match(TokenType.NUM):
-            # it's a duration
-            expression =SetInterval(self.advance())
+    def parse_bar(self):
+        return Bar(self.advance())
 
+    # Parse SetInterval, a number on its own is a duration
+    def parse_interval(self):
+        return SetInterval(self.advance())
 
 # compound expressions
 
-        # Parse Repetition
-        elif self.match(TokenType.ASTERISK):
-            source = self.advance()
+    # Parse Repetition
+    def parse_repetition(self):
+        source = self.advance()
 
-            n = 0
-            if self.match(TokenType.NUM):
-                n = int(self.advance().value)
+        if self.match(TokenType.NUM):
+            n = int(self.advance().value)
+            return Repetition(n,source)
 
-                if self.stack[-1] == ParseState.EXPR:
-                    expression = Repetition(n,source)
-                else:
-                    self.err_list.append(f"{SyntaxErr(self.peek(0))}Repetition postfix operator can only be used after an expression{self.log_tk()}")
-            else:
-                self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected number after repetition '*' {self.log_tk()}")
-                expression = errExpr(self.log(0))
-                self.restore_to(TokenType.SPACE)
+        self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected number after repetition '*' {self.log_tk()}")
+        expression = errExpr(self.log(0))
+        self.restore_to(TokenType.SPACE)
+        return expression
 
+    # Parse ReleaseNote
+    def parse_release(self):
+        return ReleaseNote(self.advance())
 
+    # Parse HoldNote
+    def parse_hold(self):
+        source = self.advance()
+        note = yield
+        if isinstance(note,Note) or isinstance(note,Chord) or isinstance(note,Ident):
+            return HoldNote(note,source)
 
-        # Parse ReleaseNote
-        elif self.match(TokenType.CLOSE_PAREN):
-            source = self.advance()
-            if self.stack[-1] == ParseState.EXPR:
-                expression = ReleaseNote(source)
-            else:
-                self.err_list.append(f"{SyntaxErr(self.peek(0))}Close paren postfix operator can only be used after an expression{self.log_tk()}")
+        self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected note or identifier after open parenthesis{self.log_tk()}")
+        self.restore_to(TokenType.SPACE)
+
+    # Parse ExprGroup
+    def parse_group(self):
+        source = self.advance()
+        self.skip_whitespace()
+        exprs = []
+        # gotta parse a expr group
+        while not self.match(TokenType.CLOSE_BRACKET):
+            exprs.append((yield))
+            self.skip_whitespace() #whitespace doesn't matter within a expr group
+
+        self.advance() # skip close bracket
+
+        # space doesn't matter after parsing an expr
+        self.skip_space()
+
+        return ExprGroup(exprs,source)
+
+    # Parse ident, chord or macro application
+    def parse_ident(self):
+        ident = self.advance()
 
-        # Parse HoldNote
+        self.ident_ops.append((ident, False))
+
+        if self.match(TokenType.SLASH):
+            return self.parse_ident_chord(ident)
+
+        # parse Macro appl
         elif self.match(TokenType.OPEN_PAREN):
-            #parse hold
-            source = self.advance()
-            note = self.parse_expr()
-            if isinstance(note,Note) or isinstance(note,Chord) or isinstance(note,Ident):
-                expression =HoldNote(note,source)
-            else:
-                self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected note or identifier after open parenthesis{self.log_tk()}")
-                self.restore_to(TokenType.SPACE)
+            return self.parse_macro_call(ident)
 
-        # Parse ExprGroup
-        elif self.match(TokenType.OPEN_BRACKET):
+        elif self.kind(0) not in (TokenType.SPACE, TokenType.NL, TokenType.CLOSE_PAREN):
+            self.err_list.append(f"{SyntaxErr(self.peek(0))}Unexpected token after identifier{self.peek(0).value}")
+            self.restore_to(TokenType.SPACE)
 
-            source = self.advance()
-            self.skip_whitespace()
-            exprs = []
-            # gotta parse a expr group
-            while not self.match(TokenType.CLOSE_BRACKET):
-                exprs.append(self.parse_expr())
-                self.skip_whitespace() #whitespace doesn't matter within a expr group
-            
-            self.advance() # skip close bracket
+        # if it doesn't match anything else, it's just an identifier
+        return Ident(ident)
 
-            # space doesn't matter after parsing an expr
-            self.skip_space()
-            
-            expression =ExprGroup(exprs,source)
+    def parse_ident_chord(self, ident):
+        self.advance()
+        curr_ident = Ident(ident)
+        notes = [curr_note]
+        while self.kind(0) not in END_CHORD:
+            ident = yield
+            if isinstance(ident,Note):
+                notes.append(ident)
+                return Chord(notes,ident)
 
+            if isinstance(ident,Chord):
+                notes.extend(ident.notes)
+                return Chord(notes,ident)
 
-        # Parse ident or chord
-        elif self.match(TokenType.ALPHANUM):
-            ident = self.advance()
+            if isinstance(ident,Ident):
+                notes.append(ident)
+                return Chord(notes,ident)
 
-            if ident.value not in self.idents.keys():
-                self.idents[ident.value] = ident
 
-            if self.match(TokenType.SLASH):
-                # parsing chord
-                self.advance()
-                curr_ident = Ident(ident)
-                notes = [curr_note]
-                while self.peek(0).type not in [TokenType.NL, TokenType.SPACE]:
-                    ident = self.parse_expr()
-                    if isinstance(ident,Note):
-                        notes.append(ident)
-                        self.stack.pop()
-                        return Chord(notes,ident)
-                    
-                    if isinstance(ident,Chord):
-                        notes.extend(ident.notes)
-                        self.stack.pop()
-                        return Chord(notes,ident)
+            self.err_list.append(f"{SyntaxErr(self.peek(0))}Chords can only be formed from notes,using \"{ident.value}\" is not valid")
+            self.restore_to(TokenType.SPACE)
 
-                    if isinstance(ident,Ident):
-                        notes.append(ident)
-                        self.stack.pop()
-                        return Chord(notes,ident)
+        return Ident(ident)
 
+    def parse_macro_call(self, ident):
+        self.advance()
+        self.skip_space()
+        args = []
+        while True:
+            args.append((yield))
 
-                    self.err_list.append(f"{SyntaxErr(self.peek(0))}Chords can only be formed from notes,using \"{ident.value}\" is not valid")
-                    self.restore_to(TokenType.SPACE)
-            
-            # parse Macro appl
-            elif self.match(TokenType.OPEN_PAREN):
+            self.skip_whitespace()
+
+            if self.expect(TokenType.CLOSE_PAREN):
+                break
+
+            if self.expect(TokenType.COMMA):
+                continue
+            else:
+                self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected comma or close parenthesis after expression in argument list",self.log_tk())
+                self.restore_to(TokenType.CLOSE_PAREN)
+
+        return MacroCall(ident,args)
+
+    # Parse Note or chord
+    def parse_note(self):
+        note_p = self.advance()
+
+        semitone = 0 # placeholder for default value
+        octave = -1 # placeholder for default value
+        duration = -1 # placeholder for default value
+        # parse semitones
+        while True:
+            if self.match(TokenType.PLUS):
+                semitone +=1
                 self.advance()
-                self.skip_space()
-                args = []
-                while True:
-                    args.append(self.parse_expr())
-                    
-                    self.skip_whitespace()
+            elif self.match(TokenType.DASH):
+                semitone -=1
+                self.advance()
+            else:
+                break
 
-                    if self.expect(TokenType.CLOSE_PAREN):
-                        break
-                    
-                    if self.expect(TokenType.COMMA):
-                        continue
-                    else:
-                        self.err_list.append(f"{SyntaxErr(self.peek(0))}Expected comma or close parenthesis after expression in argument list",self.log_tk())
-                        self.restore_to(TokenType.CLOSE_PAREN)
 
-                self.stack.pop() # preserve parse stack state
-                return MacroCall(ident,args)
-            elif self.match(TokenType.SPACE):
-                pass
-            elif self.match(TokenType.NL):
-                pass
-            elif self.match(TokenType.CLOSE_PAREN):
-                pass
-            else :
-                self.err_list.append(f"{SyntaxErr(self.peek(0))}Unexpected token after identifier{self.peek(0).value}")
-                expresion = errExpr(self.peek(0))
-                self.restore_to(TokenType.SPACE)
+        if self.match(TokenType.DOT):
+            self.advance()
+            if self.match(TokenType.NUM):
+                octave = int(self.advance().value)
 
-            # if it doesn't match anything else, it's just an identifier
-            expression =Ident(ident)
+        if self.match(TokenType.SLASH):
+            return self.parse_chord(note_p,semitone,octave,duration)
 
-        
-        # Parse Note or chord
-        elif self.peek(0).type in NOTES:
-            # parse notes
-            note_p = self.advance()
-
-            semitone = 0 # placeholder for default value
-            octave = -1 # placeholder for default value
-            duration = -1 # placeholder for default value
-            # parse semitones 
-            while True:
-                if self.match(TokenType.PLUS):
-                    semitone +=1
-                    self.advance()
-                elif self.match(TokenType.DASH):
-                    semitone -=1
-                    self.advance()
-                else:
-                    break
+        return self.parse_note_duration(note_p,semitone,octave,duration)
 
+    def parse_chord(self,note_p,semitone,octave,duration):
+        self.advance() #consume slash
+        curr_note = Note(note_p,semitone,octave,duration)
+        notes = [curr_note]
+        while self.kind(0) not in END_CHORD:
+            note = yield
+            if isinstance(note,Note):
+                notes.append(note)
+                return Chord(notes,note_p)
 
-            if self.match(TokenType.DOT):
-                self.advance()
-                if self.match(TokenType.NUM):
-                    octave = int(self.advance().value)
-
-            if self.match(TokenType.SLASH):
-                # parsing chord
-                self.advance() #consume slash
-                curr_note = Note(note_p,semitone,octave,duration)
-                notes = [curr_note]
-                while self.peek(0).type not in [TokenType.NL, TokenType.SPACE]:
-                    note = self.parse_expr()
-                    if isinstance(note,Note):
-                        notes.append(note)
-                        self.stack.pop()
-                        return Chord(notes,note_p)
-                    
-                    elif isinstance(note,Chord):
-                        notes.extend(note.notes)
-                        self.stack.pop()
-                        return Chord(notes,note_p)
+            elif isinstance(note,Chord):
+                notes.extend(note.notes)
+                return Chord(notes,note_p)
 
-                    elif isinstance(note,Ident):
-                        notes.append(note)
-                        self.stack.pop()
-                        return Chord(notes,note_p)
+            elif isinstance(note,Ident):
+                notes.append(note)
+                return Chord(notes,note_p)
 
-                    else:
-                        self.err_list.append(f"{SyntaxErr(self.peek(0))}Chords can only be formed from notes,using {note} is not valid, notes= {notes}, curr{self.peek(0)}")
-                        
+            else:
+                self.err_list.append(f"{SyntaxErr(self.peek(0))}Chords can only be formed from notes,using {note} is not valid, notes= {notes}, curr{self.peek(0)}")
 
-            if self.match(TokenType.COLON):
-                self.advance()
+        # a slash without a note after it
+        return self.parse_note_duration(note_p,semitone,octave,duration)
 
-                if self.match(TokenType.NUM):
-                    duration = float(self.advance().value)
-                    if self.match(TokenType.SLASH):
-                        self.advance()
-                        over = self.expect(TokenType.NUM)
-                        if over is not None:
-                            duration = duration / int(over.value)
+    def parse_note_duration(self,note_p,semitone,octave,duration):
+        if self.match(TokenType.COLON):
+            self.advance()
 
-                elif self.match(TokenType.SLASH):
-                    self.advance() #consume slash token
+            # durations are kept exact, as an int or a Fraction of a whole note
+            if self.match(TokenType.NUM):
+                duration = int(self.advance().value)
+                if self.match(TokenType.SLASH):
+                    self.advance()
+                    over = self.expect(TokenType.NUM)
+                    if over is not None:
+                        duration = Fraction(duration,int(over.value))
 
-                    if self.match(TokenType.NUM):
-                        duration = Fraction(1,int(self.advance().value))
-                    else:
-                        self.err_list.append(f"{SyntaxErr(self.peek(0))}After slash expected a number",self.log_tk())
-                        self.restore_to(TokenType.SPACE)
+            elif self.match(TokenType.SLASH):
+                self.advance() #consume slash token
 
-                else :
-                    self.err_list.append(f"{SyntaxErr(self.peek(0))}After colon in note definition expected a number",self.log_tk())
-            
-            expression =Note(note_p,semitone,octave,duration)
-        elif self.match(TokenType.EOF):
-            pass
+                if self.match(TokenType.NUM):
+                    duration = Fraction(1,int(self.advance().value))
+                else:
+                    self.err_list.append(f"{SyntaxErr(self.peek(0))}After slash expected a number",self.log_tk())
+                    self.restore_to(TokenType.SPACE)
 
-        else:
-            self.err_list.append(f"{SyntaxErr(self.peek(0))}Unexpected token while parsing expressions: {self.peek(0).value} ")
+            else :
+                self.err_list.append(f"{SyntaxErr(self.peek(0))}After colon in note definition expected a number",self.log_tk())
 
-        top = self.stack.pop()
-        if top != ParseState.EXPR:
-            self.dump_state()
-            raise ValueError(f"Expected expr on top of the stack, got {top} instead")
+        return Note(note_p,semitone,octave,duration)
 
-        if expression is None:
-            self.dump_state()
-            raise ValueError(f"Expression must not be none",self.log_tk())
+    def parse_unexpected(self):
+        if not self.match(TokenType.EOF):
+            self.err_list.append(f"{SyntaxErr(self.peek(0))}Unexpected token while parsing expressions: {self.peek(0).value} ")
 
-        return expression
+    # expression parsers by the kind of their first token
+    EXPR_PARSERS = {
+        TokenType.V: parse_volume,
+        TokenType.PLUS: parse_sharp,
+        TokenType.DASH: parse_flat,
+        TokenType.GREATER_THAN: parse_octave_up,
+        TokenType.LESS_THAN: parse_octave_down,
+        TokenType.COLON: parse_duration,
+        TokenType.BANG: parse_measure,
+        TokenType.CARROT: parse_tempo,
+        TokenType.PIPE: parse_bar,
+        TokenType.NUM: parse_interval,
+        TokenType.ASTERISK: parse_repetition,
+        TokenType.CLOSE_PAREN: parse_release,
+        TokenType.OPEN_PAREN: parse_hold,
+        TokenType.OPEN_BRACKET: parse_group,
+        TokenType.ALPHANUM: parse_ident,
+        **dict.fromkeys(NOTES, parse_note),
+    }
 
 
 # helper parser functions
     def skip_space(self):
-        self.log(f"skip space after {self.peek(0)}")
-        while self.peek(0).type == TokenType.SPACE:
-            self.advance()
+        self.log("skip space after {tk}")
+        while self.kind(0) == TokenType.SPACE:
+            self.pos += 1
 
     def skip_whitespace(self):
-        self.log(f"skip whitespace after {self.peek(0)}")
-        while self.peek(0).type == TokenType.SPACE or self.peek(0).type == TokenType.NL:
-            self.advance()
+        self.log("skip whitespace after {tk}")
+        while self.kind(0) in (TokenType.SPACE, TokenType.NL):
+            self.pos += 1
 
     def skip_newlines(self):
-        self.log(f"skip newline after {self.peek(0)}")
+        self.log("skip newline after {tk}")
         """Skip any newline tokens"""
-        while self.peek(0).type == TokenType.NL:
-            self.advance()
+        while self.kind(0) == TokenType.NL:
+            self.pos += 1
 
     def log_tk(self):
         return f", got token \"{self.peek(0).value}\" instead\n"
 
+    # printed to stderr, stdout can be the midi file being written
     def dump_state(self):
-        print(self.stack)
-        print("Recent tokens")
-        for tk in self.tokens[self.pos - 5 : self.pos + 5]:
-            print(tk)
+        print(self.stack, file=sys.stderr)
+        print("Recent tokens", file=sys.stderr)
+        for tk in self.tokens.window(self.pos - 5, self.pos + 5):
+            print(tk, file=sys.stderr)
 
-        print("Recent logs:")
-        for log in self.log_list[-10:]:
-            print(log)
+        print("Recent logs:" if self.log_level else "Recent logs: tracing is off, see LogLevel", file=sys.stderr)
+        for log in list(self.log_list)[-10:]:
+            print(log, file=sys.stderr)
 
-        print("Errors found:")
+        print("Errors found:", file=sys.stderr)
         for err in self.err_list:
-            print(err)
+            print(err, file=sys.stderr)
 
 # error recovery parser functions
     def restore_stmt(self):
        
-        self.log(f"restore statement from error at {self.peek(0)}")
-        if self.peek(0).type == TokenType.OPEN_BRACKET:
+        self.log("restore statement from error at {tk}", level=LogLevel.ERROR)
+        if self.kind(0) == TokenType.OPEN_BRACKET:
                 self.restore_to(TokenType.CLOSE_BRACKET)
-        while self.peek(0).type != TokenType.NL and \
-                self.peek(0).type != TokenType.COLON and \
-                self.peek(0).type != TokenType.EOF :
-            self.advance()
+        while self.kind(0) not in (TokenType.NL, TokenType.COLON, TokenType.EOF):
+            self.pos += 1
 
 
     def restore_to(self,*args):
-        self.log(f"restore to {args} from error at {self.peek(0)}")
-        while self.peek(0).type not in args:
-            self.advance()
+        self.log("restore to {} from error at {tk}", args, level=LogLevel.ERROR)
+        while self.kind(0) not in args:
+            self.pos += 1
 
 
 # helper err functions
@@ -1,165 +1,414 @@
-from new_parser import Parser
 from ai_ast import *
 from lexer import *
-import copy
-
-
-def flatten_expr_group(program):
-    while True:
-        modified = False
-        for m_id,macro in enumerate(program.macros):
-            for e_id,expr in enumerate(macro.body):
-                if isinstance(expr, ExprGroup):
-                    macro.body = macro.body[:e_id] + expr.exprs + macro.body[e_id+1:]
-                    modified = True
-                    break 
-
-        # resolve repeats in movements
-        for t_id,track in enumerate(program.tracks):
-            for m_id,mov in enumerate(track.movements):
-                for e_id,expr in enumerate(mov.expressions):
-                    if isinstance(expr,ExprGroup):
-                        mov.expressions = mov.expressions[:e_id] + expr.exprs + mov.expressions[e_id+1:]
-                        modified = True
-                        break
-
-        if not modified:
-            break
-    
-def print_list(list,indent):
-    for item in list:
-        print(traverse_ast(item,indent))
-    print()
-
-def resolve_repeats(program):
-    # Process macros
-    for macro in program.macros:
-        macro.body = resolve_in_list(macro.body)
-
-    # Process tracks
-    for track in program.tracks:
-        for movement in track.movements:
-            movement.expressions = resolve_in_list(movement.expressions)
-
-def resolve_in_list(expr_list):
-    new_exprs = []
-    i = 0
-    while i < len(expr_list):
-        expr = expr_list[i]
-        
-        if isinstance(expr, ExprGroup):
-            # Recursively process nested groups
-            expr.exprs = resolve_in_list(expr.exprs)
-            new_exprs.append(expr)
-            i += 1
-        elif isinstance(expr, Repetition):
-            # Ensure repetition follows an expression
-            if not new_exprs:
-                raise SyntaxError(f"Invalid repetition at start of expression list: {expr}")
-                
-            # Get target expression and repeat count
-            target = new_exprs.pop()
-            count = expr.times
-            
-            expanded = [copy.deepcopy(target) for _ in range(count)]
-                
-            new_exprs.extend(expanded)
-            i += 1
-        else:
-            new_exprs.append(expr)
+from collections import Counter
+import fractions
+
+
+# the expressions movement_events resolves instead of yielding
+NOT_EVENTS = frozenset([ExprGroup, Repeat, Repetition, Ident, MacroCall])
+
+# exprs with the repetitions after its expressions applied, as repetitions have always been resolved:
+# the first *a of X*a*b makes a copies of X and *b repeats the last copy, so X plays a-1+b times.
+# An expression repeated 0 times is dropped and a repetition after it applies to the one before.
+# Expressions played more than once are wrapped in a Repeat, a list without repetitions is returned as is
+def apply_repetitions(exprs):
+    if not any(type(expr) is Repetition for expr in exprs):
+        return exprs
+
+    played = [] # [expression, times played]
+    for expr in exprs:
+        if type(expr) is not Repetition:
+            played.append([expr, 1])
+            continue
+        if not played:
+            raise SyntaxError(f"Invalid repetition at start of expression list: {expr}")
+        played[-1][1] += expr.times - 1
+        if played[-1][1] <= 0:
+            played.pop()
+    return [expr if times == 1 else Repeat([expr], times, expr.source) for expr, times in played]
+
+# apply_repetitions of exprs, done once per list and kept in cache
+def played_exprs(exprs, cache):
+    entry = cache.get(id(exprs))
+    if entry is None:
+        entry = cache[id(exprs)] = (exprs, apply_repetitions(exprs)) # the list is kept so its id isn't reused
+    return entry[1]
+
+# Keeps active, how many times each macro is in the chain of the frame being walked, up to date
+# when the walk goes from a frame in chain old to the next one in new. The walk pushes or pops a
+# single frame at a time, so new is either the chain of a macro played in old, or the chain of the
+# caller of the macro old is in, whose argument is played
+def move_chain(active, old, new):
+    if new is not None and new[1] is old:
+        active[new[0]] += 1
+    else:
+        active[old[0]] -= 1
+
+# Events kept per macro use in a walk, the events of bigger expansions are walked again each time
+MAX_RECORDED_EVENTS = 4096
+
+# The fused pipeline: yields the events of a movement (notes, chords, state changes, bars) with
+# groups, repeats and macros resolved on the fly, in a single walk over the parsed AST. Nothing is
+# copied or expanded ahead, so memory doesn't grow with the size of the expansion. The events of
+# a macro played more than once are recorded, and played from the recording after that.
+#
+# A frame of the walk is [exprs, index, passes left, env, chain, cache key, recorded events]. env
+# maps the parameters of the macro being played to their (argument, env and chain of the caller),
+# chain is the linked list (macro index, outer chain) of the macros the frame is in, used to find
+# recursive macros, with active counting the macros of the chain of the top frame. A macro played with no arguments, or with plain events as arguments, has a
+# cache key, the same for every call with equal arguments wherever it is. From its second use on
+# it records its events, unless a recursive macro or more than
+# MAX_RECORDED_EVENTS events are met, as the recording wouldn't be the same wherever it's played
+def movement_events(program, movement):
+    reported = set() # ids of the expressions already reported as errors
+    played = {} # lists with their repetitions applied, see played_exprs
+    expanded = {} # cache key -> the events of the macro
+    seen = set() # cache keys of the macros played once so far
+    recorders = [] # the frames recording their events, the innermost one gets the events yielded
+    stack = [[played_exprs(movement.expressions, played), 0, 0, None, None, None, None]]
+    active = Counter() # macro index -> times it's in the chain of the top frame
+    current = None # the chain active counts
+    while stack:
+        frame = stack[-1]
+        exprs, i = frame[0], frame[1]
+        if frame[4] is not current:
+            move_chain(active, current, frame[4])
+            current = frame[4]
+
+        if recorders and len(recorders[-1][6]) > MAX_RECORDED_EVENTS:
+            for recorder in recorders:
+                recorder[6] = None
+            recorders.clear()
+
+        # plain events are the common case, they're yielded right away
+        n = len(exprs)
+        start = i
+        while i < n:
+            expr = exprs[i]
+            if type(expr) in NOT_EVENTS:
+                break
+            yield expr
             i += 1
-            
-    return new_exprs
-def resolve_macros(program):
-    
-    # iterate through movements in the ast and find macros
-    for t_id,track in enumerate(program.tracks):
-        for m_id,mov in enumerate(track.movements):
-            while True: # iterate until no more modifications were made
-                mov_body = copy.copy(mov.expressions) #make a shallow copy of the expr list
-                was_modified = False
-
-                for e_id,expr in enumerate(mov_body):
-                    if isinstance(expr,Ident):
-                        maps = program.ident_dic[expr.source.value]
-                        macro = None
-
-                        try:
-                            macro = program.macros[maps-1]
-                        except:
-                            program.err_list.append(f"Unknown idenfitier: {expr}")
-
-                        mov_body = mov_body[:e_id] + inline_macro_body(macro,program) + mov_body[e_id+1:]
-                        was_modified = True
-                        break
-
-
-                    if isinstance(expr,MacroCall):
-                        maps = program.ident_dic[expr.name.value]
-                        macro = None
-                        try:
-                            macro = program.macros[maps-1]
-                        except:
-                            ValueError(f"Unknown macro: {expr}")
-
-                        new_macro = apply_macro(macro,expr.arguments,program)
-                        mov_body = mov_body[:e_id] + inline_macro_body(new_macro,program) + mov_body[e_id+1:]
-                        was_modified = True
-                        break
-
-                mov.expressions = mov_body
-                if not was_modified:
-                    break
-
-    pass
-
-def apply_macro(macro,args,program):
-    arg_map = {}
-    new_macro = copy.deepcopy(macro)
-
-    if len(macro.parameters) != len(args):
-        raise ValueError(f"Expected {len(macro.parameters)} arguments, got only {len(args)}")
-
-    for i,param in enumerate(macro.parameters):
-        arg_map[param.value] = args[i]
-
-    arg_keys = arg_map.keys()
-    for e_id,expr in enumerate(macro.body):
-        if expr.source.value in arg_keys:
-            new_macro.body = new_macro.body[:e_id] + [arg_map[expr.source.value]] + new_macro.body[e_id+1:]
-
-
-
-    return new_macro
-
-def inline_macro_body(macro,program):
-    if (macro is None) or (len(macro.body) == 0):
-        return []
-    macro_body = copy.copy(macro.body)
-
-    for e_id,expr in enumerate(macro.body):
-        if isinstance(expr,Ident):
-            maps = program.ident_dic[expr.source.value]
-            new_macro = None
-
-            try:
-                new_macro = program.macros[maps-1]
-            except:
-                raise ValueError(f"Unknown idenfitier: {expr}")
-            
-            macro_body = macro.body[:e_id] + inline_macro_body(new_macro,program) + macro.body[e_id+1:]
+        frame[1] = i
+        if recorders and i > start:
+            recorders[-1][6].extend(exprs[start:i])
+
+        if i == n:
+            events = frame[6]
+            if events is not None:
+                # the first pass of the macro is recorded, the other passes play the recording
+                expanded[frame[5]] = events
+                recorders.pop()
+                for _ in range(frame[2]):
+                    yield from events
+                if recorders:
+                    recorders[-1][6].extend(events * (frame[2] + 1))
+                stack.pop()
+            elif frame[2] > 0:
+                frame[2] -= 1
+                frame[1] = 0
+            else:
+                stack.pop()
             continue
 
-        if isinstance(expr,MacroCall):
-            maps = program.ident_dic[expr.name]
-            new_macro = None
+        expr = exprs[i]
+        frame[1] = i + 1
+
+        # the Repeats of apply_repetitions are played like the expression they hold
+        times = 1
+        if type(expr) is Repeat and len(expr.body) == 1:
+            expr, times = expr.body[0], expr.times
+            if times <= 0:
+                continue
+
+        env, chain = frame[3], frame[4]
+        if isinstance(expr, ExprGroup):
+            stack.append([played_exprs(expr.exprs, played), 0, times - 1, env, chain, None, None])
+
+        elif isinstance(expr, Repeat):
+            if expr.times > 0:
+                stack.append([played_exprs(expr.body, played), 0, times * expr.times - 1, env, chain, None, None])
+
+        elif isinstance(expr, Ident) and env and expr.source.value in env:
+            arg, arg_env, arg_chain = env[expr.source.value]
+            if type(arg) in NOT_EVENTS:
+                stack.append([[arg], 0, times - 1, arg_env, arg_chain, None, None])
+            else:
+                for _ in range(times):
+                    yield arg
+                if recorders:
+                    recorders[-1][6].extend([arg] * times)
+
+        elif isinstance(expr, (Ident, MacroCall)):
+            name = expr.source if isinstance(expr, Ident) else expr.name
+            maps = program.ident_dic.get(name.value)
+            if not isinstance(maps, int):
+                if id(expr) not in reported:
+                    reported.add(id(expr))
+                    program.err_list.append(f"Unknown {'macro' if isinstance(expr, MacroCall) else 'idenfitier'}: {expr}")
+                continue
+
+            if active[maps]:
+                # the macros being recorded are missing this use, their recordings only hold here
+                for recorder in recorders:
+                    recorder[6] = None
+                recorders.clear()
+                if id(expr) not in reported:
+                    reported.add(id(expr))
+                    outer = chain
+                    while outer[0] != maps:
+                        outer = outer[1]
+                    uses = []
+                    while chain is not outer[1]:
+                        uses.append(program.macros[chain[0]-1].name.value)
+                        chain = chain[1]
+                    uses = " -> ".join(reversed(uses))
+                    program.err_list.append(f"Macro error({name.line},{name.column}): macro {name.value} uses itself ({uses} -> {name.value}), it was left out")
+                continue
+
+            # calls with equal arguments share their recording, like in SizeEstimator. Bars are left
+            # out, the bar index and the measure errors need the position of every bar
+            key = None
+            if isinstance(expr, Ident):
+                key = (maps,)
+            elif all(type(arg) not in NOT_EVENTS and type(arg) is not Bar for arg in expr.arguments):
+                key = (maps, node_key(expr.arguments)) # the arguments don't depend on where the call is
+            events = expanded.get(key)
+            if events is not None:
+                for _ in range(times):
+                    yield from events
+                if recorders:
+                    recorders[-1][6].extend(events * times)
+                continue
+
+            macro = program.macros[maps-1]
+            macro_env = None
+            if isinstance(expr, MacroCall):
+                if len(macro.parameters) != len(expr.arguments):
+                    raise ValueError(f"Expected {len(macro.parameters)} arguments, got only {len(expr.arguments)}")
+                macro_env = {param.value: (arg, env, chain) for param, arg in zip(macro.parameters, expr.arguments)}
+
+            macro_frame = [played_exprs(macro.body, played), 0, times - 1, macro_env, (maps, chain), key, None]
+            if key is not None:
+                if times > 1 or key in seen:
+                    macro_frame[6] = []
+                    recorders.append(macro_frame)
+                else:
+                    seen.add(key)
+            stack.append(macro_frame)
+
+        else:
+            for _ in range(times):
+                yield expr
+            if recorders:
+                recorders[-1][6].extend([expr] * times)
+
+
+# Default budget of events for a movement, see check_budget
+MAX_EVENTS = 1_000_000
+
+class ExpansionSize:
+    """How many events a movement expands into and how long it plays, in beats (quarter notes)"""
+
+    __slots__ = ("events", "duration")
+
+    def __init__(self, events, duration):
+        self.events = events
+        self.duration = duration
+
+    def __repr__(self):
+        return f"ExpansionSize(events={self.events}, duration={self.duration})"
+
+
+class SizeEstimator:
+    """Computes the exact ExpansionSize of movements without expanding them.
+
+    Every list of expressions is summarised once by the events it would yield, see seq_size, and
+    a list played n times is composed with itself in log(n) steps. Macro summaries are cached, so
+    a macro of repeated macros *1000 costs about as much as its source. The walk follows the one
+    in movement_events and counts exactly what it would yield; errors are left for it to report.
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self.sizes = {} # macro cache key -> summary of its body, see macro_key
+        self.played = {} # lists with their repetitions applied, see played_exprs
+
+    def size(self, movement):
+        summary = self.summarise(movement.expressions)
+        if summary is None:
+            return ExpansionSize(0, fractions.Fraction(0))
+
+        # the state starts with a duration of 1 and the last note has no interval after it
+        count, _, adv_c, adv_k, pending, _ = summary
+        duration = adv_c + adv_k
+        if pending is not None:
+            duration += pending[0] + pending[1]
+        return ExpansionSize(count, duration)
+
+    # The summary of the events exprs yields, walked like movement_events does.
+    # A frame is [exprs, index, summary so far, env, chain, times, cache key, binding, cycle found]
+    def summarise(self, exprs):
+        program = self.program
+        stack = [[played_exprs(exprs, self.played), 0, None, None, None, 1, None, None, False]]
+        active = Counter() # macro index -> times it's in the chain of the top frame, see move_chain
+        current = None
+        while True:
+            frame = stack[-1]
+            exprs, i, env, chain = frame[0], frame[1], frame[3], frame[4]
+            if chain is not current:
+                move_chain(active, current, chain)
+                current = chain
+
+            if i == len(exprs):
+                stack.pop()
+                summary = frame[2]
+                if not stack:
+                    return summary
+
+                parent = stack[-1]
+                if frame[8]:
+                    parent[8] = True # a summary with a recursive macro left out depends on where it's used
+                elif frame[6] is not None:
+                    self.sizes[frame[6]] = summary
+                if frame[7] is not None:
+                    frame[7].append(summary)
+                parent[2] = seq_size(parent[2], power_size(summary, frame[5]))
+                continue
+
+            expr = exprs[i]
+            frame[1] = i + 1
+
+            times = 1
+            if type(expr) is Repeat and len(expr.body) == 1:
+                expr, times = expr.body[0], expr.times
+                if times <= 0:
+                    continue
+
+            if isinstance(expr, ExprGroup):
+                stack.append([played_exprs(expr.exprs, self.played), 0, None, env, chain, times, None, None, False])
+
+            elif isinstance(expr, Repeat):
+                if expr.times > 0:
+                    stack.append([played_exprs(expr.body, self.played), 0, None, env, chain, times * expr.times, None, None, False])
+
+            elif isinstance(expr, Ident) and env and expr.source.value in env:
+                # an argument is summarised once, in the env of the call, the first time it's used
+                arg, arg_env, arg_chain, binding = env[expr.source.value]
+                if binding:
+                    frame[2] = seq_size(frame[2], power_size(binding[0], times))
+                else:
+                    stack.append([[arg], 0, None, arg_env, arg_chain, times, None, binding, False])
+
+            elif isinstance(expr, (Ident, MacroCall)):
+                name = expr.source if isinstance(expr, Ident) else expr.name
+                maps = program.ident_dic.get(name.value)
+                if not isinstance(maps, int):
+                    continue
+
+                if active[maps]:
+                    frame[8] = True
+                    continue
+
+                # the summary of a macro only depends on its arguments when they don't use parameters
+                key = None
+                if isinstance(expr, Ident):
+                    key = (maps,)
+                elif env is None:
+                    key = (maps, tuple(node_key(arg) for arg in expr.arguments))
+                if key in self.sizes:
+                    frame[2] = seq_size(frame[2], power_size(self.sizes[key], times))
+                    continue
+
+                macro = program.macros[maps-1]
+                macro_env = None
+                if isinstance(expr, MacroCall):
+                    if len(macro.parameters) != len(expr.arguments):
+                        raise ValueError(f"Expected {len(macro.parameters)} arguments, got only {len(expr.arguments)}")
+                    macro_env = {param.value: (arg, env, chain, []) for param, arg in zip(macro.parameters, expr.arguments)}
+
+                stack.append([played_exprs(macro.body, self.played), 0, None, macro_env, (maps, chain), times, key, None, False])
+
+            else:
+                frame[2] = seq_size(frame[2], power_size(event_size(expr), times))
+
+
+# The summary of a run of events, or None for no events, is the tuple
+# (count, first_interval, adv_c, adv_k, pending, out_dur) where, for a run started with a default
+# duration of d: adv_c + adv_k*d beats pass before its last note, pending is the (c, k) of the last
+# note's c + k*d beats when the run ends with one (an interval right after it replaces them),
+# first_interval is the interval the run starts with, if any, and out_dur the default duration
+# it leaves set, if it sets one. It follows how the time moves in the programs of compile_movement,
+# as midigen.run_program plays them.
+def event_size(event):
+    if isinstance(event, (Note, Chord)):
+        note = event if isinstance(event, Note) else event.notes[-1]
+        duration = note.duration if isinstance(note, Note) else -1
+        if duration == -1:
+            return (1, None, 0, 0, (0, 4), None)
+        return (1, None, 0, 0, (4 * exact_duration(duration), 0), None)
+
+    if isinstance(event, SetInterval):
+        return (1, int(event.time.value), 0, 0, None, None)
+
+    if isinstance(event, SetDuration):
+        return (1, None, 0, 0, None, exact_duration(event.dur))
+
+    return (1, None, 0, 0, None, None)
+
+def exact_duration(duration):
+    return fractions.Fraction(duration)
+
+# The summary of a played right before b
+def seq_size(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+
+    count, first_interval, adv_c, adv_k, pending, out_dur = a
+    b_count, b_interval, b_c, b_k, b_pending, b_out = b
+
+    if pending is not None:
+        if b_interval is not None:
+            adv_c += b_interval
+        else:
+            adv_c += pending[0]
+            adv_k += pending[1]
+
+    # b starts with the duration a leaves set
+    if out_dur is not None:
+        b_c += b_k * out_dur
+        b_k = 0
+        if b_pending is not None:
+            b_pending = (b_pending[0] + b_pending[1] * out_dur, 0)
+
+    return (count + b_count, first_interval, adv_c + b_c, adv_k + b_k, b_pending, out_dur if b_out is None else b_out)
 
-            try:
-                new_macro = program.macros[maps-1]
-            except:
-                raise ValueError(f"Unknown macro: {expr}") 
+# The summary of a played times times in a row
+def power_size(a, times):
+    result = None
+    while times > 0 and a is not None:
+        if times & 1:
+            result = seq_size(result, a)
+        a = seq_size(a, a)
+        times >>= 1
+    return result
 
-            another_macro = apply_macro(macro,program)
-            macro_body = macro.body[:e_id] + inline_macro_body(another_macro,program) + macro.body[e_id+1:]
+# The sizes of every movement, per track
+def expansion_sizes(program):
+    estimator = SizeEstimator(program)
+    return [[estimator.size(movement) for movement in track.movements] for track in program.tracks]
 
-    return macro_body
\ No newline at end of file
+# Adds an error for every movement expanding into more than max_events events,
+# returns the sizes of the movements and whether they all fit
+def check_budget(program, max_events=MAX_EVENTS):
+    sizes = expansion_sizes(program)
+    fits = True
+    for track, track_sizes in zip(program.tracks, sizes):
+        for movement, size in zip(track.movements, track_sizes):
+            if size.events > max_events:
+                fits = False
+                instrument = movement.instrument
+                program.err_list.append(f"Expansion error({instrument.line},{instrument.column}): {instrument.value} expands into {size.events} events, more than the limit of {max_events}")
+    return sizes, fits
@@ -0,0 +1,139 @@
+from midi_ir import *
+import os
+
+# Writes Standard MIDI Files (SMF) from the midi IR (see midi_ir.py): header and track chunks,
+# variable length delta times and, optionally, running status, straight into a bytearray.
+#
+# The events are put in order by order_events first, so the output matches what midiutil wrote
+# for the same events: same event order, same duplicate removal, same note off placement.
+# With running status on, the bytes differ but the events are the same.
+#
+# The file can be built whole (encode_smf), written to a path, stream or buffer (write_smf) or
+# produced a chunk at a time (iter_smf), so it never has to go through the disk.
+
+
+def write_var_length(out, value):
+    if value < 0x80:
+        out.append(value)
+        return
+    groups = []
+    while value > 0:
+        groups.append(value & 0x7F)
+        value >>= 7
+    for group in reversed(groups[1:]):
+        out.append(group | 0x80)
+    out.append(groups[0])
+
+
+# Appends the track chunk of buffer to out. With running status the status byte of a channel
+# message is left out when it's the same as the one before it, and note offs are written as note
+# ons with velocity 0 so they share it. Meta events cancel the running status. A channel message
+# that doesn't fit its bytes is a ValueError, see invalid_message
+def encode_track(out, buffer, running_status=True):
+    buffer = order_events(buffer)
+    data = buffer.data
+
+    out += b"MTrk"
+    length_at = len(out)
+    out += b"\x00\x00\x00\x00"
+
+    previous = 0
+    running = None
+    for tick, _, _, status, data1, data2 in buffer:
+        if status == META:
+            if data1 == META_END_OF_TRACK:
+                continue
+            write_var_length(out, tick - previous)
+            previous = tick
+            out.append(META)
+            out.append(data1)
+            write_var_length(out, len(data[data2]))
+            out += data[data2]
+            running = None
+            continue
+
+        if (data1 | data2) & ~0x7F or not NOTE_OFF <= status < 0xF0:
+            raise ValueError(invalid_message(tick, status, data1, data2))
+
+        delta = tick - previous
+        if delta < 0x80:
+            out.append(delta)
+        else:
+            write_var_length(out, delta)
+        previous = tick
+        if running_status:
+            if status & 0xF0 == NOTE_OFF:
+                status = NOTE_ON | (status & 0x0F)
+                data2 = 0
+            if status != running:
+                out.append(status)
+                running = status
+        else:
+            out.append(status)
+        out.append(data1)
+        if status & 0xE0 != 0xC0: # program change and channel pressure have one data byte
+            out.append(data2)
+
+    out += bytes((0x00, META, META_END_OF_TRACK, 0x00))
+    out[length_at:length_at + 4] = (len(out) - length_at - 4).to_bytes(4, "big")
+
+
+# A channel message takes a status byte from 0x80 to 0xEF and data bytes from 0 to 127, anything
+# else would be read back as other events
+def invalid_message(tick, status, data1, data2):
+    return f"Cannot encode the event at tick {tick}: status {status:#x}, data bytes {data1} {data2} (a status is 0x80 to 0xef, a data byte 0 to 127)"
+
+
+def encode_header(format, n_tracks, ticks_per_quarter):
+    out = bytearray(b"MThd")
+    out += (6).to_bytes(4, "big")
+    out += format.to_bytes(2, "big")
+    out += n_tracks.to_bytes(2, "big")
+    out += ticks_per_quarter.to_bytes(2, "big")
+    return out
+
+
+def encode_smf(ir, running_status=True):
+    out = encode_header(ir.format, len(ir.tracks), ir.ticks_per_quarter)
+    for buffer in ir.tracks:
+        encode_track(out, buffer, running_status)
+    return out
+
+
+# The file in chunks: the header, then a track chunk for every buffer of tracks as it comes. The
+# buffers can be generated while the file is sent, only their number has to be known up front
+def iter_smf(tracks, n_tracks, format=1, ticks_per_quarter=TICKS_PER_QUARTER, running_status=True):
+    yield encode_header(format, n_tracks, ticks_per_quarter)
+    for buffer in tracks:
+        out = bytearray()
+        encode_track(out, buffer, running_status)
+        yield out
+
+
+# Writes chunks one after the other to target: a path, a binary file (anything with write) or a
+# writable buffer (a memoryview, bytearray...) filled from its start. Returns the number of bytes
+# written, a buffer too small for them is a ValueError
+def write_chunks(chunks, target):
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, "wb") as output_file:
+            return write_chunks(chunks, output_file)
+
+    written = 0
+    if hasattr(target, "write"):
+        for chunk in chunks:
+            target.write(chunk)
+            written += len(chunk)
+        return written
+
+    with memoryview(target).cast("B") as view:
+        for chunk in chunks:
+            if written + len(chunk) > len(view):
+                raise ValueError(f"the midi file doesn't fit in a buffer of {len(view)} bytes")
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+    return written
+
+
+def write_smf(ir, target, running_status=True):
+    chunks = iter_smf(ir.tracks, len(ir.tracks), ir.format, ir.ticks_per_quarter, running_status)
+    return write_chunks(chunks, target)
@@ -56,17 +56,8 @@ print("printing ast, before resolving macros")
 print(traverse_ast(ast, 0))
 print(ast.ident_dic)
 
-print("printing ast, after resolving repeats")
-resolve_repeats(ast)
-print(traverse_ast(ast,0))
-
-print("printing ast, after flattening expr groups")
-flatten_expr_group(ast)
-print(traverse_ast(ast,0))
-
-print()
-resolve_macros(ast)
-print("printing ast after resolving macros")
-print(traverse_ast(ast,0))
-
-
+print("printing the events of every movement, with repeats, groups and macros resolved")
+for track in ast.tracks:
+    for movement in track.movements:
+        print(movement.instrument.value, list(movement_events(ast, movement)))
+print(ast.err_list)
@@ -0,0 +1,150 @@
+from lexer import Tokenizer, Token
+from new_parser import Parser
+from incremental import IncrementalParser
+from ai_ast import traverse_ast
+import pytest
+import pickle
+
+# tests for the incremental parser: after every edit the program has to be the one a full parse
+# of the new source gives, down to the lines and columns of the tokens and the errors.
+# Run with: python -m pytest test_incremental.py
+
+SOURCE = """title: "edits"
+
+riff = do re mi
+k(a) = a [a sol]*2
+
+track "main":
+piano "melody": riff | k(do) fa |
+violin: [do re]*2 mi
+track "bass":
+cello: do 2 re 2
+"""
+
+
+# what a program holds, as text, tokens are printed with their line and column
+def summary(ast):
+    return traverse_ast(ast, 0), ast.err_list, repr(ast.metadata), repr(ast.ident_dic)
+
+
+def check(live):
+    assert summary(live.program()) == summary(Parser(Tokenizer(live.source).buffer()).parse())
+
+
+def edited(source, start, end, text):
+    live = IncrementalParser(source)
+    live.edit(start, end, text)
+    assert live.source == source[:start] + text + source[end:]
+    check(live)
+    return live
+
+
+EDITS = [
+    ("do re mi", "do re re mi"), # inside a statement
+    ("k(do)", "k(re)"),
+    ("[do re]*2", "[do re]*3"),
+    ("do 2 re 2", "do 2\nre 2"), # a new line inside a statement
+    ("cello:", "cello"), # an error, the colon is missing
+]
+
+
+@pytest.mark.parametrize("old, new", EDITS)
+def test_edit_in_statement(old, new):
+    start = SOURCE.index(old)
+    edited(SOURCE, start, start + len(old), new)
+
+
+def test_edit_across_statements():
+    start = SOURCE.index("mi\n")
+    end = SOURCE.index("[a sol]")
+    edited(SOURCE, start, end, "fa\nk(b) = b b ")
+
+    # joins two statements
+    start = SOURCE.index("fa |\nviolin")
+    edited(SOURCE, start, start + len("fa |\nviolin"), "fa | violin")
+
+    # the new text adds and removes statements
+    start = SOURCE.index("track")
+    edited(SOURCE, start, start, 'track "intro":\nflute: sol\n')
+    edited(SOURCE, SOURCE.index("riff ="), SOURCE.index("track"), "")
+    edited(SOURCE, SOURCE.index("riff ="), SOURCE.index("riff ="), "riff = do\n") # an error, riff is defined twice
+
+
+def test_edit_at_end():
+    end = len(SOURCE)
+    edited(SOURCE, end, end, "flute: sol la")
+    edited(SOURCE, end, end, "\n\nflute: sol la\n")
+    edited(SOURCE, end - 5, end, "")
+    edited(SOURCE, SOURCE.index("cello"), end, "")
+    edited("", 0, 0, SOURCE)
+    edited(SOURCE, 0, end, "")
+
+
+def test_statements_reused():
+    source = "".join(f'piano "m{i}": do re mi\n' for i in range(100))
+    start = source.index('piano "m50"')
+    live = edited(source, start + 8, start + 8, "x")
+    assert live.reparsed < 10
+    live.edit(start, start, "\n\n")
+    check(live)
+    assert live.reparsed < 10
+
+
+def test_lines_moved_without_reparsing():
+    # a new line moves the statements after it, their tokens count their lines from their statement
+    # so nothing is parsed or registered again. The gap follows the edits from the end to the start
+    source = "".join(f'piano "m{i}": do re mi\n' for i in range(2000))
+    live = IncrementalParser(source)
+    check(live)
+    for statement in ("\n", 'piano "m1000"', 'piano "m0"', 'piano "m1999"'):
+        position = live.source.rindex(statement) if statement == "\n" else live.source.index(statement)
+        registered = live.registered
+        live.edit(position, position, "\n\n")
+        check(live)
+        assert live.reparsed < 10 and live.registered is registered
+
+    # the tokens of another process are plain tokens, at the line they're on
+    token = live.program().tracks[0].movements[-1].instrument
+    copied = pickle.loads(pickle.dumps(token))
+    assert (type(copied), copied.line, copied.column) == (Token, token.line, token.column) and token.line > 2000
+
+
+def test_register_errors_moved():
+    # the error of a redefinition shows its line, a new line before it moves it
+    live = IncrementalParser(SOURCE + "riff = do\n")
+    check(live)
+    live.edit(0, 0, "\n")
+    check(live)
+
+
+def test_renames():
+    # a name no other statement uses is renamed in place, the others register everything again
+    source = "riff = do re\nlick = riff mi\n" + "".join(f'piano "m{i}": do re mi\n' for i in range(100))
+    live = IncrementalParser(source)
+    check(live)
+    for old, new, kept in [('"m50"', '"m50x"', True), ("lick", "lick2", True), ('"m51"', '"m52"', False), ("riff =", "rif =", False), ('"m52"', '"m51"', False)]:
+        start = live.source.index(old)
+        registered = live.registered
+        live.edit(start, start + len(old), new)
+        check(live)
+        assert (live.registered is registered) == kept
+
+
+def test_edits_in_a_row():
+    # every edit starts from the program the one before left
+    live = IncrementalParser(SOURCE)
+    for old, new in EDITS + [("violin", "flute: sol la\nviolin"), ("flute: sol la\n", ""), ("fa |", "fa |\n\n"), ("do 2\nre 2", "do")]:
+        start = live.source.index(old)
+        live.edit(start, start + len(old), new)
+        check(live)
+    live.update(SOURCE)
+    check(live)
+
+
+if __name__ == "__main__":
+    for old, new in EDITS:
+        test_edit_in_statement(old, new)
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and name != "test_edit_in_statement":
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,69 @@
+from lexer import Tokenizer
+from new_parser import Parser
+from ai_ast import ExprGroup, HoldNote, ReleaseNote, Chord, MacroCall, traverse_ast, node_key
+import sys
+
+# stress tests for the parser on deeply nested groups, holds and macro calls, far deeper than
+# the recursion limit: a parser recursing once per level would raise RecursionError on them.
+# The parse times are in bench.py (python bench.py nesting).
+# Run with: python -m pytest test_parser.py
+
+DEPTH = 20 * sys.getrecursionlimit()
+
+
+def parse(source):
+    ast = Parser(Tokenizer(source).buffer()).parse()
+    assert ast.err_list == [], ast.err_list
+    return ast
+
+
+def test_nested_groups():
+    ast = parse("piano: " + "[" * DEPTH + "do re" + "]" * DEPTH + "\n")
+    expr = ast.tracks[0].movements[0].expressions[0]
+    depth = 0
+    while type(expr) is ExprGroup:
+        assert len(expr.exprs) in (1, 2)
+        depth += 1
+        expr = expr.exprs[0]
+    assert depth == DEPTH
+    assert expr.source.value == "do"
+
+
+def test_nested_holds():
+    ast = parse("piano: " + "[(do) " * DEPTH + "do/mi" + "]" * DEPTH + "\n")
+    group = ast.tracks[0].movements[0].expressions[0]
+    for _ in range(DEPTH - 1):
+        hold, release, group = group.exprs
+        assert type(hold) is HoldNote and type(release) is ReleaseNote
+    assert [type(expr) for expr in group.exprs] == [HoldNote, ReleaseNote, Chord]
+
+
+def test_nested_calls():
+    ast = parse("m(a) = a\npiano: " + "m(" * DEPTH + "do" + ")" * DEPTH + "\n")
+    call = ast.tracks[0].movements[0].expressions[0]
+    depth = 0
+    while type(call) is MacroCall:
+        depth += 1
+        call = call.arguments[0]
+    assert depth == DEPTH
+
+
+def test_traverse_nested_groups():
+    # the printed tree has an indent per level, it's kept shallow enough to stay small
+    ast = parse("piano: " + "[" * 5_000 + "do" + "]" * 5_000 + "\n")
+    lines = [line.strip() for line in traverse_ast(ast, 0).splitlines()]
+    assert lines.count("[") == lines.count("]") == 5_000
+
+
+def test_mixed_nesting():
+    # groups, holds and calls in one another, and node_key walking the whole tree
+    ast = parse("m(a) = a\npiano: " + "[(do) m(" * DEPTH + "do" + ")]" * DEPTH + "\n")
+    key = node_key(ast)
+    assert key.count(MacroCall) == key.count(HoldNote) == key.count(ExprGroup) == DEPTH
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
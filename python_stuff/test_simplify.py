@@ -0,0 +1,139 @@
+from lexer import Tokenizer
+from new_parser import Parser
+from ai_ast import Bar
+from simplify import movement_events, expansion_sizes, played_exprs
+import simplify
+import pytest
+
+# tests for the events movement_events yields and the sizes the estimator gives for them.
+# The walk times are in bench.py (python bench.py groups).
+# Run with: python -m pytest test_simplify.py
+
+
+def parse(source):
+    return Parser(Tokenizer(source).buffer()).parse()
+
+
+# the notes movement_events plays for the first movement of source, as note names
+def played(source):
+    ast = parse(source)
+    movement = ast.tracks[0].movements[0]
+    events = list(movement_events(ast, movement))
+    assert expansion_sizes(ast)[0][0].events == len(events)
+    return [event.source.value for event in events]
+
+
+# the steps movement_events takes for the first movement of source: every frame it pushes
+# gets its expressions from played_exprs, a step is an expression of a frame
+def walk_steps(source):
+    ast = parse(source)
+    steps = 0
+
+    def counted(exprs, cache):
+        nonlocal steps
+        played = played_exprs(exprs, cache)
+        steps += len(played)
+        return played
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(simplify, "played_exprs", counted)
+        for _ in movement_events(ast, ast.tracks[0].movements[0]):
+            pass
+    return steps
+
+
+def test_chained_repetitions():
+    # X*a*b plays X a-1+b times, the first *a makes copies and *b repeats the last one
+    assert played("piano: do*2*3\n") == ["do"] * 4
+    assert played("piano: do*3*2\n") == ["do"] * 4
+    assert played("piano: do*2*2*2\n") == ["do"] * 4
+    assert played("piano: [do re]*2*3\n") == ["do", "re"] * 4
+    assert played("piano: do*1*3 re\n") == ["do"] * 3 + ["re"]
+
+
+def test_repetition_of_nothing():
+    # a repetition after an expression played 0 times applies to the expression before it
+    assert played("piano: re do*0*3\n") == ["re"] * 3
+    assert played("piano: re*2 do*0*3\n") == ["re"] * 4
+    assert played("piano: re do*3*0\n") == ["re", "do", "do"]
+    assert played("piano: re [do mi]*0 fa\n") == ["re", "fa"]
+
+
+def test_repetition_at_start():
+    with pytest.raises(SyntaxError):
+        played("piano: do*0*3 re\n")
+
+
+def test_repetitions_in_macros():
+    source = "riff = do re*2*3\npiano: riff mi riff\n"
+    assert played(source) == ["do", "re", "re", "re", "re", "mi", "do", "re", "re", "re", "re"]
+    assert played("k(a) = a [a mi]*2*2\npiano: k(do)\n") == ["do"] + ["do", "mi"] * 3
+
+
+def test_macros_played_again():
+    # the events of a macro are recorded on its second use, the recording has to play the same
+    source = "riff = do re\nverse = riff mi riff\npiano: [verse fa]*3 riff\n"
+    assert played(source) == (["do", "re", "mi", "do", "re", "fa"] * 3) + ["do", "re"]
+    assert played("k(a) = a re\npiano: [k(do) mi]*3 k(do)\n") == ["do", "re", "mi"] * 3 + ["do", "re"]
+
+
+def test_recursive_macros():
+    # a recursive use is left out where it's found, wherever the macro holding it is played from
+    ast = parse("a = do b\nb = re a\npiano: a b a b\n")
+    events = [event.source.value for event in movement_events(ast, ast.tracks[0].movements[0])]
+    assert events == ["do", "re", "re", "do"] * 2
+    assert ast.err_list == ["Macro error(2,7): macro a uses itself (a -> b -> a), it was left out",
+                            "Macro error(1,7): macro b uses itself (b -> a -> b), it was left out"]
+
+
+def test_deep_macro_chains():
+    # the recursion check doesn't walk the chain of macros being played, however deep it is
+    n = 8_000
+    source = "".join(f"m{i} = m{i - 1}\n" for i in range(1, n)) + f"m0 = do m{n - 1}\npiano: m{n - 1} re\n"
+    assert played(source) == ["do", "re"]
+    ast = parse(source)
+    list(movement_events(ast, ast.tracks[0].movements[0]))
+    uses = " -> ".join(f"m{i}" for i in range(n - 1, -1, -1))
+    assert ast.err_list == [f"Macro error({n},8): macro m{n - 1} uses itself ({uses} -> m{n - 1}), it was left out"]
+
+    # an argument is played in the chain of its caller, a macro passed to itself isn't recursive
+    source = "".join(f"p{i}(a) = p{i - 1}(a)\n" for i in range(1, n)) + f"p0(a) = a\npiano: p{n - 1}(p{n - 1}(do)) p0(p0(re))\n"
+    assert played(source) == ["do", "re"]
+    assert parse(source).err_list == []
+
+
+def test_nested_groups():
+    # groups nested far deeper than the recursion limit are walked without recursing
+    depth = 20_000
+    assert played("piano: " + "[" * depth + "do]*2" + "]" * (depth - 1) + " re\n") == ["do", "do", "re"]
+    assert played("piano: " + "[do " * depth + "]" * depth + "\n") == ["do"] * depth
+
+
+def test_groups_walk_is_linear():
+    # a step per expression of each group, whatever the depth of the group
+    for n in (2_000, 16_000):
+        assert walk_steps("piano: " + "[do re] " * n + "\n") == 3 * n
+        assert walk_steps("piano: " + "[do " * n + "]" * n + "\n") == 2 * n
+
+    # a repeated group is walked once, a macro twice as its second use is recorded
+    assert walk_steps("piano: [do re]*1000\n") == 3
+    assert walk_steps("riff = [do re] mi\npiano: " + "riff " * 1000 + "\n") == 1000 + 2 * 4
+
+
+def test_equal_calls_recorded_once():
+    # calls with equal arguments share one recording wherever they are, other arguments get their own
+    source = "k(a) = a re mi\npiano: " + "k(do) fa " * 1000 + "k(sol)\n"
+    assert walk_steps(source) == 2001 + 2 * 3 + 3
+    assert played(source) == ["do", "re", "mi", "fa"] * 1000 + ["sol", "re", "mi"]
+
+    # a bar passed as an argument keeps the position of its call
+    ast = parse("k(a) = a re\npiano: k(|) k(|) k(|)\n")
+    bars = [event.source.column for event in movement_events(ast, ast.tracks[0].movements[0]) if type(event) is Bar]
+    assert bars == [9, 14, 19]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,382 @@
+from lexer import Tokenizer, TokenBuffer
+from new_parser import Parser
+from midigen import gen_midi, gen_ir, gen_midi_bytes, stream_midi, compile_movement, MovementProgram, run_program, run_program_vectorised, TrackEvents, BarIndex, np
+from midi_ir import EventBuffer, MidiIR, dump, load, merge_tracks, TICKS_PER_QUARTER, META_END_OF_TRACK, PROGRAM_CHANGE
+from smf import encode_smf
+import tempfile
+import contextlib
+import io
+import pytest
+import os
+
+# golden tests for the midi writer: the scores in golden/ are compiled and compared byte for byte
+# with the .mid files next to them. scale.mid, chords.mid and macros.mid were written by midiutil,
+# with compiler.py of 8edf815 (the commit bench.py compares the lexer with). That compiler left out
+# the title, so these scores have none. tracks.mid has several tracks, which the midiutil version
+# refused, so it was written by smf.py. With running status the
+# bytes differ, so the events are read back from both and compared instead. The midi IR of every score is also dumped and
+# loaded back, it has to give the same bytes, and so do the in memory writers. The compiled
+# programs of the scores are also run note by note and with numpy, both have to give the same events.
+# Run with: python -m pytest test_smf.py, or python test_smf.py
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+SCORES = ["scale", "chords", "macros", "tracks"]
+
+# movements for the numpy runner, with chords, durations in thirds of a tick, measure errors and key changes
+PROGRAMS = {
+    "chords": "piano: do/mi/sol re/fa [do mi]*2 fa sol 2 la 1 do/mi\n",
+    "thirds": "piano: :1/12 do re mi :1/4 fa | sol:1/3 la si:1/6 r:1/6\n",
+    "measures": "piano: !3/4 :1/4 do re mi fa | sol | !2/4 la si |\n",
+    "keys": "piano: +do -re do re mi [+mi mi] do+ re- | >> v=40 do <<< re\n",
+}
+
+
+def read_var_length(data, i):
+    value = 0
+    while True:
+        byte = data[i]
+        i += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, i
+
+
+# The events of every track of a midi file as (tick, message) pairs, with running status
+# expanded and note ons with velocity 0 read as note offs (their velocity is lost)
+def read_events(data):
+    assert data[:4] == b"MThd"
+    n_tracks = int.from_bytes(data[10:12], "big")
+    tracks = []
+    i = 14
+    for _ in range(n_tracks):
+        assert data[i:i + 4] == b"MTrk"
+        end = i + 8 + int.from_bytes(data[i + 4:i + 8], "big")
+        i += 8
+        tick = 0
+        status = None
+        events = []
+        while i < end:
+            delta, i = read_var_length(data, i)
+            tick += delta
+            if data[i] == 0xFF:
+                length, start = read_var_length(data, i + 2)
+                events.append((tick, ("meta", data[i + 1], bytes(data[start:start + length]))))
+                i = start + length
+                status = None
+                continue
+            if data[i] >= 0x80:
+                status = data[i]
+                i += 1
+            kind = status & 0xF0
+            if kind == 0xC0:
+                events.append((tick, (status, data[i])))
+                i += 1
+                continue
+            pitch, velocity = data[i], data[i + 1]
+            i += 2
+            if kind == 0x80 or (kind == 0x90 and velocity == 0):
+                events.append((tick, ("off", status & 0x0F, pitch)))
+            else:
+                events.append((tick, (status, pitch, velocity)))
+        tracks.append(events)
+    return tracks
+
+
+def compile_score(name, running_status):
+    with open(os.path.join(GOLDEN, name + ".txt")) as f:
+        ast = Parser(Tokenizer(f.read()).buffer()).parse()
+
+    fd, path = tempfile.mkstemp(suffix=".mid")
+    os.close(fd)
+    try:
+        gen_midi(ast, path, running_status=running_status)
+        assert ast.err_list == [], ast.err_list
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+@pytest.mark.parametrize("name", SCORES)
+def test_golden(name):
+    with open(os.path.join(GOLDEN, name + ".mid"), "rb") as f:
+        golden = f.read()
+
+    plain = compile_score(name, running_status=False)
+    assert plain == golden, f"{name}: the file differs from golden/{name}.mid"
+
+    packed = compile_score(name, running_status=True)
+    assert read_events(packed) == read_events(golden), f"{name}: the events differ with running status"
+    assert len(packed) < len(golden)
+
+    with open(os.path.join(GOLDEN, name + ".txt")) as f:
+        ir = gen_ir(Parser(Tokenizer(f.read()).buffer()).parse())
+    text = dump(ir)
+    loaded = load(text)
+    assert dump(loaded) == text, f"{name}: the IR changed when loaded back"
+    assert encode_smf(loaded, running_status=False) == golden, f"{name}: the loaded IR differs from golden/{name}.mid"
+
+    with open(os.path.join(GOLDEN, name + ".txt")) as f:
+        source = f.read()
+    in_memory = gen_midi_bytes(Parser(Tokenizer(source).buffer()).parse(), running_status=False)
+    assert in_memory == golden, f"{name}: gen_midi_bytes differs from golden/{name}.mid"
+    buffer = bytearray(len(golden))
+    assert gen_midi(Parser(Tokenizer(source).buffer()).parse(), memoryview(buffer), running_status=False) == len(golden)
+    assert buffer == golden, f"{name}: the file written to a memoryview differs from golden/{name}.mid"
+    chunks = list(stream_midi(Parser(Tokenizer(source).buffer()).parse(), running_status=False))
+    assert b"".join(chunks) == golden, f"{name}: the streamed chunks differ from golden/{name}.mid"
+
+    # the bar index is the same whichever way the notes are generated
+    indexes = []
+    for vectorised in (False, True):
+        bars = gen_ir(Parser(Tokenizer(source).buffer()).parse(), vectorised=vectorised).bars
+        indexes.append([(index.channel, list(index.ticks), list(index.lines), list(index.columns)) for index in bars])
+    assert indexes[0] == indexes[1], f"{name}: the bar index differs with numpy"
+
+    # the program run note by note gives the golden file too, not only the default numpy runner
+    scalar = gen_midi_bytes(Parser(Tokenizer(source).buffer()).parse(), running_status=False, vectorised=False)
+    assert scalar == golden, f"{name}: the notes generated one at a time differ from golden/{name}.mid"
+
+
+def test_ir_strings():
+    # a title can span lines, its text is escaped in the dump so it's loaded back the same
+    source = 'title: "first line\r\nsecond line ; not a comment"\npiano: do re\n'
+    ir = gen_ir(Parser(Tokenizer(source).buffer()).parse())
+    text = dump(ir)
+    assert r'Meta Text "first line\r\nsecond line ; not a comment"' in text
+    assert dump(load(text)) == text
+    assert encode_smf(load(text)) == encode_smf(ir)
+
+
+def test_merge_tracks():
+    # the format 0 file has the events of every track of the format 1 one, at the same ticks.
+    # Events at the same tick keep the order of their tracks, and there's one end of track
+    end_of_track = ("meta", META_END_OF_TRACK, b"")
+    for name in SCORES:
+        with open(os.path.join(GOLDEN, name + ".txt")) as f:
+            ir = gen_ir(Parser(Tokenizer(f.read()).buffer()).parse())
+        merged = merge_tracks(ir)
+        assert (merged.format, len(merged.tracks), merged.ticks_per_quarter) == (0, 1, ir.ticks_per_quarter)
+
+        tracks = read_events(encode_smf(ir, running_status=False))
+        expected = sorted((tick, t_id, position, message) for t_id, events in enumerate(tracks)
+                          for position, (tick, message) in enumerate(events) if message != end_of_track)
+        data = encode_smf(merged, running_status=False)
+        assert data[8:10] == b"\x00\x00"
+        [events] = read_events(data)
+        assert events == [(tick, message) for tick, _, _, message in expected] + [(expected[-1][0], end_of_track)], name
+
+        # running status carries over between the messages of the tracks
+        assert read_events(encode_smf(merged)) == [events]
+
+
+def test_repeated_bars():
+    # a bar played again is stored once, as a run of the track. The notes written are the ones
+    # added one at a time
+    source = "piano: :1/4 [do re mi fa | sol la si r |]*50 do/mi sol\n"
+    expected = EventBuffer()
+    pitches = [48 + tone for tone in (0, 2, 4, 5, 7, 9, 11, 0)] * 50 + [48, 52, 55]
+    ticks = [quarter * 960 for quarter in range(400)] + [400 * 960] * 2 + [401 * 960]
+    for i, (pitch, tick) in enumerate(zip(pitches, ticks)):
+        expected.add_note(0, pitch, tick, 960, 0 if i % 8 == 7 and i < 400 else 100)
+    [expected_events] = read_events(encode_smf(MidiIR([expected])))
+
+    for vectorised in [False, True] if np is not None else [False]:
+        ir = gen_ir(Parser(Tokenizer(source).buffer()).parse(), vectorised=vectorised)
+        track = ir.tracks[1]
+        assert len(track.runs) == 3 and len(track.events) // 6 == 100 + 1 + 2
+        assert len(track) == 2 * len(pitches) + 2
+        notes = [event for event in read_events(encode_smf(ir))[1] if event[1][0] not in ("meta", PROGRAM_CHANGE)]
+        assert notes == expected_events[:-1], vectorised
+
+
+def test_invalid_messages():
+    # a data byte over 127 would be read back as a status byte, it's an error instead
+    track = EventBuffer()
+    track.add_note(0, 128, 0, 10, 100)
+    with pytest.raises(ValueError, match="tick 0: status 0x90, data bytes 128 100"):
+        encode_smf(MidiIR([track]))
+    track = EventBuffer()
+    track.add_message(0, 0, 0xF0, 0) # system messages aren't supported
+    with pytest.raises(ValueError, match="status 0xf0"):
+        encode_smf(MidiIR([track]))
+
+    for event, error in (("NoteOn 0 C10 100", "data bytes are 0 to 127, got 132 100"), ("NoteOn 0 C4 128", "got 60 128"),
+                         ("ProgramChange 16 0", "channel is 0 to 15"), ("PitchBend 0 16384", "pitch bend is 0 to 16383"),
+                         ("Meta Tempo 16777216", "invalid event")):
+        with pytest.raises(ValueError, match=f"IR error\\(3\\): .*{error}"):
+            load(f".MIDIHeader\n.TrackBegin\n+0: {event}\n.EndTrack\n")
+
+
+# The events (with the runs they stand for), bar indexes and measure errors of running the compiled
+# program of every movement of source, with the given runner
+def run_movements(source, runner, ticks_per_quarter):
+    ast = Parser(Tokenizer(source).buffer()).parse()
+    midi = TrackEvents(ticks_per_quarter)
+    runs = []
+    for m_id, movement in enumerate(ast.tracks[0].movements):
+        program, units = compile_movement(ast, movement, ticks_per_quarter)
+        bars = BarIndex(m_id, movement.instrument)
+        bar_errors = runner(program, units, m_id, midi, bars)
+        runs.append((list(bars.ticks), list(bars.lines), list(bars.columns), bar_errors))
+    return (midi.track.events.tobytes(), midi.track.runs), runs
+
+
+@pytest.mark.skipif(np is None, reason="numpy is not installed")
+@pytest.mark.parametrize("ticks_per_quarter", [TICKS_PER_QUARTER, 1])
+@pytest.mark.parametrize("name", list(PROGRAMS) + SCORES)
+def test_vectorised_program(name, ticks_per_quarter):
+    # with 1 tick per quarter most durations are fractions of a tick, the programs count in units then
+    if name in PROGRAMS:
+        source = PROGRAMS[name]
+    else:
+        with open(os.path.join(GOLDEN, name + ".txt")) as f:
+            source = f.read()
+    scalar = run_movements(source, run_program, ticks_per_quarter)
+    vectorised = run_movements(source, run_program_vectorised, ticks_per_quarter)
+    assert len(scalar[0][1]) > 0
+    assert vectorised[0] == scalar[0], f"{name}: the numpy runner gives other events"
+    assert vectorised[1] == scalar[1], f"{name}: the numpy runner gives other bars or measure errors"
+
+
+def test_rescaled_program():
+    # the thirds, fifths... are found after notes and inside chords, the program compiled before them
+    # is rescaled and counts in units of 1/315 tick, like a program with 315 ticks a quarter does
+    source = "piano: do re:1/3 mi | do/mi:1/5 [re:1/7 mi]*2 :1/9 fa sol !3/4 la |\n"
+    ast = Parser(Tokenizer(source).buffer()).parse()
+    movement = ast.tracks[0].movements[0]
+    program, units = compile_movement(ast, movement, 1)
+    whole_ticks, whole_units = compile_movement(ast, movement, units)
+    assert type(program) is MovementProgram and (units, whole_units) == (315, 1)
+    assert program.code == whole_ticks.code
+    assert len(program) == len(whole_ticks) > 10
+
+
+def test_compiler():
+    # compiler.py parses from a TokenBuffer filled from the file as the parser reads it. With a block
+    # of 1 character the file is read about a line at a time, and the midi files are still the golden ones
+    import compiler
+    buffers = []
+
+    class RecordingParser(Parser):
+        def __init__(self, tokens, *args, **kwargs):
+            buffers.append(tokens)
+            super().__init__(tokens, *args, **kwargs)
+
+    block = Tokenizer.BLOCK
+    compiler.Parser, Tokenizer.BLOCK = RecordingParser, 1
+    try:
+        for name in SCORES:
+            fd, path = tempfile.mkstemp(suffix=".mid")
+            os.close(fd)
+            try:
+                assert compiler.main([os.path.join(GOLDEN, name + ".txt"), path]) == 0
+                with open(path, "rb") as f:
+                    data = f.read()
+            finally:
+                os.remove(path)
+            with open(os.path.join(GOLDEN, name + ".mid"), "rb") as f:
+                assert read_events(data) == read_events(f.read()), f"{name}: compiler.py differs from golden/{name}.mid"
+    finally:
+        compiler.Parser, Tokenizer.BLOCK = Parser, block
+
+    assert [type(tokens) for tokens in buffers] == [TokenBuffer] * len(SCORES)
+    # the names midigen exports don't hide the ones of the AST
+    import ai_ast
+    assert compiler.Program is ai_ast.Program
+    # scale.txt is a single line
+    assert [len(tokens.texts) > 1 for tokens in buffers] == [name != "scale" for name in SCORES]
+
+
+def test_compiler_sizes():
+    # --sizes prints the size of every movement, even when one of them is over the budget
+    import compiler
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        assert compiler.main([os.path.join(GOLDEN, "tracks.txt"), os.devnull, "--sizes", "--max-events", "20"]) == 1
+    assert stderr.getvalue().splitlines() == [
+        "Size(7,4): piano expands into 36 events, 24 beats",
+        "Size(8,4): flute expands into 13 events, 28 beats",
+        "Size(11,4): bass expands into 9 events, 8 beats",
+        "Compilation errors:",
+        "Expansion error(7,4): piano expands into 36 events, more than the limit of 20",
+    ]
+
+
+@pytest.mark.skipif(np is None, reason="numpy is not installed")
+def test_bars_without_numpy():
+    # the bars are checked with python lists when numpy isn't there, the errors are the same
+    import midigen
+    errors = []
+    for name in ("measures", "thirds"):
+        with_numpy = run_movements(PROGRAMS[name], run_program, TICKS_PER_QUARTER)
+        with pytest.MonkeyPatch.context() as patch:
+            patch.setattr(midigen, "np", None)
+            assert run_movements(PROGRAMS[name], run_program, TICKS_PER_QUARTER) == with_numpy, name
+        errors.append(len(with_numpy[1][0][3]))
+    assert errors == [2, 1]
+
+
+@pytest.mark.skipif(np is None, reason="numpy is not installed")
+def test_short_movements_run_scalar():
+    # a movement shorter than MIN_VECTORISED_INSTRUCTIONS is run by run_program even when vectorised
+    import midigen
+    runs = []
+
+    def recorded(name):
+        run = getattr(midigen, name)
+        return lambda *args: runs.append(name) or run(*args)
+
+    source = "piano: " + "do re mi fa | " * 5 + "\nviolin: " + "do re mi fa | " * 50 + "\n"
+    with pytest.MonkeyPatch.context() as patch:
+        for name in ("run_program", "run_program_vectorised"):
+            patch.setattr(midigen, name, recorded(name))
+        gen_ir(Parser(Tokenizer(source).buffer()).parse())
+    assert runs == ["run_program", "run_program_vectorised"]
+
+
+def test_channels():
+    # every movement gets its own channel, skipping channel 9 that general midi keeps for drums
+    source = 'track "a":\n' + "".join(f'piano "m{i}": do re\n' for i in range(9))
+    source += 'track "b":\ndrums: do do\nviolin: re\nstandard_kit: mi\n'
+    ast = Parser(Tokenizer(source).buffer()).parse()
+    data = gen_midi_bytes(ast, running_status=False)
+    assert ast.err_list == [], ast.err_list
+    programs = [message for track in read_events(data) for _, message in track if message[0] in range(0xC0, 0xD0)]
+    # the kit is the same for both drums movements, the repeated program change is removed
+    assert programs == [(0xC0 + channel, 0) for channel in range(9)] + [(0xC9, 0), (0xCA, 40)]
+
+    # channel 9 plays one kit, a movement asking for another one is reported
+    ast = Parser(Tokenizer("drums: do\nviolin: re\njazz_kit: mi\n").buffer()).parse()
+    assert gen_midi_bytes(ast) is None
+    assert len(ast.err_list) == 1
+    assert ast.err_list[0].startswith('Compilation error(3,0): channel 10 already plays the kit "drums" (1,0), "jazz_kit" was left out')
+
+    # past the 15 channels for instruments, the movements are reported and nothing is written
+    source = "".join(f'piano "m{i}": do re\n' for i in range(17)) + "drums: do\n"
+    ast = Parser(Tokenizer(source).buffer()).parse()
+    assert gen_midi_bytes(ast) is None
+    assert [error.split(":")[0] for error in ast.err_list] == ["Compilation error(16,0)", "Compilation error(17,0)"]
+
+
+if __name__ == "__main__":
+    for name in SCORES:
+        test_golden(name)
+        print(f"{name}: ok")
+    test_channels()
+    if np is not None:
+        test_bars_without_numpy()
+    test_rescaled_program()
+    if np is not None:
+        test_short_movements_run_scalar()
+    test_compiler()
+    test_compiler_sizes()
+    test_ir_strings()
+    test_merge_tracks()
+    test_repeated_bars()
+    test_invalid_messages()
+    if np is not None:
+        for ticks_per_quarter in (TICKS_PER_QUARTER, 1):
+            for name in list(PROGRAMS) + SCORES:
+                test_vectorised_program(name, ticks_per_quarter)
+        print(f"numpy runner: ok, {len(PROGRAMS) + len(SCORES)} scores")